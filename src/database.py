@@ -1,11 +1,521 @@
-BOOT_DB_REQUEST = {
-    "mysql": ["""
-CREATE TABLE IF NOT EXISTS `asset_price_cache` (
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_BATCH_SIZE = 1000
+
+# scope ids of the price_series table
+PRICE_SCOPE_IDS = {"GECKO": 1, "BINANCE": 2}
+
+# candle size in minutes of the prices a scope gives when no coarser resolution is asked
+NATIVE_RESOLUTION_MINUTES = {"GECKO": 1, "BINANCE": 3}
+
+# fields identifying a raw operation of an account statement, by raw operation table
+RAW_OPERATION_KEY_FIELDS = {
+    "binance_raw_operations": ["operation_datetime", "account", "operation", "coin", "change", "remark"],
+    "coinbase_raw_operations": ["operation_datetime", "operation", "coin", "quantity", "spot_price", "amount_price", "note"],
+}
+
+# raw operation table of each exchange extracting its crypto and fiat history, by operation_watermark exchange
+EXTRACTED_RAW_OPERATION_TABLES = {"BINANCE": "binance_raw_operations", "COINBASE": "coinbase_raw_operations"}
+
+# key version of a raw operation fingerprint: 2 keeps amounts exact, 1 keeps 6 significant digits
+LEGACY_FINGERPRINT_VERSION = 1
+FINGERPRINT_VERSION = 2
+
+EPOCH = datetime(1970, 1, 1)
+MINUTE = timedelta(minutes=1)
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "busy_timeout": 30000,
+}
+
+
+def create_db_engine(database_config):
+    """
+    Engine of the configured dialect: "mysql" (MariaDB server) or "sqlite" (embedded, WAL mode)
+    """
+    if database_config["database_dialect"] != "sqlite":
+        return create_engine(database_config["database_uri"])
+
+    # datetime columns are stored as iso strings, and parsed back from their declared type
+    sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+    sqlite3.register_converter("datetime", lambda value: datetime.fromisoformat(value.decode()))
+    # tax report amounts are Decimal, stored in float columns like mysql does
+    sqlite3.register_adapter(Decimal, float)
+
+    engine = create_engine(database_config["database_uri"],
+                           connect_args={"detect_types": sqlite3.PARSE_DECLTYPES, "check_same_thread": False},
+                           poolclass=QueuePool)
+    pragmas = dict(SQLITE_PRAGMAS, **database_config.get("sqlite_pragmas", {}))
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+        cursor.close()
+
+    return engine
+
+
+class BatchWriter:
+    """
+    Buffer rows (dict of bound parameters) of one statement and flush them with executemany
+    by chunk of batch_size, inside the transaction of the given connection
+    """
+
+    def __init__(self, conn, sql: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.conn = conn
+        self.sql = text(sql)
+        self.batch_size = max(1, batch_size)
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        self.conn.execute(self.sql, self.rows)
+        self.count += len(self.rows)
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def to_epoch_minute(timestamp: datetime):
+    """
+    Minute of a naive timestamp since 1970-01-01, the wall clock time is kept as is (no timezone conversion)
+    """
+    return (timestamp.replace(tzinfo=None) - EPOCH) // MINUTE
+
+
+def from_epoch_minute(epoch_minute: int):
+    return EPOCH + epoch_minute * MINUTE
+
+
+def get_raw_operation_key(raw_operation, fields, version: int = FINGERPRINT_VERSION):
+    """
+    Natural key of a raw operation. Amounts are exact (float repr); the version 1 key, only used for the rows
+    fingerprinted from mysql single precision float columns, keeps 6 significant digits
+    """
+    values = []
+    for field in fields:
+        value = raw_operation[field]
+        if isinstance(value, datetime):
+            values.append(value.strftime("%Y-%m-%d %H:%M:%S"))
+        elif isinstance(value, float):
+            values.append(repr(value) if version >= FINGERPRINT_VERSION else "{:.6g}".format(value))
+        else:
+            values.append(str(value).strip())
+
+    return "|".join(values)
+
+
+def get_raw_operation_fingerprint(key: str, occurrence: int):
+    """
+    Fingerprint of the nth occurrence of a raw operation key in a statement, identical rows of a statement stay distinct
+    """
+    return hashlib.sha1("{}#{}".format(key, occurrence).encode("utf-8")).hexdigest()
+
+
+def migrate_price_cache(conn):
+    """
+    Copy the string keyed asset_price_cache ("%Y-%m-%d-%H-%M-SCOPE-asset") into price_series, then drop it
+    """
+    result = conn.execute(text("SELECT `key`, price FROM asset_price_cache")).mappings().all()
+
+    asset_ids = {}
+    series = {}
+    for res in result:
+        parts = res["key"].split("-", 6)
+        if len(parts) != 7 or parts[5] not in PRICE_SCOPE_IDS:
+            continue
+
+        asset = parts[6]
+        if asset not in asset_ids:
+            conn.execute(text("INSERT INTO price_asset (name) VALUES (:name)"), {"name": asset})
+            asset_ids[asset] = conn.execute(text("SELECT id FROM price_asset WHERE name = :name"), {"name": asset}).mappings().fetchone()["id"]
+
+        epoch_minute = to_epoch_minute(datetime.strptime("-".join(parts[:5]), "%Y-%m-%d-%H-%M"))
+        series[(asset_ids[asset], parts[5], epoch_minute)] = res["price"]
+
+    sql = "INSERT INTO price_series (asset_id,  scope_id,  epoch_minute,  price,  resolution_minutes)" \
+          "                  VALUES (:asset_id, :scope_id, :epoch_minute, :price, :resolution_minutes)"
+    with BatchWriter(conn, sql) as writer:
+        for (asset_id, scope, epoch_minute), price in series.items():
+            writer.add({"asset_id": asset_id,
+                        "scope_id": PRICE_SCOPE_IDS[scope],
+                        "epoch_minute": epoch_minute,
+                        "price": price,
+                        "resolution_minutes": NATIVE_RESOLUTION_MINUTES[scope]})
+
+    conn.execute(text("DROP TABLE asset_price_cache"))
+
+
+def migrate_price_resolution(conn):
+    """
+    Add the candle size of each price to a price_series created without it
+    """
+    if "resolution_minutes" in [column["name"] for column in inspect(conn).get_columns("price_series")]:
+        return
+
+    conn.execute(text("ALTER TABLE price_series ADD COLUMN resolution_minutes smallint NOT NULL DEFAULT 1"))
+    for scope, resolution_minutes in NATIVE_RESOLUTION_MINUTES.items():
+        sql = "UPDATE price_series SET resolution_minutes = :resolution_minutes WHERE scope_id = :scope_id"
+        conn.execute(text(sql), {"resolution_minutes": resolution_minutes, "scope_id": PRICE_SCOPE_IDS[scope]})
+
+
+def migrate_raw_fingerprints(conn):
+    """
+    Add the fingerprint of the raw operations loaded without it. mysql float columns only keep single
+    precision amounts, different from the parsed statement ones, so their rows get a version 1 fingerprint
+    """
+    version = LEGACY_FINGERPRINT_VERSION if conn.dialect.name == "mysql" else FINGERPRINT_VERSION
+
+    for table, fields in RAW_OPERATION_KEY_FIELDS.items():
+        if "fingerprint" in [column["name"] for column in inspect(conn).get_columns(table)]:
+            continue
+
+        conn.execute(text("ALTER TABLE `{}` ADD COLUMN `fingerprint` char(40) DEFAULT NULL".format(table)))
+        conn.execute(text("ALTER TABLE `{}` ADD COLUMN `fingerprint_version` tinyint NOT NULL DEFAULT {}".format(table, FINGERPRINT_VERSION)))
+
+        occurrences = {}
+        sql = "UPDATE `{}` SET fingerprint = :fingerprint, fingerprint_version = :fingerprint_version WHERE id = :id".format(table)
+        with BatchWriter(conn, sql) as writer:
+            for res in conn.execute(text("SELECT * FROM `{}` ORDER BY id ASC".format(table))).mappings().all():
+                raw_operation = dict(res)
+                if isinstance(raw_operation["operation_datetime"], str):
+                    raw_operation["operation_datetime"] = datetime.fromisoformat(raw_operation["operation_datetime"])
+
+                key = get_raw_operation_key(raw_operation, fields, version)
+                occurrences[key] = occurrences.get(key, -1) + 1
+                writer.add({"fingerprint": get_raw_operation_fingerprint(key, occurrences[key]), "fingerprint_version": version, "id": res["id"]})
+
+        conn.execute(text("CREATE UNIQUE INDEX `{}_fingerprint` ON `{}` (`fingerprint`)".format(table.replace("_operations", ""), table)))
+
+
+def migrate_operation_source(conn):
+    """
+    Add the staging row of each purchase and sale operation to an operation history created without it
+    """
+    for table in ["purchase_operation_history", "sale_operation_history"]:
+        if "source_id" in [column["name"] for column in inspect(conn).get_columns(table)]:
+            continue
+
+        conn.execute(text("ALTER TABLE `{}` ADD COLUMN `source_id` int DEFAULT NULL".format(table)))
+
+
+def migrate_extraction_watermarks(conn):
+    """
+    Add the CRYPTO and FIAT extraction watermarks of the raw operations loaded before they existed,
+    every raw operation of a successful load was extracted
+    """
+    for exchange, table in EXTRACTED_RAW_OPERATION_TABLES.items():
+        last_id = conn.execute(text("SELECT id FROM `{}` ORDER BY id DESC LIMIT 1".format(table))).scalar()
+        if last_id is None:
+            continue
+
+        for operation in ["CRYPTO", "FIAT"]:
+            sql = "INSERT INTO operation_watermark (exchange,  operation,  last_source_id,  compacted)" \
+                  "                         VALUES (:exchange, :operation, :last_source_id, :compacted)"
+            conn.execute(text(sql), {"exchange": exchange, "operation": operation, "last_source_id": last_id, "compacted": False})
+
+
+SCHEMA_VERSION = 11
+
+# (index name, table, columns) matching the filters of the hot queries, as created by schema version 2
+V2_SCHEMA_INDEXES = [
+    ("purchase_exchange_datetime", "purchase_operation_history", ["exchange", "purchase_datetime"]),
+    ("purchase_datetime", "purchase_operation_history", ["purchase_datetime"]),
+    ("sale_exchange_datetime", "sale_operation_history", ["exchange", "sale_datetime"]),
+    ("sale_datetime", "sale_operation_history", ["sale_datetime"]),
+    ("binance_raw_operation_account_coin", "binance_raw_operations", ["operation", "account", "coin"]),
+    ("binance_fiat_operation", "binance_fiat_history", ["operation"]),
+    ("binance_crypto_datetime_asset", "binance_crypto_history", ["operation_datetime", "asset"]),
+    ("coinbase_raw_operation_coin", "coinbase_raw_operations", ["operation", "coin"]),
+    ("coinbase_fiat_operation", "coinbase_fiat_history", ["operation"]),
+    ("coinbase_crypto_datetime_asset", "coinbase_crypto_history", ["operation_datetime", "asset"]),
+    ("etoro_close_position_id", "etoro_close_positions", ["position_id"]),
+    ("tax_disposal_report", "tax_disposal_history", ["tax_report_id"]),
+]
+
+# indexes of the source_id columns added by schema version 10
+V10_SCHEMA_INDEXES = [
+    ("purchase_exchange_source", "purchase_operation_history", ["exchange", "source_id"]),
+    ("sale_exchange_source", "sale_operation_history", ["exchange", "source_id"]),
+]
+
+# every index of a database created with the current schema, a migration step only creates the indexes of its own version
+SCHEMA_INDEXES = V2_SCHEMA_INDEXES + V10_SCHEMA_INDEXES
+
+
+def create_index_requests(indexes):
+    return ["CREATE INDEX IF NOT EXISTS `{}` ON `{}` ({});".format(name, table, ", ".join("`{}`".format(column) for column in columns))
+            for name, table, columns in indexes]
+
+
+MYSQL_SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS `schema_version` (
+  `version` int(11) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+MYSQL_COINBASE_FIAT_HISTORY_TABLE = """
+CREATE TABLE IF NOT EXISTS `coinbase_fiat_history` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount` float NOT NULL,
+  `operation` varchar(256) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+MYSQL_COINBASE_CRYPTO_HISTORY_TABLE = """
+CREATE TABLE IF NOT EXISTS `coinbase_crypto_history` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `operation` varchar(256) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+MYSQL_ASSET_PRICE_FAILURE_TABLE = """
+CREATE TABLE IF NOT EXISTS `asset_price_failure` (
   `key` varchar(256) NOT NULL,
-  `price` float NOT NULL,
+  `scope` varchar(256) NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `price_datetime` datetime NOT NULL,
+  `reason` varchar(1024) NOT NULL,
+  `failure_datetime` datetime NOT NULL,
+  `attempts` int(11) NOT NULL,
   UNIQUE KEY `key` (`key`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+MYSQL_PRICE_SERIES_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `price_asset` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(256) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+""","""
+CREATE TABLE IF NOT EXISTS `price_series` (
+  `asset_id` int(11) NOT NULL,
+  `scope_id` tinyint(4) NOT NULL,
+  `epoch_minute` int(11) NOT NULL,
+  `price` double NOT NULL,
+  `resolution_minutes` smallint(6) NOT NULL DEFAULT 1,
+  PRIMARY KEY (`asset_id`, `scope_id`, `epoch_minute`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""]
+
+MYSQL_BINANCE_KLINE_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `binance_kline` (
+  `symbol` varchar(64) NOT NULL,
+  `open_time` bigint(20) NOT NULL,
+  `open` double NOT NULL,
+  `high` double NOT NULL,
+  `low` double NOT NULL,
+  `close` double NOT NULL,
+  UNIQUE KEY `symbol_open_time` (`symbol`, `open_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+""","""
+CREATE TABLE IF NOT EXISTS `binance_kline_range` (
+  `symbol` varchar(64) NOT NULL,
+  `first_open_time` bigint(20) NOT NULL,
+  `last_open_time` bigint(20) NOT NULL,
+  `source` varchar(256) NOT NULL,
+  KEY `symbol` (`symbol`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""]
+
+MYSQL_FX_RATE_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `fx_rate` (
+  `pair` varchar(16) NOT NULL,
+  `epoch_minute` int(11) NOT NULL,
+  `rate` double NOT NULL,
+  PRIMARY KEY (`pair`, `epoch_minute`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+""","""
+CREATE TABLE IF NOT EXISTS `fx_rate_range` (
+  `pair` varchar(16) NOT NULL,
+  `first_epoch_minute` int(11) NOT NULL,
+  `last_epoch_minute` int(11) NOT NULL,
+  `source` varchar(256) NOT NULL,
+  KEY `pair` (`pair`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""]
+
+MYSQL_HOLDINGS_TIMELINE_TABLE = """
+CREATE TABLE IF NOT EXISTS `holdings_timeline` (
+  `exchange` varchar(64) NOT NULL,
+  `asset` varchar(64) NOT NULL,
+  `position` int(11) NOT NULL,
+  `change_datetime` datetime NOT NULL,
+  `phase` tinyint(4) NOT NULL,
+  `balance` double NOT NULL,
+  PRIMARY KEY (`exchange`, `asset`, `position`),
+  KEY `as_of` (`exchange`, `asset`, `change_datetime`, `phase`, `position`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+MYSQL_OPERATION_WATERMARK_TABLE = """
+CREATE TABLE IF NOT EXISTS `operation_watermark` (
+  `exchange` varchar(64) NOT NULL,
+  `operation` varchar(16) NOT NULL,
+  `last_source_id` int(11) NOT NULL,
+  `compacted` tinyint(1) NOT NULL,
+  PRIMARY KEY (`exchange`, `operation`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+SQLITE_SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS `schema_version` (
+  `version` integer NOT NULL
+);
+"""
+
+SQLITE_ASSET_PRICE_FAILURE_TABLE = """
+CREATE TABLE IF NOT EXISTS `asset_price_failure` (
+  `key` varchar(256) NOT NULL,
+  `scope` varchar(256) NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `price_datetime` datetime NOT NULL,
+  `reason` varchar(1024) NOT NULL,
+  `failure_datetime` datetime NOT NULL,
+  `attempts` integer NOT NULL,
+  UNIQUE (`key`)
+);
+"""
+
+SQLITE_PRICE_SERIES_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `price_asset` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `name` varchar(256) NOT NULL,
+  UNIQUE (`name`)
+);
+""","""
+CREATE TABLE IF NOT EXISTS `price_series` (
+  `asset_id` integer NOT NULL,
+  `scope_id` integer NOT NULL,
+  `epoch_minute` integer NOT NULL,
+  `price` double NOT NULL,
+  `resolution_minutes` smallint NOT NULL DEFAULT 1,
+  PRIMARY KEY (`asset_id`, `scope_id`, `epoch_minute`)
+) WITHOUT ROWID;
+"""]
+
+SQLITE_BINANCE_KLINE_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `binance_kline` (
+  `symbol` varchar(64) NOT NULL,
+  `open_time` bigint NOT NULL,
+  `open` double NOT NULL,
+  `high` double NOT NULL,
+  `low` double NOT NULL,
+  `close` double NOT NULL,
+  UNIQUE (`symbol`, `open_time`)
+);
+""","""
+CREATE TABLE IF NOT EXISTS `binance_kline_range` (
+  `symbol` varchar(64) NOT NULL,
+  `first_open_time` bigint NOT NULL,
+  `last_open_time` bigint NOT NULL,
+  `source` varchar(256) NOT NULL
+);
 ""","""
+CREATE INDEX IF NOT EXISTS `binance_kline_range_symbol` ON `binance_kline_range` (`symbol`);
+"""]
+
+SQLITE_FX_RATE_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `fx_rate` (
+  `pair` varchar(16) NOT NULL,
+  `epoch_minute` integer NOT NULL,
+  `rate` double NOT NULL,
+  PRIMARY KEY (`pair`, `epoch_minute`)
+) WITHOUT ROWID;
+""","""
+CREATE TABLE IF NOT EXISTS `fx_rate_range` (
+  `pair` varchar(16) NOT NULL,
+  `first_epoch_minute` integer NOT NULL,
+  `last_epoch_minute` integer NOT NULL,
+  `source` varchar(256) NOT NULL
+);
+""","""
+CREATE INDEX IF NOT EXISTS `fx_rate_range_pair` ON `fx_rate_range` (`pair`);
+"""]
+
+SQLITE_HOLDINGS_TIMELINE_TABLES = ["""
+CREATE TABLE IF NOT EXISTS `holdings_timeline` (
+  `exchange` varchar(64) NOT NULL,
+  `asset` varchar(64) NOT NULL,
+  `position` integer NOT NULL,
+  `change_datetime` datetime NOT NULL,
+  `phase` integer NOT NULL,
+  `balance` double NOT NULL,
+  PRIMARY KEY (`exchange`, `asset`, `position`)
+) WITHOUT ROWID;
+""","""
+CREATE INDEX IF NOT EXISTS `holdings_timeline_as_of` ON `holdings_timeline` (`exchange`, `asset`, `change_datetime`, `phase`, `position`);
+"""]
+
+SQLITE_OPERATION_WATERMARK_TABLE = """
+CREATE TABLE IF NOT EXISTS `operation_watermark` (
+  `exchange` varchar(64) NOT NULL,
+  `operation` varchar(16) NOT NULL,
+  `last_source_id` integer NOT NULL,
+  `compacted` tinyint(1) NOT NULL,
+  PRIMARY KEY (`exchange`, `operation`)
+);
+"""
+
+SQLITE_COINBASE_FIAT_HISTORY_TABLE = """
+CREATE TABLE IF NOT EXISTS `coinbase_fiat_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount` float NOT NULL,
+  `operation` varchar(256) NOT NULL
+);
+"""
+
+SQLITE_COINBASE_CRYPTO_HISTORY_TABLE = """
+CREATE TABLE IF NOT EXISTS `coinbase_crypto_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `operation` varchar(256) NOT NULL
+);
+"""
+
+BOOT_DB_REQUEST = {
+    "mysql": MYSQL_PRICE_SERIES_TABLES + ["""
+
 CREATE TABLE IF NOT EXISTS `asset_gecko_convert` (
   `token_name` varchar(256) NOT NULL,
   `gecko_name` varchar(256) NOT NULL,
@@ -44,7 +554,10 @@ CREATE TABLE `binance_raw_operations` (
   `coin` varchar(256) NOT NULL,
   `change` float NOT NULL,
   `remark` varchar(256) NOT NULL,
+  `fingerprint` char(40) NOT NULL,
+  `fingerprint_version` tinyint NOT NULL DEFAULT 2,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `fingerprint` (`fingerprint`),
   KEY `coin` (`coin`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 ""","""
@@ -59,9 +572,20 @@ CREATE TABLE `coinbase_raw_operations` (
   `spot_price` float NOT NULL,
   `amount_price` float NOT NULL,
   `note` text NOT NULL,
-  PRIMARY KEY (`id`)
+  `fingerprint` char(40) NOT NULL,
+  `fingerprint_version` tinyint NOT NULL DEFAULT 2,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `fingerprint` (`fingerprint`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 ""","""
+DROP TABLE IF EXISTS `coinbase_fiat_history`;
+""",
+MYSQL_COINBASE_FIAT_HISTORY_TABLE,
+"""
+DROP TABLE IF EXISTS `coinbase_crypto_history`;
+""",
+MYSQL_COINBASE_CRYPTO_HISTORY_TABLE,
+"""
 DROP TABLE IF EXISTS `etoro_close_positions`;
 ""","""
 CREATE TABLE `etoro_close_positions` (
@@ -103,6 +627,7 @@ CREATE TABLE `purchase_operation_history` (
   `current_asset_price_usd` float NOT NULL,
   `current_asset_price_euro` float NOT NULL,
   `exchange` varchar(256) NOT NULL,
+  `source_id` int(11) DEFAULT NULL,
   PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 ""","""
@@ -118,6 +643,7 @@ CREATE TABLE `sale_operation_history` (
   `current_asset_price_usd` float NOT NULL,
   `current_asset_price_euro` float NOT NULL,
   `exchange` varchar(256) NOT NULL,
+  `source_id` int(11) DEFAULT NULL,
   PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 ""","""
@@ -147,5 +673,201 @@ CREATE TABLE `tax_report` (
   `global_pnl` float NOT NULL,
   PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-"""]
+""",
+MYSQL_ASSET_PRICE_FAILURE_TABLE] + MYSQL_BINANCE_KLINE_TABLES + MYSQL_FX_RATE_TABLES + [
+MYSQL_HOLDINGS_TIMELINE_TABLE,
+MYSQL_OPERATION_WATERMARK_TABLE,
+MYSQL_SCHEMA_VERSION_TABLE] + create_index_requests(SCHEMA_INDEXES),
+    "sqlite": SQLITE_PRICE_SERIES_TABLES + ["""
+
+CREATE TABLE IF NOT EXISTS `asset_gecko_convert` (
+  `token_name` varchar(256) NOT NULL,
+  `gecko_name` varchar(256) NOT NULL,
+  UNIQUE (`token_name`)
+);
+""","""
+DROP TABLE IF EXISTS `binance_crypto_history`;
+""","""
+CREATE TABLE `binance_crypto_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `operation` varchar(256) NOT NULL
+);
+""","""
+DROP TABLE IF EXISTS `binance_fiat_history`;
+""","""
+CREATE TABLE `binance_fiat_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount` float NOT NULL,
+  `operation` varchar(256) NOT NULL
+);
+""","""
+DROP TABLE IF EXISTS `binance_raw_operations`;
+""","""
+CREATE TABLE `binance_raw_operations` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `account` varchar(256) NOT NULL,
+  `operation` varchar(256) NOT NULL,
+  `coin` varchar(256) NOT NULL,
+  `change` float NOT NULL,
+  `remark` varchar(256) NOT NULL,
+  `fingerprint` char(40) NOT NULL,
+  `fingerprint_version` tinyint NOT NULL DEFAULT 2,
+  UNIQUE (`fingerprint`)
+);
+""","""
+CREATE INDEX IF NOT EXISTS `binance_raw_coin` ON `binance_raw_operations` (`coin`);
+""","""
+DROP TABLE IF EXISTS `coinbase_raw_operations`;
+""","""
+CREATE TABLE `coinbase_raw_operations` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `operation` varchar(256) NOT NULL,
+  `coin` varchar(256) NOT NULL,
+  `quantity` float NOT NULL,
+  `spot_price` float NOT NULL,
+  `amount_price` float NOT NULL,
+  `note` text NOT NULL,
+  `fingerprint` char(40) NOT NULL,
+  `fingerprint_version` tinyint NOT NULL DEFAULT 2,
+  UNIQUE (`fingerprint`)
+);
+""","""
+DROP TABLE IF EXISTS `coinbase_fiat_history`;
+""",
+SQLITE_COINBASE_FIAT_HISTORY_TABLE,
+"""
+DROP TABLE IF EXISTS `coinbase_crypto_history`;
+""",
+SQLITE_COINBASE_CRYPTO_HISTORY_TABLE,
+"""
+DROP TABLE IF EXISTS `etoro_close_positions`;
+""","""
+CREATE TABLE `etoro_close_positions` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `position_id` varchar(256) NOT NULL,
+  `close_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `amount_price` float NOT NULL,
+  `current_asset_price` float NOT NULL,
+  `profit_price` float NOT NULL,
+  `open_asset_price` float NOT NULL
+);
+""","""
+DROP TABLE IF EXISTS `etoro_open_positions`;
+""","""
+CREATE TABLE `etoro_open_positions` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `position_id` varchar(256) NOT NULL,
+  `open_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float DEFAULT NULL,
+  `amount_price` float DEFAULT NULL,
+  `current_asset_price` float DEFAULT NULL,
+  UNIQUE (`position_id`)
+);
+""","""
+DROP TABLE IF EXISTS `purchase_operation_history`;
+""","""
+CREATE TABLE `purchase_operation_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `purchase_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `amount_price_usd` float NOT NULL,
+  `amount_price_euro` float NOT NULL,
+  `current_asset_price_usd` float NOT NULL,
+  `current_asset_price_euro` float NOT NULL,
+  `exchange` varchar(256) NOT NULL,
+  `source_id` integer DEFAULT NULL
+);
+""","""
+DROP TABLE IF EXISTS `sale_operation_history`;
+""","""
+CREATE TABLE `sale_operation_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `sale_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `amount_price_usd` float NOT NULL,
+  `amount_price_euro` float NOT NULL,
+  `current_asset_price_usd` float NOT NULL,
+  `current_asset_price_euro` float NOT NULL,
+  `exchange` varchar(256) NOT NULL,
+  `source_id` integer DEFAULT NULL
+);
+""","""
+DROP TABLE IF EXISTS `tax_disposal_history`;
+""","""
+CREATE TABLE `tax_disposal_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `disposal_datetime` datetime NOT NULL,
+  `current_portfolio_value` float NOT NULL,
+  `disposal_price` float NOT NULL,
+  `current_total_purchase` float NOT NULL,
+  `current_previous_disposed_purchase` float NOT NULL,
+  `current_balanced_purchase` float NOT NULL,
+  `profit_and_loss` float NOT NULL,
+  `tax_report_id` integer NOT NULL
+);
+""","""
+DROP TABLE IF EXISTS `tax_report`;
+""","""
+CREATE TABLE `tax_report` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `creation_date` datetime NOT NULL,
+  `begin_date` datetime DEFAULT NULL,
+  `end_date` datetime DEFAULT NULL,
+  `compacted` tinyint(1) NOT NULL,
+  `global_pnl` float NOT NULL
+);
+""",
+SQLITE_ASSET_PRICE_FAILURE_TABLE] + SQLITE_BINANCE_KLINE_TABLES + SQLITE_FX_RATE_TABLES + SQLITE_HOLDINGS_TIMELINE_TABLES + [
+SQLITE_OPERATION_WATERMARK_TABLE,
+SQLITE_SCHEMA_VERSION_TABLE] + create_index_requests(SCHEMA_INDEXES)
+}
+
+SCHEMA_VERSION_REQUEST = {
+    "mysql": MYSQL_SCHEMA_VERSION_TABLE,
+    "sqlite": SQLITE_SCHEMA_VERSION_TABLE
+}
+
+# schema upgrades of an existing database, by target version (version 1 is the unversioned schema),
+# a step is a sql request or a function of the migration connection
+MIGRATE_DB_REQUEST = {
+    "mysql": {
+        2: [MYSQL_COINBASE_FIAT_HISTORY_TABLE,
+            MYSQL_COINBASE_CRYPTO_HISTORY_TABLE] + create_index_requests(V2_SCHEMA_INDEXES),
+        3: [MYSQL_ASSET_PRICE_FAILURE_TABLE],
+        4: MYSQL_BINANCE_KLINE_TABLES,
+        5: MYSQL_PRICE_SERIES_TABLES + [migrate_price_cache],
+        6: [migrate_price_resolution],
+        7: MYSQL_FX_RATE_TABLES,
+        8: [MYSQL_HOLDINGS_TIMELINE_TABLE],
+        9: [migrate_raw_fingerprints],
+        10: [MYSQL_OPERATION_WATERMARK_TABLE,
+             migrate_operation_source] + create_index_requests(V10_SCHEMA_INDEXES),
+        11: [migrate_extraction_watermarks],
+    },
+    "sqlite": {
+        2: [SQLITE_COINBASE_FIAT_HISTORY_TABLE,
+            SQLITE_COINBASE_CRYPTO_HISTORY_TABLE] + create_index_requests(V2_SCHEMA_INDEXES),
+        3: [SQLITE_ASSET_PRICE_FAILURE_TABLE],
+        4: SQLITE_BINANCE_KLINE_TABLES,
+        5: SQLITE_PRICE_SERIES_TABLES + [migrate_price_cache],
+        6: [migrate_price_resolution],
+        7: SQLITE_FX_RATE_TABLES,
+        8: SQLITE_HOLDINGS_TIMELINE_TABLES,
+        9: [migrate_raw_fingerprints],
+        10: [SQLITE_OPERATION_WATERMARK_TABLE,
+             migrate_operation_source] + create_index_requests(V10_SCHEMA_INDEXES),
+        11: [migrate_extraction_watermarks],
+    }
 }
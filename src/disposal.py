@@ -0,0 +1,128 @@
+import math
+from datetime import datetime
+from decimal import Decimal
+
+
+def divide_half_even(numerator: int, denominator: int):
+    """
+    numerator / denominator rounded to the nearest integer, ties to even (denominator > 0)
+    """
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2 == 1):
+        quotient += 1
+
+    return quotient
+
+
+def to_cents(value):
+    """
+    (cents, negative) of a float or Decimal, its exact value rounded half even to the cent
+    """
+    numerator, denominator = value.as_integer_ratio()
+    return divide_half_even(numerator * 100, denominator), math.copysign(1.0, value) < 0
+
+
+def to_decimal(cents: int, negative: bool):
+    """
+    2 digits Decimal of cents, parsed from its digits so it is exact whatever the context precision.
+    A negative value rounded to zero is printed "-0.00", as the Decimal rounding of the report did
+    """
+    sign = "-" if cents < 0 or (cents == 0 and negative) else ""
+    units, cents = divmod(abs(cents), 100)
+    return Decimal("{}{}.{:02d}".format(sign, units, cents))
+
+
+class DisposalEngine:
+    """
+    CERFA 2086 disposal recurrence on integer cent columns (Python ints, any amount fits).
+
+    Each disposal adds its portfolio value, disposal price and cumulated purchase, compute() evaluates
+    the previous disposed purchase, balanced purchase and profit and loss of every disposal in one pass.
+    Each step is rounded half even to the cent from its exact rational value. This matches rounding each step
+    with 28 digits Decimal, except for ties that Decimal would have rounded beyond 28 digits, and for exact
+    zeros, which are always "0.00" (Decimal could give "-0.00" from negative zero operands).
+    """
+
+    def __init__(self):
+        self.disposal_datetimes = []
+        self.portfolio_values = []
+        self.disposal_prices = []
+        self.total_purchases = []
+        self.profit_and_losses = []
+        # report columns as 2 digits Decimal
+        self.rows = []
+
+    def add(self, disposal_datetime: datetime, portfolio_value: float, disposal_price: float, total_purchase: float):
+        portfolio_value, portfolio_value_negative = to_cents(portfolio_value)
+        disposal_price, disposal_price_negative = to_cents(disposal_price)
+        total_purchase, total_purchase_negative = to_cents(total_purchase)
+
+        self.disposal_datetimes.append(disposal_datetime)
+        self.portfolio_values.append(portfolio_value)
+        self.disposal_prices.append(disposal_price)
+        self.total_purchases.append(total_purchase)
+        self.rows.append({"disposal_datetime": disposal_datetime,
+                          "current_portfolio_value": to_decimal(portfolio_value, portfolio_value_negative),
+                          "disposal_price": to_decimal(disposal_price, disposal_price_negative),
+                          "current_total_purchase": to_decimal(total_purchase, total_purchase_negative)})
+
+    def compute(self):
+        portfolio_values = self.portfolio_values
+        disposal_prices = self.disposal_prices
+        total_purchases = self.total_purchases
+
+        previous_disposed_purchase = 0
+        balanced_purchase = 0
+        self.profit_and_losses = [0] * len(portfolio_values)
+
+        for i in range(len(portfolio_values)):
+            portfolio_value = portfolio_values[i]
+            disposal_price = disposal_prices[i]
+            row = self.rows[i]
+
+            if portfolio_value == 0:
+                raise Exception("Portfolio value is zero at disposal {}".format(self.disposal_datetimes[i]))
+
+            # previous disposed purchase: previous one plus the purchase share of the previous disposal
+            if i > 0:
+                numerator = balanced_purchase * disposal_prices[i - 1] + previous_disposed_purchase * portfolio_values[i - 1]
+                denominator = portfolio_values[i - 1]
+                if denominator < 0:
+                    numerator, denominator = -numerator, -denominator
+
+                previous_disposed_purchase = divide_half_even(numerator, denominator)
+                # the recurrence starts from a plain 0
+                row["current_previous_disposed_purchase"] = to_decimal(previous_disposed_purchase, numerator < 0)
+            else:
+                row["current_previous_disposed_purchase"] = 0
+
+            balanced_purchase = total_purchases[i] - previous_disposed_purchase
+            row["current_balanced_purchase"] = to_decimal(balanced_purchase, False)
+
+            numerator = disposal_price * portfolio_value - balanced_purchase * disposal_price
+            denominator = portfolio_value
+            if denominator < 0:
+                numerator, denominator = -numerator, -denominator
+
+            self.profit_and_losses[i] = divide_half_even(numerator, denominator)
+            row["profit_and_loss"] = to_decimal(self.profit_and_losses[i], numerator < 0)
+
+    def get_global_pnl(self, first: int = 0, last: int = None):
+        """
+        Sum of the profit and loss of disposals [first, last)
+        """
+        profit_and_losses = self.profit_and_losses[first:last]
+        if not profit_and_losses:
+            return 0
+
+        global_pnl = sum(profit_and_losses)
+        return to_decimal(global_pnl, False)
+
+    def get_disposals(self, first: int = 0, last: int = None):
+        """
+        Rows of disposals [first, last) for dump_to_csv and save_declaration, values as 2 digits Decimal
+        """
+        return self.rows[first:last]
+
+    def __len__(self):
+        return len(self.disposal_datetimes)
@@ -2,9 +2,11 @@ import csv
 import logging
 from datetime import datetime
 
+from sqlalchemy import text
 from sqlalchemy.engine import Connection
 
-from exchange.common import AbstractExchangeExtractor
+from database import DEFAULT_BATCH_SIZE
+from exchange.common import AbstractExchangeExtractor, not_coin
 from utils import CurrencyExtractor
 
 logger = logging.getLogger("main")
@@ -13,20 +15,42 @@ logger = logging.getLogger("main")
 class BinanceTaxExtractor(AbstractExchangeExtractor):
 
     PLATFORM = "BINANCE"
-
-    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor):
-        super(BinanceTaxExtractor, self).__init__(connection, currency_extractor)
+    PRICE_SCOPE = "BINANCE"
+
+    RAW_OPERATION_TABLE = "binance_raw_operations"
+    CRYPTO_HISTORY_TABLE = "binance_crypto_history"
+    RAW_AMOUNT_FIELD = "change"
+    OPERATION_RULES = [
+        # deposit/withdraw with crypto
+        ("Deposit", "Spot", not_coin("EUR"), "BUY", 1),
+        ("Withdraw", "Spot", not_coin("EUR"), "SELL", 1),
+        # buy/sell with crypto
+        ("Buy", "Spot", not_coin("EUR"), "BUY", 1),
+        ("Sell", "Spot", not_coin("EUR"), "SELL", 1),
+        ("Fee", "Spot", not_coin("EUR"), "SELL", 1),
+        ("Small assets exchange BNB", "Spot", not_coin("EUR"), "BUY", 1),
+        # crypto free-buy
+        ("Savings Interest", "Spot", not_coin("EUR"), "BUY", 1),
+        ("POS savings interest", "Spot", not_coin("EUR"), "BUY", 1),
+        ("Launchpool Interest", "Spot", not_coin("EUR"), "BUY", 1),
+        ("Super BNB Mining", "Spot", not_coin("EUR"), "BUY", 1),
+        # crypto free-buy/airdrop
+        ("Distribution", "Spot", not_coin("EUR"), "BUY", 1),
+    ]
+
+    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor, batch_size: int = DEFAULT_BATCH_SIZE):
+        super(BinanceTaxExtractor, self).__init__(connection, currency_extractor, batch_size=batch_size)
 
     def clean_all_history(self):
         super(BinanceTaxExtractor, self).clean_all_history()
         
         with self.connection.begin() as conn:
             sql = "DELETE FROM `binance_raw_operations`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
             sql = "DELETE FROM `binance_fiat_history`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
             sql = "DELETE FROM `binance_crypto_history`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
 
     def load_account_statement(self, filepath):
         with open(filepath) as csvfile:
@@ -34,19 +58,17 @@ class BinanceTaxExtractor(AbstractExchangeExtractor):
 
             with self.connection.begin() as conn:
 
-                sql = "INSERT INTO binance_raw_operations (`operation_datetime`, `account`, `operation`, `coin`, `change`, `remark`)" \
-                      "                            VALUES (%s,                   %s,        %s,          %s,     %s,       %s      )"
+                sql = "INSERT INTO binance_raw_operations (`operation_datetime`, `account`, `operation`, `coin`, `change`, `remark`, `fingerprint`)" \
+                      "                            VALUES (:operation_datetime,  :account,  :operation,  :coin,  :change,  :remark,  :fingerprint )"
 
-                for row in reader:
-                    if row[0] == "UTC_Time":
-                        continue
+                raw_operations = ({"operation_datetime": datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"),
+                                   "account": row[1],
+                                   "operation": row[2],
+                                   "coin": row[3],
+                                   "change": float(row[4]),
+                                   "remark": row[5]} for row in reader if row[0] != "UTC_Time")
 
-                    conn.execute(sql, [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S"),
-                                       row[1],
-                                       row[2],
-                                       row[3],
-                                       float(row[4]),
-                                       row[5]])
+                self.save_raw_operations(conn, sql, raw_operations)
 
     def process_load(self):
         """
@@ -75,157 +97,59 @@ class BinanceTaxExtractor(AbstractExchangeExtractor):
 
     def extract_fiat_history(self):
         sqli = "INSERT INTO binance_fiat_history(operation_datetime, asset, amount, operation)" \
-               "                          VALUES (%s,                 %s,    %s,     %s       )"
-        with self.connection.begin() as conn:
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin = %s AND account = %s;"
-            result = conn.execute(sql, ["Deposit", "EUR", "Spot"]).mappings().all()
+               "                          VALUES (:operation_datetime, :asset, :amount, :operation)"
+        with self.connection.begin() as conn, self.batch_writer(conn, sqli) as writer:
+            after_id, last_id = self.get_extraction_range(conn, "FIAT")
+            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = :operation AND coin = :coin AND account = :account AND id > :after_id AND id <= :last_id;"
+            result = conn.execute(text(sql), {"operation": "Deposit", "coin": "EUR", "account": "Spot", "after_id": after_id, "last_id": last_id}).mappings().all()
 
             for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    "EUR",
-                                    res["change"],
-                                    "DEPOSIT"])
+                writer.add({"operation_datetime": res["operation_datetime"],
+                            "asset": "EUR",
+                            "amount": res["change"],
+                            "operation": "DEPOSIT"})
 
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin = %s AND account = %s;"
-            result = conn.execute(sql, ["Withdraw", "EUR", "Spot"]).mappings().all()
+            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = :operation AND coin = :coin AND account = :account AND id > :after_id AND id <= :last_id;"
+            result = conn.execute(text(sql), {"operation": "Withdraw", "coin": "EUR", "account": "Spot", "after_id": after_id, "last_id": last_id}).mappings().all()
 
             for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    "EUR",
-                                    res["change"],
-                                    "WITHDRAW"])
-
-    def extract_crypto_history(self):
-        sqli = "INSERT INTO binance_crypto_history(operation_datetime, asset, amount_asset, operation)" \
-               "                           VALUES (%s,                 %s,    %s,           %s       )"
+                writer.add({"operation_datetime": res["operation_datetime"],
+                            "asset": "EUR",
+                            "amount": res["change"],
+                            "operation": "WITHDRAW"})
 
-        with self.connection.begin() as conn:
-            # search for deposit with crypto
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Deposit", "EUR", "Spot"]).mappings().all()
-
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # search for widrawth with crypto
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Withdraw", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "SELL"])
-
-            # search for buy/sell with crypto
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Buy", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # search for buy/sell with crypto
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Sell", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "SELL"])
-
-            # search for fee
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Fee", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "SELL"])
-
-            # search for bnb convert
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Small assets exchange BNB", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # Savings Interest: used (crypto free-buy)
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Savings Interest", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # POS savings interest: used (crypto free-buy)
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["POS savings interest", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # Launchpool Interest: used (crypto free-buy)
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Launchpool Interest", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # Super BNB Mining: used (crypto free-buy)
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Super BNB Mining", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
-
-            # Distribution: used (crypto free-buy/airdrop)
-            sql = "SELECT * FROM `binance_raw_operations` WHERE operation = %s AND coin != %s AND account = %s;"
-            result = conn.execute(sql, ["Distribution", "EUR", "Spot"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["change"],
-                                    "BUY"])
+            if last_id > after_id:
+                self.save_operation_watermark(conn, "FIAT", last_id)
 
     def consolidate_history(self):
         # corrige les sommes negatives ?
         pass
 
-    def get_all_fiat_deposit(self):
+    def get_all_fiat_deposit(self, after_id: int = 0):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM binance_fiat_history where operation = %s"
-            args = ["DEPOSIT"]
+            sql = "SELECT * FROM binance_fiat_history where operation = :operation AND id > :after_id ORDER BY id ASC"
+            args = {"operation": "DEPOSIT", "after_id": after_id}
 
-            result = conn.execute(sql, args).mappings().all()
+            result = conn.execute(text(sql), args).mappings().all()
             return result
 
-    def get_all_fiat_withdraw(self):
+    def get_all_fiat_withdraw(self, after_id: int = 0):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM binance_fiat_history where operation = %s"
-            args = ["WITHDRAW"]
+            sql = "SELECT * FROM binance_fiat_history where operation = :operation AND id > :after_id ORDER BY id ASC"
+            args = {"operation": "WITHDRAW", "after_id": after_id}
 
-            result = conn.execute(sql, args).mappings().all()
+            result = conn.execute(text(sql), args).mappings().all()
             return result
 
     def generate_purchase_operation_history(self):
         logger.info("Generate binance purchase operation history")
-        all_open_positions = self.get_all_fiat_deposit()
+        last_source_id = self.get_operation_watermark("PURCHASE")
+        all_open_positions = self.get_all_fiat_deposit(after_id=last_source_id)
+        euro_prices = self.get_euro_prices([open_position["operation_datetime"] for open_position in all_open_positions])
 
+        purchase_operations = []
         for open_position in all_open_positions:
-            euro_price = self.currency_extractor.get_asset_price("euro", open_position["operation_datetime"])
+            euro_price = euro_prices[open_position["operation_datetime"]]
             purchase_operation = {
                 "purchase_datetime": open_position["operation_datetime"],
                 "asset": open_position["asset"],
@@ -234,16 +158,23 @@ class BinanceTaxExtractor(AbstractExchangeExtractor):
                 "amount_price_euro": open_position["amount"],
                 "current_asset_price_usd": open_position["amount"]/euro_price,  # warn: price is already in euro, get dollar instead
                 "current_asset_price_euro": open_position["amount"],
+                "source_id": open_position["id"],
             }
 
-            self.save_purchase_operation(purchase_operation)
+            purchase_operations.append(purchase_operation)
+
+        self.save_purchase_operations(purchase_operations, last_source_id=max([last_source_id] + [open_position["id"] for open_position in all_open_positions]),
+                                      replace_all=not last_source_id)
 
     def generate_sale_operation_history(self, try_compact: bool = False):
         logger.info("Generate binance sale operation history (compact is {})".format(try_compact))
-        all_close_positions = self.get_all_fiat_withdraw()
+        last_source_id = self.get_operation_watermark("SALE")
+        all_close_positions = self.get_all_fiat_withdraw(after_id=last_source_id)
+        euro_prices = self.get_euro_prices([close_position["operation_datetime"] for close_position in all_close_positions])
 
+        sale_operations = []
         for close_position in all_close_positions:
-            euro_price = self.currency_extractor.get_asset_price("euro", close_position["operation_datetime"])
+            euro_price = euro_prices[close_position["operation_datetime"]]
             amount = abs(close_position["amount"])
             sale_operation = {
                 "sale_datetime": close_position["operation_datetime"],
@@ -253,27 +184,19 @@ class BinanceTaxExtractor(AbstractExchangeExtractor):
                 "amount_price_euro": amount,
                 "current_asset_price_usd": amount/euro_price,  # warn: price is already in euro, get dollar instead
                 "current_asset_price_euro": amount,
+                "source_id": close_position["id"],
             }
 
-            self.save_sale_operation(sale_operation)
+            sale_operations.append(sale_operation)
 
-    def get_portfolio_value(self, timestamp: datetime):
-        portfolio_value = 0.0
-        with self.connection.connect() as conn:
-            sql = "select sum(amount_asset) as amount, asset from binance_crypto_history where operation_datetime <= %s group by asset"
-            args = [timestamp]
-
-            result = conn.execute(sql, args).mappings().all()
+        self.save_sale_operations(sale_operations, last_source_id=max([last_source_id] + [close_position["id"] for close_position in all_close_positions]),
+                                  replace_all=not last_source_id)
 
-            for res in result:
-                amount = res["amount"]
-                asset = res["asset"].lower()
-
-                if amount <= 0.0:
-                    continue
+    def get_holding_changes(self, after: datetime = None):
+        with self.connection.connect() as conn:
+            sql = "SELECT operation_datetime, asset, amount_asset FROM binance_crypto_history {}ORDER BY operation_datetime ASC, id ASC" \
+                .format("WHERE operation_datetime > :after " if after else "")
 
-                price = self.currency_extractor.get_asset_price(asset, timestamp, scope="BINANCE")
-                euro_price = self.currency_extractor.get_asset_price("euro", timestamp)
-                portfolio_value += price * amount * euro_price
+            result = conn.execute(text(sql), {"after": after}).mappings().all()
 
-        return portfolio_value
+        return [(res["operation_datetime"], res["asset"].lower(), res["amount_asset"], True) for res in result]
@@ -2,9 +2,11 @@ import csv
 import logging
 from datetime import datetime
 
+from sqlalchemy import text
 from sqlalchemy.engine import Connection
 
-from exchange.common import AbstractExchangeExtractor
+from database import DEFAULT_BATCH_SIZE
+from exchange.common import AbstractExchangeExtractor, any_coin
 from utils import CurrencyExtractor
 
 logger = logging.getLogger("main")
@@ -14,45 +16,63 @@ class CoinbaseTaxExtractor(AbstractExchangeExtractor):
 
     PLATFORM = "COINBASE"
 
-    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor):
-        super(CoinbaseTaxExtractor, self).__init__(connection, currency_extractor)
+    RAW_OPERATION_TABLE = "coinbase_raw_operations"
+    CRYPTO_HISTORY_TABLE = "coinbase_crypto_history"
+    RAW_AMOUNT_FIELD = "quantity"
+    OPERATION_RULES = [
+        # buy/sell crypto (with fiat)
+        ("Buy", None, any_coin, "BUY", 1),
+        ("Sell", None, any_coin, "SELL", -1),
+        # deposit/widrawth (transfert)
+        ("Receive", None, any_coin, "BUY", 1),
+        ("Send", None, any_coin, "SELL", -1),
+        # convert sells the coin, the bought one is taken from the note
+        ("Convert", None, any_coin, "SELL", -1),
+        # crypto free-buy/airdrop
+        ("Coinbase Earn", None, any_coin, "BUY", 1),
+    ]
+
+    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor, batch_size: int = DEFAULT_BATCH_SIZE):
+        super(CoinbaseTaxExtractor, self).__init__(connection, currency_extractor, batch_size=batch_size)
 
     def clean_all_history(self):
         super(CoinbaseTaxExtractor, self).clean_all_history()
 
         with self.connection.begin() as conn:
             sql = "DELETE FROM `coinbase_raw_operations`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
             sql = "DELETE FROM `coinbase_fiat_history`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
             sql = "DELETE FROM `coinbase_crypto_history`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
 
     def load_account_statement(self, filepath):
-        sql = "INSERT INTO `coinbase_raw_operations` (`operation_datetime`, `operation`, `coin`, `quantity`, `spot_price`, `amount_price`, `note`)" \
-              "                               VALUES (%s,                   %s,          %s,     %s,         %s,           %s,             %s    )"
+        sql = "INSERT INTO `coinbase_raw_operations` (`operation_datetime`, `operation`, `coin`, `quantity`, `spot_price`, `amount_price`, `note`, `fingerprint`)" \
+              "                               VALUES (:operation_datetime,  :operation,  :coin,  :quantity,  :spot_price,  :amount_price,  :note,  :fingerprint )"
+
+        def iter_raw_operations(reader):
+            header_found = False
+
+            for row in reader:
+                if row and row[0] == "Timestamp":
+                    header_found = True
+                    continue
+                elif not header_found:
+                    continue
+
+                yield {"operation_datetime": datetime.strptime(row[0], "%Y-%m-%dT%H:%M:%SZ"),
+                       "operation": row[1].upper(),
+                       "coin": row[2],
+                       "quantity": float(row[3]),
+                       "spot_price": float(row[4]),
+                       "amount_price": float(row[5]) if row[5] else 0.0,
+                       "note": row[8]}
 
         with open(filepath) as csvfile:
             reader = csv.reader(csvfile, delimiter=',')
 
-            header_found = False
-
             with self.connection.begin() as conn:
-
-                for row in reader:
-                    if row and row[0] == "Timestamp":
-                        header_found = True
-                        continue
-                    elif not header_found:
-                        continue
-
-                    conn.execute(sql, [datetime.strptime(row[0], "%Y-%m-%dT%H:%M:%SZ"),
-                                       row[1].upper(),
-                                       row[2],
-                                       float(row[3]),
-                                       float(row[4]),
-                                       float(row[5]) if row[5] else 0.0,
-                                       row[8]])
+                self.save_raw_operations(conn, sql, iter_raw_operations(reader))
 
     def process_load(self):
         self.extract_fiat_history()
@@ -61,127 +81,77 @@ class CoinbaseTaxExtractor(AbstractExchangeExtractor):
 
     def extract_fiat_history(self):
         sqli = "INSERT INTO coinbase_fiat_history(operation_datetime, asset, amount, operation)" \
-               "                          VALUES (%s,                 %s,    %s,     %s       )"
-        with self.connection.begin() as conn:
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["BUY"]).mappings().all()
+               "                          VALUES (:operation_datetime, :asset, :amount, :operation)"
+        with self.connection.begin() as conn, self.batch_writer(conn, sqli) as writer:
+            after_id, last_id = self.get_extraction_range(conn, "FIAT")
+            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = :operation AND id > :after_id AND id <= :last_id;"
+            result = conn.execute(text(sql), {"operation": "BUY", "after_id": after_id, "last_id": last_id}).mappings().all()
 
             for res in result:
                 note = res["note"]
                 fiat = note.split(" ")[-1]
-                conn.execute(sqli, [res["operation_datetime"],
-                                    fiat,
-                                    res["amount_price"],
-                                    "BUY"])
+                writer.add({"operation_datetime": res["operation_datetime"],
+                            "asset": fiat,
+                            "amount": res["amount_price"],
+                            "operation": "BUY"})
 
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["SELL"]).mappings().all()
+            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = :operation AND id > :after_id AND id <= :last_id;"
+            result = conn.execute(text(sql), {"operation": "SELL", "after_id": after_id, "last_id": last_id}).mappings().all()
 
             for res in result:
                 note = res["note"]
                 fiat = note.split(" ")[-1]
-                conn.execute(sqli, [res["operation_datetime"],
-                                    fiat,
-                                    res["amount_price"],
-                                    "SELL"])
+                writer.add({"operation_datetime": res["operation_datetime"],
+                            "asset": fiat,
+                            "amount": res["amount_price"],
+                            "operation": "SELL"})
 
-    def extract_crypto_history(self):
-        sqli = "INSERT INTO coinbase_crypto_history(operation_datetime, asset, amount_asset, operation)" \
-               "                           VALUES (%s,                 %s,    %s,           %s       )"
+            if last_id > after_id:
+                self.save_operation_watermark(conn, "FIAT", last_id)
 
-        with self.connection.begin() as conn:
-            # search for buy crypto (with fiat)
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["Buy"]).mappings().all()
-
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["quantity"],
-                                    "BUY"])
-
-            # search for sell crypto (with fiat)
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["Sell"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    -float(res["quantity"]),
-                                    "SELL"])
+    def classify_operation(self, raw_operation, rules):
+        crypto_operations = super(CoinbaseTaxExtractor, self).classify_operation(raw_operation, rules)
 
+        # a convert also buys the new coin given in the note
+        if crypto_operations and raw_operation["operation"].upper() == "CONVERT":
+            note_tokens = raw_operation["note"].split(" ")
+            new_coin = note_tokens[-1]
+            new_amount = float(note_tokens[-2].replace(",","."))
+            crypto_operations.append((raw_operation["operation_datetime"],
+                                      new_coin,
+                                      new_amount,
+                                      "BUY"))
 
-            # search for deposit (transfert)
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["Receive"]).mappings().all()
-
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["quantity"],
-                                    "BUY"])
-
-            # search for widrawth (transfert)
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["Send"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    -float(res["quantity"]),
-                                    "SELL"])
-                                    
-            # search for CONVERT
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["Convert"]).mappings().all()
-
-            for res in result:
-                note = res["note"]
-                note_tokens = note.split(" ")
-                new_coin = note_tokens[-1]
-                new_amount = float(note_tokens[-2].replace(",","."))
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    -float(res["quantity"]),
-                                    "SELL"])
-                conn.execute(sqli, [res["operation_datetime"],
-                                    new_coin,
-                                    new_amount,
-                                    "BUY"])
-
-
-            # Distribution: used (crypto free-buy/airdrop)
-            sql = "SELECT * FROM `coinbase_raw_operations` WHERE operation = %s;"
-            result = conn.execute(sql, ["Coinbase Earn"]).mappings().all()
-            for res in result:
-                conn.execute(sqli, [res["operation_datetime"],
-                                    res["coin"],
-                                    res["quantity"],
-                                    "BUY"])
+        return crypto_operations
 
     def consolidate_history(self):
         pass
 
-    def get_all_fiat_deposit(self):
+    def get_all_fiat_deposit(self, after_id: int = 0):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM coinbase_fiat_history where operation = %s"
-            args = ["BUY"]
+            sql = "SELECT * FROM coinbase_fiat_history where operation = :operation AND id > :after_id ORDER BY id ASC"
+            args = {"operation": "BUY", "after_id": after_id}
 
-            result = conn.execute(sql, args).mappings().all()
+            result = conn.execute(text(sql), args).mappings().all()
             return result
 
-    def get_all_fiat_withdraw(self):
+    def get_all_fiat_withdraw(self, after_id: int = 0):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM coinbase_fiat_history where operation = %s"
-            args = ["SELL"]
+            sql = "SELECT * FROM coinbase_fiat_history where operation = :operation AND id > :after_id ORDER BY id ASC"
+            args = {"operation": "SELL", "after_id": after_id}
 
-            result = conn.execute(sql, args).mappings().all()
+            result = conn.execute(text(sql), args).mappings().all()
             return result
 
     def generate_purchase_operation_history(self):
         logger.info("Generate coinbase purchase operation history")
-        all_open_positions = self.get_all_fiat_deposit()
+        last_source_id = self.get_operation_watermark("PURCHASE")
+        all_open_positions = self.get_all_fiat_deposit(after_id=last_source_id)
+        euro_prices = self.get_euro_prices([open_position["operation_datetime"] for open_position in all_open_positions])
 
+        purchase_operations = []
         for open_position in all_open_positions:
-            euro_price = self.currency_extractor.get_asset_price("euro", open_position["operation_datetime"])
+            euro_price = euro_prices[open_position["operation_datetime"]]
             purchase_operation = {
                 "purchase_datetime": open_position["operation_datetime"],
                 "asset": open_position["asset"],
@@ -190,16 +160,23 @@ class CoinbaseTaxExtractor(AbstractExchangeExtractor):
                 "amount_price_euro": open_position["amount"],
                 "current_asset_price_usd": open_position["amount"]/euro_price,  # warn: price is already in euro, get dollar instead
                 "current_asset_price_euro": open_position["amount"],
+                "source_id": open_position["id"],
             }
 
-            self.save_purchase_operation(purchase_operation)
+            purchase_operations.append(purchase_operation)
+
+        self.save_purchase_operations(purchase_operations, last_source_id=max([last_source_id] + [open_position["id"] for open_position in all_open_positions]),
+                                      replace_all=not last_source_id)
 
     def generate_sale_operation_history(self, try_compact: bool = False):
         logger.info("Generate coinbase sale operation history (compact is {})".format(try_compact))
-        all_close_positions = self.get_all_fiat_withdraw()
+        last_source_id = self.get_operation_watermark("SALE")
+        all_close_positions = self.get_all_fiat_withdraw(after_id=last_source_id)
+        euro_prices = self.get_euro_prices([close_position["operation_datetime"] for close_position in all_close_positions])
 
+        sale_operations = []
         for close_position in all_close_positions:
-            euro_price = self.currency_extractor.get_asset_price("euro", close_position["operation_datetime"])
+            euro_price = euro_prices[close_position["operation_datetime"]]
             amount = abs(close_position["amount"])
             sale_operation = {
                 "sale_datetime": close_position["operation_datetime"],
@@ -209,28 +186,19 @@ class CoinbaseTaxExtractor(AbstractExchangeExtractor):
                 "amount_price_euro": amount,
                 "current_asset_price_usd": amount/euro_price,  # warn: price is already in euro, get dollar instead
                 "current_asset_price_euro": amount,
+                "source_id": close_position["id"],
             }
 
-            self.save_sale_operation(sale_operation)
+            sale_operations.append(sale_operation)
 
-    def get_portfolio_value(self, timestamp: datetime):
-        portfolio_value = 0.0
-        with self.connection.connect() as conn:
-            sql = "select sum(amount_asset) as amount, asset from coinbase_crypto_history where operation_datetime <= %s group by asset"
-            args = [timestamp]
-
-            result = conn.execute(sql, args).mappings().all()
-
-            for res in result:
-                amount = res["amount"]
-                asset = res["asset"].lower()
+        self.save_sale_operations(sale_operations, last_source_id=max([last_source_id] + [close_position["id"] for close_position in all_close_positions]),
+                                  replace_all=not last_source_id)
 
-                if amount <= 0.0:
-                    continue
-
-                price = self.currency_extractor.get_asset_price(asset, timestamp, scope="GECKO")
+    def get_holding_changes(self, after: datetime = None):
+        with self.connection.connect() as conn:
+            sql = "SELECT operation_datetime, asset, amount_asset FROM coinbase_crypto_history {}ORDER BY operation_datetime ASC, id ASC" \
+                .format("WHERE operation_datetime > :after " if after else "")
 
-                euro_price = self.currency_extractor.get_asset_price("euro", timestamp)
-                portfolio_value += price * amount * euro_price
+            result = conn.execute(text(sql), {"after": after}).mappings().all()
 
-        return portfolio_value
+        return [(res["operation_datetime"], res["asset"].lower(), res["amount_asset"], True) for res in result]
@@ -1,12 +1,34 @@
 import logging
 from datetime import datetime
+from itertools import islice
+from typing import Dict, List, Tuple
 
+from sqlalchemy import bindparam, text
 from sqlalchemy.engine import Connection
 
+from database import BatchWriter, DEFAULT_BATCH_SIZE, LEGACY_FINGERPRINT_VERSION, RAW_OPERATION_KEY_FIELDS, get_raw_operation_fingerprint, get_raw_operation_key
 from utils import CurrencyExtractor
 
 logger = logging.getLogger("main")
 
+# operation history generated from the staging rows of each exchange, by operation_watermark operation
+OPERATION_HISTORY_TABLES = {"PURCHASE": "purchase_operation_history", "SALE": "sale_operation_history"}
+OPERATION_DATETIME_FIELDS = {"PURCHASE": "purchase_datetime", "SALE": "sale_datetime"}
+
+# latest holdings_timeline balance of each asset, among the rows matching the condition; positions grow with (change_datetime, phase)
+TIMELINE_BALANCES_SQL = "SELECT timeline.asset, timeline.balance FROM holdings_timeline timeline " \
+                        "JOIN (SELECT asset, MAX(position) AS position FROM holdings_timeline WHERE exchange = :exchange{} GROUP BY asset) latest " \
+                        "  ON latest.asset = timeline.asset AND latest.position = timeline.position " \
+                        "WHERE timeline.exchange = :exchange"
+
+
+def any_coin(coin: str):
+    return True
+
+
+def not_coin(excluded_coin: str):
+    return lambda coin: coin.upper() != excluded_coin.upper()
+
 
 class TaxExtractor:
 
@@ -21,29 +43,45 @@ class TaxExtractor:
                 "COINBASE": CoinbaseTaxExtractor}
 
     @staticmethod
-    def get_extractor(exchange: str, engine: Connection, currency_extractor: CurrencyExtractor):
+    def get_extractor(exchange: str, engine: Connection, currency_extractor: CurrencyExtractor, batch_size: int = DEFAULT_BATCH_SIZE):
         extractors = TaxExtractor.get_supported_exchange()
         if exchange not in extractors:
             raise Exception("Unsupported exchange: {}".format(exchange))
 
-        return extractors[exchange](engine, currency_extractor)
+        return extractors[exchange](engine, currency_extractor, batch_size=batch_size)
 
 
 class AbstractExchangeExtractor:
 
     PLATFORM = "NONE"
+    PRICE_SCOPE = "GECKO"
+
+    # raw operations are classified into the crypto history with OPERATION_RULES:
+    # (operation, account or None for any, coin predicate) -> (BUY/SELL, sign applied to RAW_AMOUNT_FIELD)
+    RAW_OPERATION_TABLE = None
+    CRYPTO_HISTORY_TABLE = None
+    RAW_AMOUNT_FIELD = None
+    OPERATION_RULES = []
 
-    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor):
+    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor, batch_size: int = DEFAULT_BATCH_SIZE):
         self.connection = connection
         self.currency_extractor = currency_extractor
+        self.batch_size = batch_size
+        # whether this extractor already brought holdings_timeline up to date
+        self.timeline_built = False
 
     def clean_all_history(self):
         logger.info("Delete all {} history".format(self.PLATFORM))
         with self.connection.begin() as conn:
-            sql = "DELETE FROM `purchase_operation_history` WHERE EXCHANGE = %s;"
-            conn.execute(sql, [self.PLATFORM])
-            sql = "DELETE FROM `sale_operation_history` WHERE EXCHANGE = %s;"
-            conn.execute(sql, [self.PLATFORM])
+            sql = "DELETE FROM `purchase_operation_history` WHERE EXCHANGE = :exchange;"
+            conn.execute(text(sql), {"exchange": self.PLATFORM})
+            sql = "DELETE FROM `sale_operation_history` WHERE EXCHANGE = :exchange;"
+            conn.execute(text(sql), {"exchange": self.PLATFORM})
+            sql = "DELETE FROM `holdings_timeline` WHERE exchange = :exchange;"
+            conn.execute(text(sql), {"exchange": self.PLATFORM})
+            sql = "DELETE FROM `operation_watermark` WHERE exchange = :exchange;"
+            conn.execute(text(sql), {"exchange": self.PLATFORM})
+        self.timeline_built = False
 
     def load_account_statement(self, filepath):
         pass
@@ -51,35 +89,248 @@ class AbstractExchangeExtractor:
     def process_load(self):
         pass
 
+    def save_raw_operations(self, conn, sql: str, raw_operations):
+        """
+        Insert the raw operations of a statement which are not loaded yet, recognized by their fingerprint
+        looked up by batch in the unique fingerprint index
+        """
+        # rows fingerprinted from mysql single precision amounts are recognized by their 6 significant digits key
+        sql_legacy = "SELECT id FROM `{}` WHERE fingerprint_version = :version LIMIT 1".format(self.RAW_OPERATION_TABLE)
+        legacy = conn.execute(text(sql_legacy), {"version": LEGACY_FINGERPRINT_VERSION}).fetchone() is not None
+
+        sql_known = text("SELECT fingerprint FROM `{}` WHERE fingerprint IN :fingerprints".format(self.RAW_OPERATION_TABLE))
+        sql_known = sql_known.bindparams(bindparam("fingerprints", expanding=True))
+
+        fields = RAW_OPERATION_KEY_FIELDS[self.RAW_OPERATION_TABLE]
+        occurrences = {}
+        legacy_occurrences = {}
+        skipped = 0
+
+        raw_operations = iter(raw_operations)
+        with self.batch_writer(conn, sql) as writer:
+            for batch in iter(lambda: list(islice(raw_operations, self.batch_size)), []):
+                candidates = []
+                for raw_operation in batch:
+                    key = get_raw_operation_key(raw_operation, fields)
+                    occurrences[key] = occurrences.get(key, -1) + 1
+                    raw_operation["fingerprint"] = get_raw_operation_fingerprint(key, occurrences[key])
+                    fingerprints = [raw_operation["fingerprint"]]
+
+                    if legacy:
+                        legacy_key = get_raw_operation_key(raw_operation, fields, LEGACY_FINGERPRINT_VERSION)
+                        legacy_occurrences[legacy_key] = legacy_occurrences.get(legacy_key, -1) + 1
+                        fingerprints.append(get_raw_operation_fingerprint(legacy_key, legacy_occurrences[legacy_key]))
+
+                    candidates.append(fingerprints)
+
+                result = conn.execute(sql_known, {"fingerprints": [fingerprint for fingerprints in candidates for fingerprint in fingerprints]})
+                known_fingerprints = {res[0] for res in result}
+
+                for raw_operation, fingerprints in zip(batch, candidates):
+                    if any(fingerprint in known_fingerprints for fingerprint in fingerprints):
+                        skipped += 1
+                        continue
+
+                    writer.add(raw_operation)
+
+        logger.info("Load {} new {} raw operations, {} already loaded are skipped".format(writer.count, self.PLATFORM, skipped))
+
+    def get_extraction_range(self, conn, operation: str):
+        """
+        (after_id, last_id) of the raw operations not extracted yet into the CRYPTO or FIAT history. Read in the transaction
+        extracting them, which moves the operation watermark to last_id, so a failed extraction is run again by the next load
+        """
+        sql = "SELECT last_source_id FROM operation_watermark WHERE exchange = :exchange AND operation = :operation"
+        after_id = conn.execute(text(sql), {"exchange": self.PLATFORM, "operation": operation}).scalar() or 0
+        last_id = conn.execute(text("SELECT id FROM `{}` ORDER BY id DESC LIMIT 1".format(self.RAW_OPERATION_TABLE))).scalar()
+
+        return after_id, max(after_id, last_id or 0)
+
+    def batch_writer(self, conn, sql: str):
+        return BatchWriter(conn, sql, batch_size=self.batch_size)
+
+    def get_operation_rules(self):
+        rules = {}
+        for operation, account, coin_filter, kind, sign in self.OPERATION_RULES:
+            rules.setdefault(operation.upper(), []).append((account, coin_filter, kind, sign))
+
+        return rules
+
+    def classify_operation(self, raw_operation, rules):
+        """
+        Crypto history rows (operation_datetime, asset, amount_asset, operation) of one raw operation
+        """
+        for account, coin_filter, kind, sign in rules.get(raw_operation["operation"].upper(), []):
+            if account is not None and raw_operation["account"].upper() != account.upper():
+                continue
+            if not coin_filter(raw_operation["coin"]):
+                continue
+
+            return [(raw_operation["operation_datetime"],
+                     raw_operation["coin"],
+                     sign * float(raw_operation[self.RAW_AMOUNT_FIELD]),
+                     kind)]
+
+        return []
+
+    def extract_crypto_history(self):
+        """
+        Classify the raw operations not extracted yet in one streaming pass over the raw operation table
+        """
+        logger.info("Extract {} crypto history".format(self.PLATFORM))
+        rules = self.get_operation_rules()
+
+        sqli = "INSERT INTO {}(operation_datetime, asset, amount_asset, operation)" \
+               "     VALUES (:operation_datetime, :asset, :amount_asset, :operation)".format(self.CRYPTO_HISTORY_TABLE)
+
+        first_datetime = None
+        with self.connection.connect() as read_conn, self.connection.begin() as conn, self.batch_writer(conn, sqli) as writer:
+            after_id, last_id = self.get_extraction_range(conn, "CRYPTO")
+            sql = "SELECT * FROM `{}` WHERE id > :after_id AND id <= :last_id ORDER BY id ASC".format(self.RAW_OPERATION_TABLE)
+            result = read_conn.execution_options(stream_results=True).execute(text(sql), {"after_id": after_id, "last_id": last_id}).mappings()
+
+            for raw_operation in result:
+                for operation_datetime, asset, amount_asset, operation in self.classify_operation(raw_operation, rules):
+                    first_datetime = operation_datetime if first_datetime is None else min(first_datetime, operation_datetime)
+                    writer.add({"operation_datetime": operation_datetime,
+                                "asset": asset,
+                                "amount_asset": amount_asset,
+                                "operation": operation})
+
+            self.truncate_holdings_timeline(conn, first_datetime)
+            if last_id > after_id:
+                self.save_operation_watermark(conn, "CRYPTO", last_id)
+
     def save_purchase_operation(self, purchase_operation):
+        self.save_purchase_operations([purchase_operation])
+
+    def save_purchase_operations(self, purchase_operations, last_source_id: int = None, replaced_source_ids: List[int] = (), replace_all: bool = False):
+        """
+        Insert purchase operations, replacing the ones generated from replaced_source_ids (or every purchase of the exchange
+        with replace_all), and move the PURCHASE watermark to last_source_id in the same transaction
+        """
         with self.connection.begin() as conn:
+            if replace_all:
+                self.delete_all_operations(conn, "PURCHASE")
+            first_datetime = self.delete_operations(conn, "PURCHASE", replaced_source_ids)
+
             sql = "INSERT INTO purchase_operation_history (purchase_datetime, asset, amount_asset, amount_price_usd," \
                   "                                        amount_price_euro, current_asset_price_usd," \
-                  "                                        current_asset_price_euro, exchange)" \
-                  "                                VALUES (%s,                %s,    %s,           %s," \
-                  "                                        %s,                %s," \
-                  "                                        %s,                       %s      )"
-            conn.execute(sql, [purchase_operation["purchase_datetime"],
-                               purchase_operation["asset"],
-                               purchase_operation["amount_asset"],
-                               purchase_operation["amount_price_usd"],
-                               purchase_operation["amount_price_euro"],
-                               purchase_operation["current_asset_price_usd"],
-                               purchase_operation["current_asset_price_euro"],
-                               self.PLATFORM])
+                  "                                        current_asset_price_euro, exchange, source_id)" \
+                  "                                VALUES (:purchase_datetime, :asset, :amount_asset, :amount_price_usd," \
+                  "                                        :amount_price_euro, :current_asset_price_usd," \
+                  "                                        :current_asset_price_euro, :exchange, :source_id)"
+            with self.batch_writer(conn, sql) as writer:
+                for purchase_operation in purchase_operations:
+                    writer.add({"purchase_datetime": purchase_operation["purchase_datetime"],
+                                "asset": purchase_operation["asset"],
+                                "amount_asset": purchase_operation["amount_asset"],
+                                "amount_price_usd": purchase_operation["amount_price_usd"],
+                                "amount_price_euro": purchase_operation["amount_price_euro"],
+                                "current_asset_price_usd": purchase_operation["current_asset_price_usd"],
+                                "current_asset_price_euro": purchase_operation["current_asset_price_euro"],
+                                "exchange": self.PLATFORM,
+                                "source_id": purchase_operation.get("source_id")})
+
+            timestamps = [operation["purchase_datetime"] for operation in purchase_operations] + ([first_datetime] if first_datetime else [])
+            self.truncate_holdings_timeline(conn, min(timestamps, default=None))
+            if last_source_id is not None:
+                self.save_operation_watermark(conn, "PURCHASE", last_source_id)
 
     def save_sale_operation(self, sale_operation):
+        self.save_sale_operations([sale_operation])
+
+    def save_sale_operations(self, sale_operations, last_source_id: int = None, compacted: bool = False, replaced_source_ids: List[int] = (),
+                             replace_all: bool = False):
+        """
+        Insert sale operations, replacing the ones generated from replaced_source_ids (or every sale of the exchange
+        with replace_all), and move the SALE watermark to last_source_id in the same transaction
+        """
         with self.connection.begin() as conn:
-            sql = "INSERT INTO sale_operation_history (sale_datetime, asset, amount_asset, amount_price_usd, amount_price_euro, current_asset_price_usd, current_asset_price_euro, exchange)" \
-                  "                            VALUES (%s,            %s,    %s,           %s,               %s,                %s,                      %s,                       %s      )"
-            conn.execute(sql, [sale_operation["sale_datetime"],
-                               sale_operation["asset"],
-                               sale_operation["amount_asset"],
-                               sale_operation["amount_price_usd"],
-                               sale_operation["amount_price_euro"],
-                               sale_operation["current_asset_price_usd"],
-                               sale_operation["current_asset_price_euro"],
-                               self.PLATFORM])
+            if replace_all:
+                self.delete_all_operations(conn, "SALE")
+            first_datetime = self.delete_operations(conn, "SALE", replaced_source_ids)
+
+            sql = "INSERT INTO sale_operation_history (sale_datetime, asset, amount_asset, amount_price_usd, amount_price_euro, current_asset_price_usd, current_asset_price_euro, exchange, source_id)" \
+                  "                            VALUES (:sale_datetime, :asset, :amount_asset, :amount_price_usd, :amount_price_euro, :current_asset_price_usd, :current_asset_price_euro, :exchange, :source_id)"
+            with self.batch_writer(conn, sql) as writer:
+                for sale_operation in sale_operations:
+                    writer.add({"sale_datetime": sale_operation["sale_datetime"],
+                                "asset": sale_operation["asset"],
+                                "amount_asset": sale_operation["amount_asset"],
+                                "amount_price_usd": sale_operation["amount_price_usd"],
+                                "amount_price_euro": sale_operation["amount_price_euro"],
+                                "current_asset_price_usd": sale_operation["current_asset_price_usd"],
+                                "current_asset_price_euro": sale_operation["current_asset_price_euro"],
+                                "exchange": self.PLATFORM,
+                                "source_id": sale_operation.get("source_id")})
+
+            timestamps = [operation["sale_datetime"] for operation in sale_operations] + ([first_datetime] if first_datetime else [])
+            self.truncate_holdings_timeline(conn, min(timestamps, default=None))
+            if last_source_id is not None:
+                self.save_operation_watermark(conn, "SALE", last_source_id, compacted=compacted)
+
+    def delete_operations(self, conn, operation: str, source_ids: List[int]):
+        """
+        Delete the operations generated from source_ids, return the datetime of the earliest one (None if none)
+        """
+        first_datetimes = []
+        field = OPERATION_DATETIME_FIELDS[operation]
+        sql = text("SELECT {0} FROM `{1}` WHERE exchange = :exchange AND source_id IN :source_ids ORDER BY {0} ASC LIMIT 1"
+                   .format(field, OPERATION_HISTORY_TABLES[operation])).bindparams(bindparam("source_ids", expanding=True))
+        for i in range(0, len(source_ids), self.batch_size):
+            result = conn.execute(sql, {"exchange": self.PLATFORM, "source_ids": list(source_ids[i:i + self.batch_size])}).mappings().fetchone()
+            if result:
+                first_datetimes.append(result[field])
+
+        sql = "DELETE FROM `{}` WHERE exchange = :exchange AND source_id = :source_id".format(OPERATION_HISTORY_TABLES[operation])
+        with self.batch_writer(conn, sql) as writer:
+            for source_id in source_ids:
+                writer.add({"exchange": self.PLATFORM, "source_id": source_id})
+
+        return min(first_datetimes, default=None)
+
+    def delete_all_operations(self, conn, operation: str):
+        """
+        Delete the PURCHASE or SALE operation history of the exchange, and its holdings timeline
+        """
+        sql = "DELETE FROM `{}` WHERE exchange = :exchange".format(OPERATION_HISTORY_TABLES[operation])
+        conn.execute(text(sql), {"exchange": self.PLATFORM})
+        sql = "DELETE FROM holdings_timeline WHERE exchange = :exchange"
+        conn.execute(text(sql), {"exchange": self.PLATFORM})
+
+    def read_operation_watermark(self, operation: str):
+        """
+        (last_source_id, compacted) of the operation watermark, None without watermark
+        """
+        with self.connection.connect() as conn:
+            sql = "SELECT last_source_id, compacted FROM operation_watermark WHERE exchange = :exchange AND operation = :operation"
+            result = conn.execute(text(sql), {"exchange": self.PLATFORM, "operation": operation}).mappings().fetchone()
+
+        return (result["last_source_id"], bool(result["compacted"])) if result is not None else None
+
+    def get_operation_watermark(self, operation: str, compacted: bool = False):
+        """
+        Id of the last staging row already generated into the PURCHASE or SALE operation history, only later rows are generated.
+
+        Without watermark (history generated before watermarks existed) or when the compaction mode changed, 0 is returned:
+        the operation history of the exchange is generated again from scratch, and saved with replace_all
+        """
+        watermark = self.read_operation_watermark(operation)
+        if watermark is not None and watermark[1] == compacted:
+            logger.info("Generate {} {} operations after staging row {}".format(self.PLATFORM, operation.lower(), watermark[0]))
+            return watermark[0]
+
+        logger.info("Generate all {} {} operations".format(self.PLATFORM, operation.lower()))
+        return 0
+
+    def save_operation_watermark(self, conn, operation: str, last_source_id: int, compacted: bool = False):
+        sql = "DELETE FROM operation_watermark WHERE exchange = :exchange AND operation = :operation"
+        conn.execute(text(sql), {"exchange": self.PLATFORM, "operation": operation})
+
+        sql = "INSERT INTO operation_watermark (exchange,  operation,  last_source_id,  compacted)" \
+              "                         VALUES (:exchange, :operation, :last_source_id, :compacted)"
+        conn.execute(text(sql), {"exchange": self.PLATFORM, "operation": operation, "last_source_id": last_source_id, "compacted": compacted})
 
     def generate_purchase_operation_history(self):
         pass
@@ -87,5 +338,106 @@ class AbstractExchangeExtractor:
     def generate_sale_operation_history(self, try_compact: bool = False):
         pass
 
-    def get_portfolio_value(self, timestamp: datetime):
+    def get_euro_prices(self, timestamps: List[datetime]):
+        return self.currency_extractor.get_euro_prices(timestamps)
+
+    def get_holdings_value(self, holdings: List[Tuple[str, float]], timestamp: datetime):
+        """
+        Value (asset, amount) holdings at timestamp in euro, all prices are resolved in one bulk request
+        """
+        portfolio_value = 0.0
+        if not holdings:
+            return portfolio_value
+
+        prices = self.currency_extractor.get_asset_prices([(asset, timestamp, self.PRICE_SCOPE) for asset, _ in holdings])
+        usd_values = [prices[(asset, timestamp, self.PRICE_SCOPE)] * amount for asset, amount in holdings]
+
+        for value in self.currency_extractor.to_euro(usd_values, [timestamp] * len(usd_values)):
+            portfolio_value += value
+
+        return portfolio_value
+
+    def get_holding_changes(self, after: datetime = None):
+        """
+        Every dated holding change of the exchange later than after (all of them if None), ordered by timestamp.
+
+        Return a list of (timestamp, asset, amount, inclusive): an inclusive change is owned at its own
+        timestamp, an exclusive one only after it.
+        """
         raise Exception("not implemented")
+
+    def get_owned_holdings(self, balances: Dict[str, float]):
+        """
+        (asset, amount) holdings to value from running balances
+        """
+        return [(asset, amount) for asset, amount in sorted(balances.items()) if amount > 0.0]
+
+    def truncate_holdings_timeline(self, conn, since: datetime):
+        """
+        Drop the holdings timeline from since on, in the transaction changing the history at since,
+        so the timeline left always matches the history and build_holdings_timeline only has to append to it
+        """
+        if since is None:
+            return
+
+        sql = "DELETE FROM holdings_timeline WHERE exchange = :exchange AND change_datetime >= :since"
+        conn.execute(text(sql), {"exchange": self.PLATFORM, "since": since})
+
+    def build_holdings_timeline(self):
+        """
+        Append to holdings_timeline the balance of each asset after each holding change later than the last one of the timeline
+        """
+        with self.connection.connect() as conn:
+            sql = "SELECT change_datetime, position FROM holdings_timeline WHERE exchange = :exchange ORDER BY position DESC LIMIT 1"
+            last = conn.execute(text(sql), {"exchange": self.PLATFORM}).mappings().fetchone()
+            balances = {res["asset"]: res["balance"] for res in conn.execute(text(TIMELINE_BALANCES_SQL.format("")), {"exchange": self.PLATFORM}).mappings()}
+
+        last_datetime = last["change_datetime"] if last else None
+        logger.info("Build {} holdings timeline after {}".format(self.PLATFORM, last_datetime))
+        # at a same timestamp, inclusive changes (phase 0) apply at it and exclusive ones (phase 1) right after
+        changes = sorted(enumerate(self.get_holding_changes(last_datetime)), key=lambda change: (change[1][0], 0 if change[1][3] else 1, change[0]))
+        first_position = last["position"] + 1 if last else 0
+
+        with self.connection.begin() as conn:
+            sql = "INSERT INTO holdings_timeline (exchange,  asset,  position,  change_datetime,  phase,  balance)" \
+                  "                       VALUES (:exchange, :asset, :position, :change_datetime, :phase, :balance)"
+            with self.batch_writer(conn, sql) as writer:
+                for position, (_, (timestamp, asset, amount, inclusive)) in enumerate(changes, first_position):
+                    balances[asset] = balances.get(asset, 0.0) + amount
+                    writer.add({"exchange": self.PLATFORM,
+                                "asset": asset,
+                                "position": position,
+                                "change_datetime": timestamp,
+                                "phase": 0 if inclusive else 1,
+                                "balance": balances[asset]})
+
+        self.timeline_built = True
+
+    def get_timeline_changes(self, until: datetime):
+        """
+        (change_datetime, phase, asset, balance) rows of the holdings timeline up to until, in the order they apply.
+        The timeline is brought up to date first, a database loaded before it existed gets it built on first use
+        """
+        if not self.timeline_built:
+            self.build_holdings_timeline()
+
+        with self.connection.connect() as conn:
+            sql = "SELECT change_datetime, phase, asset, balance FROM holdings_timeline " \
+                  "WHERE exchange = :exchange AND change_datetime <= :until " \
+                  "ORDER BY change_datetime ASC, phase ASC, position ASC"
+            result = conn.execute(text(sql), {"exchange": self.PLATFORM, "until": until}).fetchall()
+
+        return [tuple(res) for res in result]
+
+    def get_holdings_as_of(self, timestamp: datetime):
+        """
+        Balance of each asset at timestamp, with a single holdings_timeline query
+        """
+        if not self.timeline_built:
+            self.build_holdings_timeline()
+
+        with self.connection.connect() as conn:
+            sql = TIMELINE_BALANCES_SQL.format(" AND (change_datetime < :timestamp OR (change_datetime = :timestamp AND phase = 0))")
+            result = conn.execute(text(sql), {"exchange": self.PLATFORM, "timestamp": timestamp}).mappings().all()
+
+        return {res["asset"]: res["balance"] for res in result}
@@ -1,9 +1,13 @@
 import logging
-from datetime import datetime
+import math
+from datetime import datetime, timedelta
+from typing import Dict
 
 from openpyxl import load_workbook
+from sqlalchemy import text
 from sqlalchemy.engine import Connection
 
+from database import DEFAULT_BATCH_SIZE
 from exchange.common import AbstractExchangeExtractor
 from utils import CurrencyExtractor
 
@@ -34,24 +38,37 @@ FIELD_NAME_ACTION = 1
 logger = logging.getLogger("main")
 
 
+def get_compaction_key(close_position):
+    """
+    Close positions of a same asset within a same minute are compacted into one sale
+    """
+    return close_position["close_datetime"].strftime("%d-%m-%Y-%H-%M")+"-"+close_position["asset"]
+
+
 class EtoroTaxExtractor(AbstractExchangeExtractor):
 
     PLATFORM = "ETORO"
 
-    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor):
-        super(EtoroTaxExtractor, self).__init__(connection, currency_extractor)
-        self.all_position_operations = None
-        self.closed_positions = None
+    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor, batch_size: int = DEFAULT_BATCH_SIZE):
+        super(EtoroTaxExtractor, self).__init__(connection, currency_extractor, batch_size=batch_size)
+        self.statement_filepath = None
 
     def load_account_statement(self, filepath):
         logger.info("Load etoro account statement")
-        wb = load_workbook(filename = filepath)
+        self.statement_filepath = filepath
 
-        transactions_report = wb["Transactions Report"]
-        closed_positions = wb["Closed Positions"]
+    def iter_statement_rows(self, sheet_name: str):
+        """
+        Stream the cell values of one sheet of the statement, the workbook is opened read-only
+        so only the current row is kept in memory
+        """
+        wb = load_workbook(filename=self.statement_filepath, read_only=True, data_only=True)
 
-        self.all_position_operations = transactions_report
-        self.closed_positions = closed_positions
+        try:
+            for row in wb[sheet_name].iter_rows(values_only=True):
+                yield row
+        finally:
+            wb.close()
 
     def process_load(self):
         self.extract_purchase_history()
@@ -63,167 +80,294 @@ class EtoroTaxExtractor(AbstractExchangeExtractor):
 
         with self.connection.begin() as conn:
             sql = "DELETE FROM `etoro_open_positions`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
             sql = "DELETE FROM `etoro_close_positions`;"
-            conn.execute(sql, [])
+            conn.execute(text(sql))
 
     def extract_purchase_history(self):
         logger.info("Extract etoro purchase history")
-        with self.connection.begin() as conn:
+        sql = "INSERT INTO etoro_open_positions (position_id,  open_datetime,  asset,  amount_price)" \
+              "                          VALUES (:position_id, :open_datetime, :asset, :amount_price)"
+
+        # positions of a previous statement are kept as loaded
+        open_position_ids = self.get_open_position_ids()
+        skipped = 0
 
-            for row in self.all_position_operations.rows:
+        with self.connection.begin() as conn, self.batch_writer(conn, sql) as writer:
+
+            for row in self.iter_statement_rows("Transactions Report"):
                 # skip anything other than "Open Positions"
-                if not row[FIELD_NAME_TYPE].internal_value == FIELD_TYPE_OPEN_POSITION:
+                if not row[FIELD_NAME_TYPE] == FIELD_TYPE_OPEN_POSITION:
+                    continue
+
+                # skip not crypto (and empty rows)
+                if not row[FIELD_NAME_DETAILS] or row[FIELD_NAME_DETAILS].upper() not in CRYPTO_PAIR.values():
                     continue
 
-                # skip not crypto
-                if row[FIELD_NAME_DETAILS].internal_value.upper() not in CRYPTO_PAIR.values():
+                if str(row[4]) in open_position_ids:
+                    skipped += 1
                     continue
 
                 position = {
-                    "position_id": row[4].internal_value,
-                    "open_datetime": datetime.fromisoformat(row[0].internal_value),
-                    "asset": row[3].internal_value,
+                    "position_id": row[4],
+                    "open_datetime": datetime.fromisoformat(row[0]),
+                    "asset": row[3],
                     "amount_asset": None,
-                    "amount_price": float(row[5].internal_value),
+                    "amount_price": float(row[5]),
                     "current_asset_price": None
                 }
 
-                sql = "INSERT INTO etoro_open_positions (position_id, open_datetime, asset, amount_price)" \
-                      "                          VALUES (%s,          %s,            %s,    %s          )"
-                conn.execute(sql, [position["position_id"],
-                                   position["open_datetime"],
-                                   position["asset"],
-                                   position["amount_price"]])
+                writer.add({"position_id": position["position_id"],
+                            "open_datetime": position["open_datetime"],
+                            "asset": position["asset"],
+                            "amount_price": position["amount_price"]})
+                open_position_ids.add(str(position["position_id"]))
+
+        logger.info("Load {} new etoro open positions, {} already loaded are skipped".format(writer.count, skipped))
 
     def extract_sale_history(self):
         logger.info("Extract etoro sale history")
         supported_action = ["BUY "+asset for asset in CRYPTO_PAIR]
+        sql = "INSERT INTO etoro_close_positions (position_id, close_datetime, asset, amount_asset, amount_price, current_asset_price, profit_price, open_asset_price)" \
+              "                           VALUES (:position_id, :close_datetime, :asset, :amount_asset, :amount_price, :current_asset_price, :profit_price, :open_asset_price)"
+        sql2 = "INSERT INTO etoro_open_positions (position_id,  open_datetime,  asset,  amount_price)" \
+               "                          VALUES (:position_id, :open_datetime, :asset, :amount_price)"
+
+        # known open positions are indexed once, missing ones are added as they are synthesized
+        open_position_ids = self.get_open_position_ids()
+        # close positions of a previous statement, or already met in this one, are kept as loaded
+        close_position_ids = self.get_close_position_ids()
+        skipped = 0
+
+        with self.connection.begin() as conn, self.batch_writer(conn, sql) as writer, self.batch_writer(conn, sql2) as open_writer:
+
+            for row in self.iter_statement_rows("Closed Positions"):
+                # skip not crypto (and empty rows)
+                if not row[FIELD_NAME_ACTION] or row[FIELD_NAME_ACTION].upper() not in supported_action:
+                    continue
 
-        with self.connection.begin() as conn:
-
-            for row in self.closed_positions.rows:
-                # skip not crypto
-                if row[FIELD_NAME_ACTION].internal_value.upper() not in supported_action:
+                if str(row[0]) in close_position_ids:
+                    skipped += 1
                     continue
 
                 position = {
-                    "position_id": row[0].internal_value,
-                    "close_datetime": datetime.strptime(row[10].internal_value, "%d/%m/%Y %H:%M"),
-                    "profit_price": float(row[8].internal_value.replace(",", ".")),
-                    "open_asset_price": float(row[5].internal_value.replace(",", ".")),
-                    "current_asset_price": float(row[6].internal_value.replace(",", ".")),
-                    "amount_asset": float(row[4].internal_value.replace(",", ".")),
-                    "amount_price": float(row[3].internal_value.replace(",", ".")),
+                    "position_id": row[0],
+                    "close_datetime": datetime.strptime(row[10], "%d/%m/%Y %H:%M"),
+                    "profit_price": float(row[8].replace(",", ".")),
+                    "open_asset_price": float(row[5].replace(",", ".")),
+                    "current_asset_price": float(row[6].replace(",", ".")),
+                    "amount_asset": float(row[4].replace(",", ".")),
+                    "amount_price": float(row[3].replace(",", ".")),
                 }
 
-                sql = "INSERT INTO etoro_close_positions (position_id, close_datetime, asset, amount_asset, amount_price, current_asset_price, profit_price, open_asset_price)" \
-                      "                           VALUES (%s,          %s,             %s,    %s,           %s,           %s,                  %s,           %s              )"
-                conn.execute(sql, [position["position_id"],
-                                   position["close_datetime"],
-                                   row[FIELD_NAME_ACTION].internal_value[4:].lower(),
-                                   position["amount_asset"],
-                                   position["amount_price"],
-                                   position["current_asset_price"],
-                                   position["profit_price"],
-                                   position["open_asset_price"]])
-
-                open_pos = self.get_open_position(position["position_id"])
-                if not open_pos:
+                writer.add({"position_id": position["position_id"],
+                            "close_datetime": position["close_datetime"],
+                            "asset": row[FIELD_NAME_ACTION][4:].lower(),
+                            "amount_asset": position["amount_asset"],
+                            "amount_price": position["amount_price"],
+                            "current_asset_price": position["current_asset_price"],
+                            "profit_price": position["profit_price"],
+                            "open_asset_price": position["open_asset_price"]})
+                close_position_ids.add(str(position["position_id"]))
+
+                if str(position["position_id"]) not in open_position_ids:
                     open_position = {
                         "position_id": position["position_id"],
-                        "open_datetime": datetime.strptime(row[10].internal_value, "%d/%m/%Y %H:%M"),
-                        "asset": CRYPTO_PAIR[row[FIELD_NAME_ACTION].internal_value[4:].upper()],
+                        "open_datetime": datetime.strptime(row[10], "%d/%m/%Y %H:%M"),
+                        "asset": CRYPTO_PAIR[row[FIELD_NAME_ACTION][4:].upper()],
                         "amount_asset": position["amount_asset"],
                         "amount_price": position["amount_price"],
                         "current_asset_price": position["open_asset_price"]
                     }
 
-                    sql2 = "INSERT INTO etoro_open_positions (position_id, open_datetime, asset, amount_price)" \
-                          "                          VALUES (%s,          %s,            %s,    %s          )"
-                    conn.execute(sql2, [open_position["position_id"],
-                                        open_position["open_datetime"],
-                                        open_position["asset"],
-                                        open_position["amount_price"]])
-                    print("correct missing open position: {}".format(open_position))
+                    open_writer.add({"position_id": open_position["position_id"],
+                                     "open_datetime": open_position["open_datetime"],
+                                     "asset": open_position["asset"],
+                                     "amount_price": open_position["amount_price"]})
+                    open_position_ids.add(str(open_position["position_id"]))
+                    logger.debug("correct missing open position: {}".format(open_position))
+
+        logger.info("Load {} new etoro close positions, {} already loaded are skipped".format(writer.count, skipped))
+        if open_writer.count:
+            logger.info("Corrected {} missing etoro open positions".format(open_writer.count))
+
+    def get_all_open_positions(self, after_id: int = 0):
+        with self.connection.connect() as conn:
+            sql = "SELECT * FROM etoro_open_positions WHERE id > :after_id ORDER BY id ASC"
+
+            result = conn.execute(text(sql), {"after_id": after_id}).mappings().all()
+            return result
 
-    def get_all_open_positions(self):
+    def get_all_close_positions(self, after_id: int = 0):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM etoro_open_positions"
-            args = []
+            sql = "SELECT * FROM etoro_close_positions WHERE id > :after_id ORDER BY id ASC"
+
+            result = conn.execute(text(sql), {"after_id": after_id}).mappings().all()
 
-            result = conn.execute(sql, args).mappings().all()
             return result
 
-    def get_all_close_positions(self):
+    def get_close_positions_between(self, begin_date: datetime, end_date: datetime, last_id: int):
+        """
+        Close positions of [begin_date, end_date) up to id last_id
+        """
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM etoro_close_positions"
-            args = []
+            sql = "SELECT * FROM etoro_close_positions " \
+                  "WHERE close_datetime >= :begin_date AND close_datetime < :end_date AND id <= :last_id " \
+                  "ORDER BY id ASC"
+            args = {"begin_date": begin_date, "end_date": end_date, "last_id": last_id}
 
-            result = conn.execute(sql, args).mappings().all()
+            result = conn.execute(text(sql), args).mappings().all()
 
             return result
 
+    def get_open_position_ids(self):
+        with self.connection.connect() as conn:
+            sql = "SELECT position_id FROM etoro_open_positions"
+
+            result = conn.execute(text(sql)).mappings().all()
+            return {str(res["position_id"]) for res in result}
+
+    def get_close_position_ids(self):
+        with self.connection.connect() as conn:
+            sql = "SELECT DISTINCT position_id FROM etoro_close_positions"
+
+            result = conn.execute(text(sql)).mappings().all()
+            return {str(res["position_id"]) for res in result}
+
+    def get_reconsolidated_open_positions(self, last_source_id: int):
+        """
+        Open positions up to id last_source_id, already generated into purchases, whose close position is not generated
+        into a sale yet: consolidation may have changed them since their purchase was generated
+        """
+        watermark = self.read_operation_watermark("SALE")
+        with self.connection.connect() as conn:
+            sql = "SELECT * FROM etoro_open_positions open_position " \
+                  "WHERE open_position.id <= :last_source_id AND EXISTS (" \
+                  "  SELECT 1 FROM etoro_close_positions close_position " \
+                  "  WHERE close_position.position_id = open_position.position_id AND close_position.id > :close_after_id) " \
+                  "ORDER BY open_position.id ASC"
+            args = {"last_source_id": last_source_id, "close_after_id": watermark[0] if watermark is not None else 0}
+
+            result = conn.execute(text(sql), args).mappings().all()
+            return result
+
     def get_open_position(self, position_id: str):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM etoro_open_positions WHERE position_id = %s"
-            args = [position_id]
+            sql = "SELECT * FROM etoro_open_positions WHERE position_id = :position_id"
+            args = {"position_id": position_id}
 
-            result = conn.execute(sql, args).mappings().fetchone()
+            result = conn.execute(text(sql), args).mappings().fetchone()
 
             return result
 
     def get_close_position(self, position_id: str):
         with self.connection.connect() as conn:
-            sql = "SELECT * FROM etoro_close_positions WHERE position_id = %s"
-            args = [position_id]
+            sql = "SELECT * FROM etoro_close_positions WHERE position_id = :position_id"
+            args = {"position_id": position_id}
 
-            result = conn.execute(sql, args).mappings().fetchone()
+            result = conn.execute(text(sql), args).mappings().fetchone()
 
             return result
 
+    def get_open_positions_with_close(self):
+        """
+        Every open position joined with its close position (if any) in one query
+        """
+        with self.connection.connect() as conn:
+            sql = "SELECT open_position.*," \
+                  "       close_position.id AS close_position_id," \
+                  "       close_position.amount_asset AS close_amount_asset," \
+                  "       close_position.open_asset_price AS close_open_asset_price " \
+                  "FROM etoro_open_positions open_position " \
+                  "LEFT JOIN etoro_close_positions close_position ON close_position.position_id = open_position.position_id " \
+                  "ORDER BY open_position.id ASC, close_position.id ASC"
+
+            result = conn.execute(text(sql)).mappings().all()
+            return result
+
     def save_open_position(self, open_position):
+        self.save_open_positions([open_position])
+
+    def save_open_positions(self, open_positions):
         with self.connection.begin() as conn:
             sql = "UPDATE etoro_open_positions " \
                   "SET " \
-                  " asset = %s, " \
-                  " amount_asset = %s, " \
-                  " amount_price = %s, " \
-                  " current_asset_price = %s " \
+                  " asset = :asset, " \
+                  " amount_asset = :amount_asset, " \
+                  " amount_price = :amount_price, " \
+                  " current_asset_price = :current_asset_price " \
                   "WHERE " \
-                  " position_id = %s"
-            conn.execute(sql, [open_position["asset"],
-                               open_position["amount_asset"],
-                               open_position["amount_price"],
-                               open_position["current_asset_price"],
-                               open_position["position_id"]])
+                  " position_id = :position_id"
+            with self.batch_writer(conn, sql) as writer:
+                for open_position in open_positions:
+                    writer.add({"asset": open_position["asset"],
+                                "amount_asset": open_position["amount_asset"],
+                                "amount_price": open_position["amount_price"],
+                                "current_asset_price": open_position["current_asset_price"],
+                                "position_id": open_position["position_id"]})
 
     def consolidate_history(self):
         logger.info("Consolidate etoro history")
-        all_open_positions = self.get_all_open_positions()
-
-        for open_position in all_open_positions:
-            close_position = self.get_close_position(open_position["position_id"])
-
-            position = dict(open_position)
-            position["asset"] = PAIR_CRYPTO[position["asset"].upper()].lower()
-            if close_position:
-                position["amount_asset"] = close_position["amount_asset"]
-                position["current_asset_price"] = close_position["open_asset_price"]
-            else:
+        positions = {}
+        unknown_positions = []
+
+        for open_position in self.get_open_positions_with_close():
+            # keep the first close position only
+            if open_position["position_id"] in positions:
+                continue
+
+            # positions consolidated by a previous load already have the crypto name
+            asset = open_position["asset"].upper()
+            position = {
+                "position_id": open_position["position_id"],
+                "open_datetime": open_position["open_datetime"],
+                "asset": PAIR_CRYPTO.get(asset, asset).lower(),
+                "amount_price": open_position["amount_price"],
+                "amount_asset": open_position["amount_asset"],
+                "current_asset_price": open_position["current_asset_price"],
+            }
+            if open_position["close_position_id"] is not None:
+                position["amount_asset"] = open_position["close_amount_asset"]
+                position["current_asset_price"] = open_position["close_open_asset_price"]
+            elif open_position["amount_asset"] is None:
                 logger.warning("Unknown price {}....".format(position))
-                current_asset_price = self.currency_extractor.get_asset_price(position["asset"], position["open_datetime"])
-                position["amount_asset"] = position["amount_price"]/current_asset_price
-                position["current_asset_price"] = current_asset_price
+                unknown_positions.append(position)
+
+            positions[position["position_id"]] = (open_position, position)
+
+        prices = self.currency_extractor.get_asset_prices([(position["asset"], position["open_datetime"], "GECKO") for position in unknown_positions])
+        for position in unknown_positions:
+            current_asset_price = prices[(position["asset"], position["open_datetime"], "GECKO")]
+            position["amount_asset"] = position["amount_price"]/current_asset_price
+            position["current_asset_price"] = current_asset_price
+
+        # only new positions, or ones whose close position came with a later statement, are saved
+        changed_positions = []
+        for open_position, position in positions.values():
+            if open_position["amount_asset"] is not None:
+                if math.isclose(open_position["amount_asset"], position["amount_asset"], rel_tol=1e-6) and \
+                   math.isclose(open_position["current_asset_price"], position["current_asset_price"], rel_tol=1e-6):
+                    continue
+
+            changed_positions.append(position)
 
-            self.save_open_position(position)
+        self.save_open_positions(changed_positions)
 
     def generate_purchase_operation_history(self):
         logger.info("Generate etoro purchase operation history")
-        all_open_positions = self.get_all_open_positions()
+        last_source_id = self.get_operation_watermark("PURCHASE")
+        all_open_positions = self.get_all_open_positions(after_id=last_source_id)
 
+        # purchases generated before a position was consolidated again with its close position are replaced
+        reconsolidated_positions = list(self.get_reconsolidated_open_positions(last_source_id))
+        replaced_source_ids = [open_position["id"] for open_position in reconsolidated_positions]
+        all_open_positions = reconsolidated_positions + list(all_open_positions)
+
+        euro_prices = self.get_euro_prices([open_position["open_datetime"] for open_position in all_open_positions])
+
+        purchase_operations = []
         for open_position in all_open_positions:
-            euro_price = self.currency_extractor.get_asset_price("euro", open_position["open_datetime"])
+            euro_price = euro_prices[open_position["open_datetime"]]
             purchase_operation = {
                 "purchase_datetime": open_position["open_datetime"],
                 "asset": open_position["asset"],
@@ -232,18 +376,35 @@ class EtoroTaxExtractor(AbstractExchangeExtractor):
                 "amount_price_euro": open_position["amount_price"]*euro_price,
                 "current_asset_price_usd": open_position["current_asset_price"],
                 "current_asset_price_euro": open_position["current_asset_price"]*euro_price,
+                "source_id": open_position["id"],
             }
 
-            self.save_purchase_operation(purchase_operation)
+            purchase_operations.append(purchase_operation)
+
+        self.save_purchase_operations(purchase_operations, last_source_id=max([last_source_id] + [open_position["id"] for open_position in all_open_positions]),
+                                      replaced_source_ids=replaced_source_ids, replace_all=not last_source_id)
 
     def generate_sale_operation_history(self, try_compact: bool = False):
         logger.info("Generate etoro sale operation history (compact is {})".format(try_compact))
-        all_close_positions = self.get_all_close_positions()
+        last_source_id = self.get_operation_watermark("SALE", compacted=try_compact)
+        all_close_positions = list(self.get_all_close_positions(after_id=last_source_id))
+        new_last_source_id = max([last_source_id] + [close_position["id"] for close_position in all_close_positions])
+        replaced_source_ids = []
+
+        if try_compact and last_source_id and all_close_positions:
+            # a sale compacted from close positions before the watermark is compacted again with the new close positions of its minute
+            keys = {get_compaction_key(close_position) for close_position in all_close_positions}
+            close_datetimes = [close_position["close_datetime"].replace(second=0, microsecond=0) for close_position in all_close_positions]
+            earlier_close_positions = [close_position for close_position in self.get_close_positions_between(min(close_datetimes), max(close_datetimes) + timedelta(minutes=1), last_source_id)
+                                       if get_compaction_key(close_position) in keys]
+
+            replaced_source_ids = [close_position["id"] for close_position in earlier_close_positions]
+            all_close_positions = earlier_close_positions + all_close_positions
 
         if try_compact:
             compacted_sale_op = {}
             for close_op in all_close_positions:
-                key = close_op["close_datetime"].strftime("%d-%m-%Y-%H-%M")+"-"+close_op["asset"]
+                key = get_compaction_key(close_op)
 
                 if key in compacted_sale_op.keys():
                     compacted_sale_op[key]["amount_asset"] += close_op["amount_asset"]
@@ -255,16 +416,22 @@ class EtoroTaxExtractor(AbstractExchangeExtractor):
                         "amount_asset": close_op["amount_asset"],
                         "amount_price_usd": close_op["amount_price"] + close_op["profit_price"],
                         "current_asset_price_usd": close_op["current_asset_price"],
+                        "source_id": close_op["id"],
                     }
 
+            euro_prices = self.get_euro_prices([op["sale_datetime"] for op in compacted_sale_op.values()])
             for op in compacted_sale_op.values():
-                euro_price = self.currency_extractor.get_asset_price("euro", op["sale_datetime"])
+                euro_price = euro_prices[op["sale_datetime"]]
                 op["amount_price_euro"] = op["amount_price_usd"]*euro_price
                 op["current_asset_price_euro"] = op["current_asset_price_usd"]*euro_price
-                self.save_sale_operation(op)
+
+            self.save_sale_operations(list(compacted_sale_op.values()), last_source_id=new_last_source_id, compacted=True,
+                                      replaced_source_ids=replaced_source_ids, replace_all=not last_source_id)
         else:
+            euro_prices = self.get_euro_prices([close_position["close_datetime"] for close_position in all_close_positions])
+            sale_operations = []
             for close_position in all_close_positions:
-                euro_price = self.currency_extractor.get_asset_price("euro", close_position["close_datetime"])
+                euro_price = euro_prices[close_position["close_datetime"]]
 
                 sale_operation = {
                     "sale_datetime": close_position["close_datetime"],
@@ -274,62 +441,32 @@ class EtoroTaxExtractor(AbstractExchangeExtractor):
                     "amount_price_euro": (close_position["amount_price"] + close_position["profit_price"])*euro_price,
                     "current_asset_price_usd": close_position["current_asset_price"],
                     "current_asset_price_euro": close_position["current_asset_price"]*euro_price,
+                    "source_id": close_position["id"],
                 }
 
-                self.save_sale_operation(sale_operation)
+                sale_operations.append(sale_operation)
 
-    def get_purchased_assets(self, timestamp: datetime, inclusive: bool = False):
-        with self.connection.connect() as conn:
-            op = "<=" if inclusive else "<"
-            sql = "SELECT * FROM purchase_operation_history WHERE  purchase_datetime {} %s AND exchange = %s".format(op)
-            args = [timestamp, self.PLATFORM]
-
-            result = conn.execute(sql, args).mappings().all()
-
-            return result
+            self.save_sale_operations(sale_operations, last_source_id=new_last_source_id, replace_all=not last_source_id)
 
-    def get_sold_assets(self, timestamp: datetime, inclusive: bool = False):
+    def get_holding_changes(self, after: datetime = None):
         with self.connection.connect() as conn:
-            op = "<=" if inclusive else "<"
-            sql = "SELECT * FROM sale_operation_history WHERE  sale_datetime {} %s AND exchange = %s".format(op)
-            args = [timestamp, self.PLATFORM]
+            sql = "SELECT purchase_datetime, asset, amount_asset FROM purchase_operation_history " \
+                  "WHERE exchange = :exchange {}ORDER BY purchase_datetime ASC, id ASC".format("AND purchase_datetime > :after " if after else "")
+            purchases = conn.execute(text(sql), {"exchange": self.PLATFORM, "after": after}).mappings().all()
 
-            result = conn.execute(sql, args).mappings().all()
+            sql = "SELECT sale_datetime, asset, amount_asset FROM sale_operation_history " \
+                  "WHERE exchange = :exchange {}ORDER BY sale_datetime ASC, id ASC".format("AND sale_datetime > :after " if after else "")
+            sales = conn.execute(text(sql), {"exchange": self.PLATFORM, "after": after}).mappings().all()
 
-            return result
-
-    def get_owned_assets(self, timestamp: datetime):
-        purchased_asset = self.get_purchased_assets(timestamp, inclusive=True)
-        sold_asset = self.get_sold_assets(timestamp, inclusive=False)
-
-        owned_asset = {}
-
-        for asset in purchased_asset:
-            asset_name = asset["asset"]
-            if asset_name in owned_asset.keys():
-                owned_asset[asset_name] += asset["amount_asset"]
-            else:
-                owned_asset[asset_name] = asset["amount_asset"]
-
-        for asset in sold_asset:
-            asset_name = asset["asset"]
-            if asset_name in owned_asset.keys():
-                owned_asset[asset_name] -= asset["amount_asset"]
-                if owned_asset[asset_name] < 0:
-                    raise Exception("Asset sold with negative balance")
-            else:
-                raise Exception("Asset sold with negative balance")
+        # purchases are owned at their timestamp, sales only decrease balance after it
+        changes = [(res["purchase_datetime"], res["asset"], res["amount_asset"], True) for res in purchases]
+        changes += [(res["sale_datetime"], res["asset"], -res["amount_asset"], False) for res in sales]
 
-        return owned_asset
+        return sorted(changes, key=lambda change: change[0])
 
-    def get_portfolio_value(self, timestamp: datetime):
-        assets = self.get_owned_assets(timestamp)
-
-        portfolio_value = 0
-
-        for asset, amount in assets.items():
-            price = self.currency_extractor.get_asset_price(asset, timestamp)
-            euro_price = self.currency_extractor.get_asset_price("euro", timestamp)
-            portfolio_value += price * amount * euro_price
+    def get_owned_holdings(self, balances: Dict[str, float]):
+        for amount in balances.values():
+            if amount < 0:
+                raise Exception("Asset sold with negative balance")
 
-        return portfolio_value
\ No newline at end of file
+        return list(balances.items())
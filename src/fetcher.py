@@ -0,0 +1,249 @@
+import copy
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import requests
+from binance.client import Client
+from pycoingecko import CoinGeckoAPI
+
+logger = logging.getLogger("main")
+
+DEFAULT_FETCH_WORKERS = 8
+
+# requests per second, burst, base url of each price provider
+DEFAULT_PROVIDER_CONFIG = {
+    "GECKO": {"rate": 0.8, "burst": 5, "url": "https://api.coingecko.com/api/v3/"},
+    "BINANCE": {"rate": 10.0, "burst": 20, "url": None},
+}
+
+RATE_LIMIT_STATUS = [418, 429]
+DEFAULT_MAX_RETRIES = 10
+DEFAULT_MIN_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 120.0
+
+
+def get_status_code(exception: Exception):
+    """
+    HTTP status of a failed provider call, if any
+    """
+    status = getattr(exception, "status_code", None)
+    if status is None and getattr(exception, "response", None) is not None:
+        status = exception.response.status_code
+
+    # pycoingecko raises the json body of a failed response as a ValueError
+    if status is None and isinstance(exception, ValueError) and exception.args and isinstance(exception.args[0], dict):
+        body = exception.args[0]
+        if isinstance(body.get("status"), dict):
+            status = body["status"].get("error_code")
+        elif "error" in body:
+            status = 400
+
+    return status
+
+
+def get_retry_after(exception: Exception):
+    response = getattr(exception, "response", None)
+    if response is None or response.headers is None:
+        return 0.0
+
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0.0
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket: rate tokens per second, at most burst in reserve
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # seconds callers spent waiting for a token (throttle and rate limit pauses)
+        self.wait_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                else:
+                    wait = (1.0 - self.tokens) / self.rate
+
+            with self.lock:
+                self.wait_seconds += wait
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Hold every caller for seconds and halve the rate, it recovers slowly with successful calls
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = 0.0
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 16)
+
+
+class ProviderLimiter:
+    """
+    Run calls of one provider through its token bucket, with an adaptive backoff
+    on rate limit (429/418) and transient (network, 5xx) errors
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_retries: int = DEFAULT_MAX_RETRIES,
+                 min_backoff: float = DEFAULT_MIN_BACKOFF, max_backoff: float = DEFAULT_MAX_BACKOFF):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        # attempts (retries included), retries, failed calls, seconds slept before a retry
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.retry_wait_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def get_stats(self):
+        with self.lock:
+            return {"calls": self.calls,
+                    "retries": self.retries,
+                    "failures": self.failures,
+                    "retry_wait_seconds": self.retry_wait_seconds,
+                    "throttle_wait_seconds": self.bucket.wait_seconds}
+
+    def call(self, fn: Callable, *args):
+        attempt = 0
+
+        while True:
+            self.bucket.acquire()
+            with self.lock:
+                self.calls += 1
+            try:
+                result = fn(*args)
+            except Exception as e:
+                status = get_status_code(e)
+                rate_limited = status in RATE_LIMIT_STATUS
+                transient = (status is None and isinstance(e, requests.exceptions.RequestException)) or (status is not None and status >= 500)
+
+                attempt += 1
+                if not (rate_limited or transient) or attempt >= self.max_retries:
+                    with self.lock:
+                        self.failures += 1
+                    raise
+
+                with self.lock:
+                    wait = max(self.backoff, get_retry_after(e))
+                    self.backoff = min(self.max_backoff, self.backoff * 2)
+                    self.retries += 1
+                    self.retry_wait_seconds += wait
+
+                if rate_limited:
+                    logger.warning("{} rate limit reached ({}), backoff {}s".format(self.name, status, wait))
+                    self.bucket.pause(wait)
+                else:
+                    logger.warning("{} call failed ({}), retry in {}s".format(self.name, e, wait))
+                    time.sleep(wait)
+                continue
+
+            with self.lock:
+                self.backoff = self.min_backoff
+            self.bucket.recover()
+            return result
+
+
+class PriceFetcher:
+    """
+    Concurrent price provider calls: a thread pool keeps several requests in flight,
+    each provider being throttled by its own ProviderLimiter
+    """
+
+    def __init__(self, binance_client: Client, fetch_config: dict = None):
+        fetch_config = fetch_config or {}
+        self.binance_client = binance_client
+        self.workers = fetch_config.get("workers", DEFAULT_FETCH_WORKERS)
+        self.local = threading.local()
+
+        self.provider_config = {}
+        self.limiters = {}
+        for provider, default_config in DEFAULT_PROVIDER_CONFIG.items():
+            config = dict(default_config, **fetch_config.get(provider.lower(), {}))
+            self.provider_config[provider] = config
+            self.limiters[provider] = ProviderLimiter(provider, config["rate"], config["burst"],
+                                                      max_retries=fetch_config.get("max_retries", DEFAULT_MAX_RETRIES),
+                                                      min_backoff=fetch_config.get("min_backoff", DEFAULT_MIN_BACKOFF),
+                                                      max_backoff=fetch_config.get("max_backoff", DEFAULT_MAX_BACKOFF))
+
+    def get_stats(self):
+        return {provider: limiter.get_stats() for provider, limiter in self.limiters.items()}
+
+    def get_gecko_client(self):
+        if not hasattr(self.local, "gecko_client"):
+            self.local.gecko_client = CoinGeckoAPI(api_base_url=self.provider_config["GECKO"]["url"])
+
+        return self.local.gecko_client
+
+    def get_binance_client(self):
+        # binance client keeps the last response on itself, so each thread works on its own copy
+        if not hasattr(self.local, "binance_client"):
+            client = copy.copy(self.binance_client)
+            client.session = client._init_session()
+            client.response = None
+            if self.provider_config["BINANCE"]["url"]:
+                client.API_URL = self.provider_config["BINANCE"]["url"]
+            self.local.binance_client = client
+
+        return self.local.binance_client
+
+    def get_coin_history(self, gecko_id: str, date: str):
+        return self.get_gecko_client().get_coin_history_by_id(gecko_id, date, localization='false')
+
+    def get_coin_market_chart_range(self, gecko_id: str, vs_currency: str, from_timestamp: int, to_timestamp: int):
+        return self.get_gecko_client().get_coin_market_chart_range_by_id(gecko_id, vs_currency, from_timestamp, to_timestamp)
+
+    def get_klines(self, symbol: str, start_time: int, end_time: int, limit: int, interval: str = Client.KLINE_INTERVAL_3MINUTE):
+        return self.get_binance_client().get_klines(symbol=symbol,
+                                                    interval=interval,
+                                                    startTime=start_time,
+                                                    endTime=end_time,
+                                                    limit=limit)
+
+    def run(self, calls: List[Tuple[str, Callable, tuple]]):
+        """
+        Execute (provider, fn, args) calls concurrently.
+
+        Return the results in the order of calls, a failed call gives its exception instead of a result.
+        """
+        if not calls:
+            return []
+
+        def execute(call):
+            provider, fn, args = call
+            try:
+                return self.limiters[provider].call(fn, *args)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(calls))) as executor:
+            return list(executor.map(execute, calls))
@@ -0,0 +1,218 @@
+import csv
+import datetime
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from database import BatchWriter, DEFAULT_BATCH_SIZE, to_epoch_minute
+from fetcher import PriceFetcher
+
+logger = logging.getLogger("main")
+
+# EUR price of one USD, priced like the "euro" asset: tether in eur
+FX_PAIR = "USDEUR"
+FX_GECKO_ID = "tether"
+FX_GECKO_CURRENCY = "eur"
+
+# coingecko market chart range is hourly up to 90 days, the curve is fetched by aligned blocks of 88 days,
+# padded by a day on each side so the first and last points of a block can be interpolated (90 days per call)
+FX_BLOCK_MINUTES = 88 * 24 * 60
+FX_PADDING_MINUTES = 24 * 60
+
+# two points further apart than this are not interpolated (covers weekends of daily reference rates)
+DEFAULT_FX_MAX_GAP_HOURS = 96
+
+
+class FxCurve:
+    """
+    EUR/USD curve (EUR price of one USD) loaded for whole periods, with one coingecko market chart call
+    per block of 88 days or from an imported csv, and linearly interpolated in memory.
+
+    Each load records the range it covers in fx_rate_range, a covered period is never fetched again.
+    Safe to share across threads.
+    """
+
+    def __init__(self, connection: Connection, fetcher: PriceFetcher, max_gap_hours: int = DEFAULT_FX_MAX_GAP_HOURS,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        self.connection = connection
+        self.fetcher = fetcher
+        self.max_gap_minutes = max_gap_hours * 60
+        self.batch_size = batch_size
+        self.epoch_minutes = None
+        self.rates = None
+        self.ranges = None
+        # first minute of the blocks that could not be fetched, not requested again during this run
+        self.failed_blocks = set()
+        # first minute of the blocks being fetched -> Future done once the block is loaded
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Read the stored curve and its covered ranges
+        """
+        epoch_minutes = array("q")
+        rates = array("d")
+
+        with self.connection.connect() as conn:
+            sql = "SELECT epoch_minute, rate FROM fx_rate WHERE pair = :pair ORDER BY epoch_minute ASC"
+            for epoch_minute, rate in conn.execute(text(sql), {"pair": FX_PAIR}):
+                epoch_minutes.append(epoch_minute)
+                rates.append(rate)
+
+            sql = "SELECT first_epoch_minute, last_epoch_minute FROM fx_rate_range WHERE pair = :pair ORDER BY first_epoch_minute ASC"
+            result = conn.execute(text(sql), {"pair": FX_PAIR}).mappings().all()
+
+        ranges = []
+        for res in result:
+            if ranges and res["first_epoch_minute"] <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], res["last_epoch_minute"]))
+            else:
+                ranges.append((res["first_epoch_minute"], res["last_epoch_minute"]))
+
+        with self.lock:
+            self.epoch_minutes = epoch_minutes
+            self.rates = rates
+            self.ranges = ranges
+
+    def is_covered(self, epoch_minute: int):
+        i = bisect_right(self.ranges, (epoch_minute, float("inf"))) - 1
+        return i >= 0 and self.ranges[i][0] <= epoch_minute <= self.ranges[i][1]
+
+    def ensure(self, epoch_minutes: List[int]):
+        """
+        Fetch the aligned blocks of the epoch minutes not covered yet, with concurrent calls.
+        Blocks are claimed under the lock but fetched and saved outside of it, a block already being
+        fetched by another thread is waited for instead of fetched twice.
+        """
+        now = to_epoch_minute(datetime.datetime.utcnow())
+
+        if self.ranges is None:
+            self.load()
+
+        owned_blocks = {}
+        waited_blocks = []
+        with self.lock:
+            block_starts = sorted({epoch_minute - epoch_minute % FX_BLOCK_MINUTES for epoch_minute in epoch_minutes
+                                   if epoch_minute <= now and not self.is_covered(epoch_minute)})
+            for first in block_starts:
+                if first in self.failed_blocks:
+                    continue
+                if first in self.in_flight:
+                    waited_blocks.append(self.in_flight[first])
+                else:
+                    owned_blocks[first] = self.in_flight[first] = Future()
+
+        if owned_blocks:
+            try:
+                self.fetch_blocks(list(owned_blocks.keys()), now)
+            finally:
+                with self.lock:
+                    for first, future in owned_blocks.items():
+                        future.set_result(None)
+                        del self.in_flight[first]
+
+        for future in waited_blocks:
+            future.result()
+
+    def fetch_blocks(self, block_starts: List[int], now: int):
+        """
+        Fetch, save then publish blocks, a block that can't be fetched is marked failed
+        """
+        # the running block is only covered up to now, later minutes are fetched by a later run
+        blocks = [(first, min(first + FX_BLOCK_MINUTES - 1, now)) for first in block_starts]
+        logger.info("Load EUR/USD curve, {} blocks of {} days".format(len(blocks), FX_BLOCK_MINUTES // (24 * 60)))
+        calls = [("GECKO", self.fetcher.get_coin_market_chart_range,
+                  (FX_GECKO_ID, FX_GECKO_CURRENCY, (first - FX_PADDING_MINUTES) * 60, (last + FX_PADDING_MINUTES) * 60))
+                 for first, last in blocks]
+
+        for (first, last), result in zip(blocks, self.fetcher.run(calls)):
+            if isinstance(result, Exception):
+                logger.warning("Unable to load EUR/USD curve from minute {} to {}: {}".format(first, last, result))
+                with self.lock:
+                    self.failed_blocks.add(first)
+                continue
+
+            self.save_rates([(int(timestamp) // 60000, float(rate)) for timestamp, rate in result.get("prices", [])], first, last, "gecko")
+
+        self.load()
+
+    def import_file(self, filepath: str):
+        """
+        Import a csv of (datetime or date, EUR price of one USD) rows, the file covers its first to last row
+        """
+        points = []
+        with open(filepath, newline="") as file:
+            for row in csv.reader(file):
+                try:
+                    timestamp = datetime.datetime.fromisoformat(row[0].strip())
+                except (IndexError, ValueError):
+                    # header or empty line
+                    continue
+
+                points.append((to_epoch_minute(timestamp), float(row[1])))
+
+        if not points:
+            raise Exception("No EUR/USD rate in {}".format(filepath))
+
+        logger.info("Import {} EUR/USD rates from {}".format(len(points), filepath))
+        self.save_rates(points, min(points)[0], max(points)[0], filepath)
+        self.load()
+
+    def save_rates(self, points: List, first_epoch_minute: int, last_epoch_minute: int, source: str):
+        """
+        Replace the stored rates at the minutes of points, and record [first_epoch_minute, last_epoch_minute] as covered
+        """
+        points = dict(points)
+
+        with self.connection.begin() as conn:
+            sql = "DELETE FROM fx_rate WHERE pair = :pair AND epoch_minute = :epoch_minute"
+            with BatchWriter(conn, sql, batch_size=self.batch_size) as writer:
+                for epoch_minute in points:
+                    writer.add({"pair": FX_PAIR, "epoch_minute": epoch_minute})
+
+            sql = "INSERT INTO fx_rate (pair,  epoch_minute,  rate)" \
+                  "             VALUES (:pair, :epoch_minute, :rate)"
+            with BatchWriter(conn, sql, batch_size=self.batch_size) as writer:
+                for epoch_minute, rate in points.items():
+                    writer.add({"pair": FX_PAIR, "epoch_minute": epoch_minute, "rate": rate})
+
+            sql = "INSERT INTO fx_rate_range (pair,  first_epoch_minute,  last_epoch_minute,  source)" \
+                  "                   VALUES (:pair, :first_epoch_minute, :last_epoch_minute, :source)"
+            conn.execute(text(sql), {"pair": FX_PAIR,
+                                     "first_epoch_minute": first_epoch_minute,
+                                     "last_epoch_minute": last_epoch_minute,
+                                     "source": source})
+
+    def get_rates(self, timestamps: List[datetime.datetime]):
+        """
+        Interpolated EUR price of one USD at each timestamp, None where the curve has no close enough points
+        """
+        if not timestamps:
+            return []
+
+        epoch_minutes = [to_epoch_minute(timestamp) for timestamp in timestamps]
+        self.ensure(epoch_minutes)
+
+        with self.lock:
+            curve_minutes = self.epoch_minutes
+            curve_rates = self.rates
+
+        rates = []
+        for epoch_minute in epoch_minutes:
+            i = bisect_left(curve_minutes, epoch_minute)
+            if i < len(curve_minutes) and curve_minutes[i] == epoch_minute:
+                rates.append(curve_rates[i])
+            elif 0 < i < len(curve_minutes) and curve_minutes[i] - curve_minutes[i - 1] <= self.max_gap_minutes:
+                weight = (epoch_minute - curve_minutes[i - 1]) / (curve_minutes[i] - curve_minutes[i - 1])
+                rates.append(curve_rates[i - 1] + (curve_rates[i] - curve_rates[i - 1]) * weight)
+            else:
+                rates.append(None)
+
+        return rates
@@ -0,0 +1,171 @@
+import csv
+import io
+import logging
+import os
+import re
+import threading
+import zipfile
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from database import BatchWriter, DEFAULT_BATCH_SIZE
+
+logger = logging.getLogger("main")
+
+# only the interval used for pricing is imported, see CurrencyExtractor.parse_kline_prices
+KLINE_INTERVAL = "3m"
+KLINE_INTERVAL_MS = 3 * 60 * 1000
+
+# data.binance.vision archive name: <SYMBOL>-<INTERVAL>-<YYYY-MM[-DD]>.zip|csv
+KLINE_FILENAME = re.compile(r"^([A-Z0-9]+)-([0-9]+[smhdwM])-[0-9]{4}-[0-9]{2}(-[0-9]{2})?\.(zip|csv)$")
+
+# open time above this is in microseconds (spot archives since 2025), below in milliseconds
+MICROSECOND_THRESHOLD = 10 ** 14
+
+
+class KlineStore:
+    """
+    Local OHLC store loaded from Binance kline archives (data.binance.vision layout)
+    and from the candles returned by the binance api.
+
+    Each imported file records the open time range it covers, inside a covered range
+    the store is authoritative and the binance api is not called.
+    """
+
+    def __init__(self, connection: Connection, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+    def import_directory(self, directory: str):
+        logger.info("Import binance klines from {}".format(directory))
+        imported_files = 0
+
+        for root, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                match = KLINE_FILENAME.match(filename)
+                if not match:
+                    continue
+
+                symbol, interval = match.group(1), match.group(2)
+                if interval != KLINE_INTERVAL:
+                    logger.debug("Skip {}, only {} klines are used".format(filename, KLINE_INTERVAL))
+                    continue
+
+                self.import_file(symbol, os.path.join(root, filename))
+                imported_files += 1
+
+        logger.info("Imported {} binance kline files".format(imported_files))
+
+    def import_file(self, symbol: str, filepath: str):
+        if filepath.endswith(".zip"):
+            with zipfile.ZipFile(filepath) as archive:
+                for name in archive.namelist():
+                    if name.endswith(".csv"):
+                        with archive.open(name) as file:
+                            self.import_rows(symbol, filepath, csv.reader(io.TextIOWrapper(file, encoding="utf-8")))
+        else:
+            with open(filepath, newline="") as file:
+                self.import_rows(symbol, filepath, csv.reader(file))
+
+    def import_rows(self, symbol: str, source: str, rows):
+        klines = []
+        for row in rows:
+            # skip header line of some archives
+            if not row or not row[0].isdigit():
+                continue
+
+            open_time = int(row[0])
+            if open_time > MICROSECOND_THRESHOLD:
+                open_time //= 1000
+
+            klines.append({"symbol": symbol,
+                           "open_time": open_time,
+                           "open": float(row[1]),
+                           "high": float(row[2]),
+                           "low": float(row[3]),
+                           "close": float(row[4])})
+
+        if not klines:
+            return
+
+        first_open_time = min(kline["open_time"] for kline in klines)
+        last_open_time = max(kline["open_time"] for kline in klines)
+        logger.debug("Import {} klines of {} from {}".format(len(klines), symbol, source))
+
+        self.save_klines(symbol, klines, first_open_time, last_open_time, os.path.basename(source))
+
+    def save_api_klines(self, klines: List, symbol: str, start_time: int, end_time: int):
+        """
+        Keep every candle of a kline range call, the call covers all klines opened in [start_time, end_time]
+        """
+        self.save_klines(symbol,
+                         [{"symbol": symbol,
+                           "open_time": kline[0],
+                           "open": float(kline[1]),
+                           "high": float(kline[2]),
+                           "low": float(kline[3]),
+                           "close": float(kline[4])} for kline in klines],
+                         start_time,
+                         end_time - KLINE_INTERVAL_MS + 1,
+                         "api")
+
+    def save_klines(self, symbol: str, klines: List, first_open_time: int, last_open_time: int, source: str):
+        """
+        Replace the klines of symbol opened in [first_open_time, last_open_time], and record the range as covered
+        """
+        with self.lock, self.connection.begin() as conn:
+            sql = "DELETE FROM binance_kline WHERE symbol = :symbol AND open_time >= :first_open_time AND open_time <= :last_open_time"
+            conn.execute(text(sql), {"symbol": symbol, "first_open_time": first_open_time, "last_open_time": last_open_time})
+            sql = "DELETE FROM binance_kline_range WHERE symbol = :symbol AND first_open_time >= :first_open_time AND last_open_time <= :last_open_time"
+            conn.execute(text(sql), {"symbol": symbol, "first_open_time": first_open_time, "last_open_time": last_open_time})
+
+            sql = "INSERT INTO binance_kline (symbol,  open_time,  `open`, high,  low,  `close`)" \
+                  "                   VALUES (:symbol, :open_time, :open,  :high, :low, :close )"
+            with BatchWriter(conn, sql, batch_size=self.batch_size) as writer:
+                for kline in klines:
+                    writer.add(kline)
+
+            sql = "INSERT INTO binance_kline_range (symbol,  first_open_time,  last_open_time,  source)" \
+                  "                         VALUES (:symbol, :first_open_time, :last_open_time, :source)"
+            conn.execute(text(sql), {"symbol": symbol,
+                                     "first_open_time": first_open_time,
+                                     "last_open_time": last_open_time,
+                                     "source": source})
+
+    def get_covered_ranges(self, symbol: str):
+        """
+        Sorted (first_open_time, last_open_time) of the imported data of symbol, contiguous files merged
+        """
+        with self.connection.connect() as conn:
+            sql = "SELECT first_open_time, last_open_time FROM binance_kline_range WHERE symbol = :symbol ORDER BY first_open_time ASC"
+            result = conn.execute(text(sql), {"symbol": symbol}).mappings().all()
+
+        ranges = []
+        for res in result:
+            if ranges and res["first_open_time"] <= ranges[-1][1] + KLINE_INTERVAL_MS:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], res["last_open_time"]))
+            else:
+                ranges.append((res["first_open_time"], res["last_open_time"]))
+
+        return ranges
+
+    def get_klines(self, symbol: str, start_time: int, end_time: int):
+        """
+        Klines [open_time, open, high, low, close] of symbol opened in [start_time, end_time] (milliseconds)
+        """
+        with self.connection.connect() as conn:
+            sql = "SELECT open_time, `open`, high, low, `close` FROM binance_kline " \
+                  "WHERE symbol = :symbol AND open_time >= :start_time AND open_time <= :end_time ORDER BY open_time ASC"
+            result = conn.execute(text(sql), {"symbol": symbol, "start_time": start_time, "end_time": end_time}).all()
+
+        return [list(res) for res in result]
+
+
+def is_covered(ranges: List, start_time: int, end_time: int):
+    """
+    True when every kline opened in [start_time, end_time] belongs to an imported range
+    """
+    return any(first_open_time <= start_time and end_time < last_open_time + KLINE_INTERVAL_MS for first_open_time, last_open_time in ranges)
@@ -5,14 +5,17 @@ import sys
 import yaml
 from datetime import datetime
 
-from utils import CurrencyExtractor
+from utils import CurrencyExtractor, DEFAULT_FAILURE_TTL_HOURS, DEFAULT_LRU_SIZE
 
 from binance.client import Client
 
 from exchange.common import TaxExtractor
-from reporter import TaxReporter, dump_to_csv
-from utils import boot_db
-from sqlalchemy import create_engine
+from fx import FxCurve
+from klines import KlineStore
+from profiler import Profiler, get_profile_filename
+from reporter import DEFAULT_VALUATION_WORKERS, TaxReporter, dump_to_csv, get_window_filename
+from utils import boot_db, migrate_db
+from database import DEFAULT_BATCH_SIZE, create_db_engine
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 
@@ -32,6 +35,7 @@ if __name__ == '__main__':
     parser.add_argument("--exchange", type=str, help="selected exchange", required=not ("--generate" not in sys.argv or "--boot" not in sys.argv), choices=TaxExtractor.get_supported_exchange().keys())
 
     parser.add_argument("--boot", action="store_true", help="create intial database structure", required=False)
+    parser.add_argument("--migrate", action="store_true", help="upgrade database structure, keeping loaded data", required=False)
 
     parser.add_argument("--load", action="store_true", help="load exchange data", required=False, )
     parser.add_argument("-i", "--inf", type=str, help="exchange account statement", required="--load" in sys.argv)
@@ -39,19 +43,36 @@ if __name__ == '__main__':
 
     parser.add_argument("--clean", action="store_true", help="clean loaded exchange data", required=False)
 
+    parser.add_argument("--import-klines", type=str, help="directory of binance kline archives (data.binance.vision layout)", required=False)
+
+    parser.add_argument("--import-fx", type=str, help="csv of EUR/USD rates (datetime, EUR price of one USD)", required=False)
+
+    parser.add_argument("--unresolved", action="store_true", help="list asset prices that could not be resolved", required=False)
+    parser.add_argument("--clean-unresolved", action="store_true", help="forget unresolved asset prices, they are requested again", required=False)
+
+    parser.add_argument("--profile", action="store_true", help="write stage timings, sql, api and cache counters as json next to the output", required=False)
+
     parser.add_argument("--generate", action="store_true", help="generate disposal summary", required=False)
     parser.add_argument("-o", "--outf", type=str, help="csv of disposal summary", required="--generate" in sys.argv)
-    parser.add_argument("-b", "--begin", type=str, help="begin date of tax year", required="--generate" in sys.argv)
-    parser.add_argument("-e", "--end", type=str, help="end date of tax year", required="--generate" in sys.argv)
+    parser.add_argument("-b", "--begin", type=str, action="append", help="begin date of tax year, repeat with --end for several years: the disposal recurrence then starts at the first "
+                                                                        "begin and carries over to the next years, a single year starts it at its own begin",
+                        required="--generate" in sys.argv)
+    parser.add_argument("-e", "--end", type=str, action="append", help="end date of tax year", required="--generate" in sys.argv)
 
     args = parser.parse_args()
 
     config_file = args.config
     exchange = args.exchange
     execute_boot = args.boot
+    execute_migrate = args.migrate
     execute_load = args.load
     execute_clean = args.clean
     execute_generate = args.generate
+    execute_unresolved = args.unresolved
+    klines_directory = args.import_klines
+    fx_filename = args.import_fx
+    execute_clean_unresolved = args.clean_unresolved
+    execute_profile = args.profile
 
     input_filename = args.inf
     output_filename = args.outf
@@ -60,32 +81,84 @@ if __name__ == '__main__':
     end_date = args.end
 
     config = load_configuration(config_file)
+    batch_size = config["database"].get("batch_size", DEFAULT_BATCH_SIZE)
 
-    engine = create_engine(config["database"]["database_uri"])
+    engine = create_db_engine(config["database"])
     binance_client = Client(config["binance"]["key"], config["binance"]["secret"])
-    currency_extractor = CurrencyExtractor(engine, binance_client)
+    currency_extractor = CurrencyExtractor(engine, binance_client, lru_size=config.get("price_cache", {}).get("lru_size", DEFAULT_LRU_SIZE),
+                                           fetch_config=config.get("price_fetch", {}),
+                                           failure_ttl_hours=config.get("price_cache", {}).get("failure_ttl_hours", DEFAULT_FAILURE_TTL_HOURS),
+                                           resolution_config=config.get("price_resolution", {}),
+                                           fx_config=config.get("fx", {}))
+    profiler = Profiler(engine, currency_extractor, enabled=execute_profile)
 
     if execute_boot:
         boot_db(config["database"]["database_dialect"], engine)
 
+    if execute_migrate:
+        migrate_db(config["database"]["database_dialect"], engine)
+
+    if klines_directory:
+        with profiler.stage("import_klines"):
+            KlineStore(engine, batch_size=batch_size).import_directory(klines_directory)
+
+    if fx_filename:
+        with profiler.stage("import_fx"):
+            FxCurve(engine, currency_extractor.fetcher, batch_size=batch_size).import_file(fx_filename)
+
     if execute_clean:
-        extractor = TaxExtractor.get_extractor(exchange, engine, currency_extractor)
+        extractor = TaxExtractor.get_extractor(exchange, engine, currency_extractor, batch_size=batch_size)
         extractor.clean_all_history()
 
     if execute_load:
-        extractor = TaxExtractor.get_extractor(exchange, engine, currency_extractor)
-        extractor.load_account_statement(input_filename)
-        extractor.process_load()
-        extractor.generate_purchase_operation_history()
-        extractor.generate_sale_operation_history(try_compact=try_compact)
+        extractor = TaxExtractor.get_extractor(exchange, engine, currency_extractor, batch_size=batch_size)
+        with profiler.stage("load_account_statement"):
+            extractor.load_account_statement(input_filename)
+        with profiler.stage("process_load"):
+            extractor.process_load()
+        with profiler.stage("generate_purchase_operation_history"):
+            extractor.generate_purchase_operation_history()
+        with profiler.stage("generate_sale_operation_history"):
+            extractor.generate_sale_operation_history(try_compact=try_compact)
+        with profiler.stage("build_holdings_timeline"):
+            extractor.build_holdings_timeline()
 
     if execute_generate:
-        report = TaxReporter(engine, currency_extractor)
-        tax_report = report.generate_tax_disposal_history(begin_date=datetime.strptime(begin_date, "%Y-%m-%d-%H-%M-%S"),
-                                                          end_date=datetime.strptime(end_date, "%Y-%m-%d-%H-%M-%S"),
-                                                          compacted=try_compact)
-
-        dump_to_csv(tax_report, output_filename)
+        report = TaxReporter(engine, currency_extractor, batch_size=batch_size,
+                             valuation_workers=config.get("report", {}).get("valuation_workers", DEFAULT_VALUATION_WORKERS))
+        if len(begin_date) != len(end_date):
+            raise Exception("Each --begin needs an --end")
+
+        if len(begin_date) == 1:
+            with profiler.stage("generate_tax_disposal_history"):
+                tax_report = report.generate_tax_disposal_history(begin_date=datetime.strptime(begin_date[0], "%Y-%m-%d-%H-%M-%S"),
+                                                                  end_date=datetime.strptime(end_date[0], "%Y-%m-%d-%H-%M-%S"),
+                                                                  compacted=try_compact)
+
+            with profiler.stage("dump_to_csv"):
+                dump_to_csv(tax_report, output_filename)
+        else:
+            windows = [(datetime.strptime(begin, "%Y-%m-%d-%H-%M-%S"), datetime.strptime(end, "%Y-%m-%d-%H-%M-%S")) for begin, end in zip(begin_date, end_date)]
+            with profiler.stage("generate_tax_disposal_history"):
+                tax_reports = report.generate_tax_disposal_histories(windows, compacted=try_compact)
+
+            for tax_report in tax_reports:
+                with profiler.stage("dump_to_csv"):
+                    dump_to_csv(tax_report, get_window_filename(output_filename, tax_report["begin_date"], tax_report["end_date"]))
+
+    if execute_unresolved:
+        unresolved_prices = currency_extractor.get_unresolved_prices()
+        for failure in unresolved_prices:
+            logger.info("{} {} at {}: {} (attempts: {}, last: {})".format(failure["scope"], failure["asset"], failure["price_datetime"],
+                                                                          failure["reason"], failure["attempts"], failure["failure_datetime"]))
+        logger.info("{} unresolved asset prices".format(len(unresolved_prices)))
+
+    if execute_clean_unresolved:
+        currency_extractor.clean_unresolved_prices()
+
+    logger.debug("Price cache stats: {}".format(currency_extractor.get_cache_stats()))
+
+    profiler.write(get_profile_filename(output_filename if execute_generate else input_filename))
 
 
 
@@ -0,0 +1,269 @@
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from database import NATIVE_RESOLUTION_MINUTES, PRICE_SCOPE_IDS, BatchWriter
+
+logger = logging.getLogger("main")
+
+# candle sizes a price can be resolved at (binance kline interval names)
+RESOLUTION_MINUTES = {"1m": 1, "3m": 3, "5m": 5, "15m": 15, "30m": 30,
+                      "1h": 60, "2h": 120, "4h": 240, "6h": 360, "8h": 480, "12h": 720,
+                      "1d": 1440}
+RESOLUTION_NAMES = {minutes: name for name, minutes in RESOLUTION_MINUTES.items()}
+
+
+class PriceQuote(float):
+    """
+    Price (usable as a float) with the candle size it was resolved at, and the epoch minute of its point
+    """
+
+    def __new__(cls, price: float, resolution: Optional[str], epoch_minute: int):
+        quote = super(PriceQuote, cls).__new__(cls, price)
+        quote.resolution = resolution
+        quote.epoch_minute = epoch_minute
+        return quote
+
+    def __repr__(self):
+        return "PriceQuote({}, {}, {})".format(float(self), self.resolution, self.epoch_minute)
+
+
+class ResolutionPolicy(NamedTuple):
+    """
+    A stored price up to tolerance_minutes away from the requested minute can be reused,
+    a missing price is fetched at resolution (None is the native resolution of the scope)
+    """
+    tolerance_minutes: int = 0
+    resolution: Optional[str] = None
+
+    def get_resolution_minutes(self, scope: str):
+        return RESOLUTION_MINUTES[self.resolution] if self.resolution else NATIVE_RESOLUTION_MINUTES[scope]
+
+    def get_resolution(self, scope: str):
+        return self.resolution if self.resolution else RESOLUTION_NAMES[NATIVE_RESOLUTION_MINUTES[scope]]
+
+    def is_coarse(self, scope: str):
+        return self.get_resolution_minutes(scope) > NATIVE_RESOLUTION_MINUTES[scope]
+
+    def get_fetch_minute(self, scope: str, epoch_minute: int):
+        """
+        Minute a missing price is fetched and stored at: the requested minute, or the start of its coarse candle
+        """
+        if not self.is_coarse(scope):
+            return epoch_minute
+
+        resolution_minutes = self.get_resolution_minutes(scope)
+        return epoch_minute - epoch_minute % resolution_minutes
+
+
+class ResolutionPolicies:
+    """
+    Resolution policy of each scope, overridden for asset classes:
+
+        price_resolution:
+          GECKO: {tolerance_minutes: 5}
+          classes:
+            illiquid:
+              assets: ["cgld"]
+              GECKO: {tolerance_minutes: 720, resolution: "1d"}
+    """
+
+    def __init__(self, resolution_config: dict = None):
+        resolution_config = resolution_config or {}
+        self.scope_policies = {scope: self.parse_policy(resolution_config.get(scope, {})) for scope in PRICE_SCOPE_IDS}
+        self.asset_policies = {}
+
+        for class_name, class_config in resolution_config.get("classes", {}).items():
+            for asset in class_config.get("assets", []):
+                for scope in PRICE_SCOPE_IDS:
+                    if scope in class_config:
+                        self.asset_policies[(scope, asset.lower())] = self.parse_policy(class_config[scope])
+
+    @staticmethod
+    def parse_policy(policy_config: dict):
+        resolution = policy_config.get("resolution")
+        if resolution is not None and resolution not in RESOLUTION_MINUTES:
+            raise Exception("Unsupported price resolution: {}".format(resolution))
+
+        return ResolutionPolicy(tolerance_minutes=policy_config.get("tolerance_minutes", 0), resolution=resolution)
+
+    def get_policy(self, scope: str, asset: str):
+        return self.asset_policies.get((scope, asset.lower()), self.scope_policies[scope])
+
+
+class PriceSeries:
+    """
+    Prices of one (asset, scope), as sorted arrays of epoch minutes, double values and resolutions in minutes
+    """
+
+    def __init__(self, epoch_minutes: array, prices: array, resolutions: array):
+        self.epoch_minutes = epoch_minutes
+        self.prices = prices
+        self.resolutions = resolutions
+
+    def get_quote(self, i: int):
+        return PriceQuote(self.prices[i], RESOLUTION_NAMES.get(self.resolutions[i]), self.epoch_minutes[i])
+
+    def get(self, epoch_minute: int, max_resolution_minutes: int):
+        i = bisect_left(self.epoch_minutes, epoch_minute)
+        if i < len(self.epoch_minutes) and self.epoch_minutes[i] == epoch_minute and self.resolutions[i] <= max_resolution_minutes:
+            return self.get_quote(i)
+
+        return None
+
+    def get_nearest(self, epoch_minute: int, tolerance_minutes: int, max_resolution_minutes: int):
+        """
+        Closest price at most tolerance_minutes away, the earlier one on a tie
+        """
+        i = bisect_left(self.epoch_minutes, epoch_minute)
+        before = i - 1
+        after = i
+        while True:
+            before_distance = epoch_minute - self.epoch_minutes[before] if before >= 0 else None
+            after_distance = self.epoch_minutes[after] - epoch_minute if after < len(self.epoch_minutes) else None
+
+            if after_distance is not None and after_distance <= tolerance_minutes and (before_distance is None or after_distance < before_distance):
+                if self.resolutions[after] <= max_resolution_minutes:
+                    return self.get_quote(after)
+                after += 1
+            elif before_distance is not None and before_distance <= tolerance_minutes:
+                if self.resolutions[before] <= max_resolution_minutes:
+                    return self.get_quote(before)
+                before -= 1
+            else:
+                return None
+
+    def get_range(self, first_epoch_minute: int, last_epoch_minute: int):
+        first = bisect_left(self.epoch_minutes, first_epoch_minute)
+        last = bisect_left(self.epoch_minutes, last_epoch_minute + 1)
+        return [self.get_quote(i) for i in range(first, last)]
+
+    def put(self, epoch_minute: int, price: float, resolution_minutes: int):
+        i = bisect_left(self.epoch_minutes, epoch_minute)
+        if i < len(self.epoch_minutes) and self.epoch_minutes[i] == epoch_minute:
+            self.prices[i] = price
+            self.resolutions[i] = resolution_minutes
+        else:
+            self.epoch_minutes.insert(i, epoch_minute)
+            self.prices.insert(i, price)
+            self.resolutions.insert(i, resolution_minutes)
+
+    def __len__(self):
+        return len(self.epoch_minutes)
+
+
+class PriceSeriesStore:
+    """
+    Price store keyed by (asset id, scope id, epoch minute).
+
+    The series of an (asset, scope) is read once with a single ordered query, then every lookup
+    is a binary search in memory. Safe to share across threads.
+    """
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.asset_ids = None
+        self.series = {}
+        self.lock = threading.RLock()
+
+    def get_asset_id(self, asset: str, create: bool = False):
+        with self.lock:
+            if self.asset_ids is None:
+                with self.connection.connect() as conn:
+                    result = conn.execute(text("SELECT id, name FROM price_asset")).mappings().all()
+                self.asset_ids = {res["name"]: res["id"] for res in result}
+
+            if asset not in self.asset_ids and create:
+                with self.connection.begin() as conn:
+                    conn.execute(text("INSERT INTO price_asset (name) VALUES (:name)"), {"name": asset})
+                    result = conn.execute(text("SELECT id FROM price_asset WHERE name = :name"), {"name": asset}).mappings().fetchone()
+                self.asset_ids[asset] = result["id"]
+
+            return self.asset_ids.get(asset)
+
+    def get_series(self, scope: str, asset: str):
+        with self.lock:
+            if (scope, asset) in self.series:
+                return self.series[(scope, asset)]
+
+            epoch_minutes = array("q")
+            prices = array("d")
+            resolutions = array("H")
+
+            asset_id = self.get_asset_id(asset)
+            if asset_id is not None:
+                with self.connection.connect() as conn:
+                    sql = "SELECT epoch_minute, price, resolution_minutes FROM price_series " \
+                          "WHERE asset_id = :asset_id AND scope_id = :scope_id ORDER BY epoch_minute ASC"
+                    result = conn.execute(text(sql), {"asset_id": asset_id, "scope_id": PRICE_SCOPE_IDS[scope]})
+                    for epoch_minute, price, resolution_minutes in result:
+                        epoch_minutes.append(epoch_minute)
+                        prices.append(price)
+                        resolutions.append(resolution_minutes)
+
+            self.series[(scope, asset)] = PriceSeries(epoch_minutes, prices, resolutions)
+            return self.series[(scope, asset)]
+
+    def get_quote(self, scope: str, asset: str, epoch_minute: int, policy: ResolutionPolicy):
+        """
+        Stored price for a request under policy: the closest point within tolerance,
+        else the point of the coarse candle of the request
+        """
+        resolution_minutes = policy.get_resolution_minutes(scope)
+
+        with self.lock:
+            series = self.get_series(scope, asset)
+            quote = series.get_nearest(epoch_minute, policy.tolerance_minutes, resolution_minutes)
+            if quote is None and policy.is_coarse(scope):
+                quote = series.get(policy.get_fetch_minute(scope, epoch_minute), resolution_minutes)
+
+            return quote
+
+    def get_prices(self, keys: List[Tuple[str, str, int, str]]):
+        """
+        Stored prices of (scope, asset, epoch minute, resolution) keys, at the resolution or finer
+        """
+        prices = {}
+        with self.lock:
+            for key in keys:
+                scope, asset, epoch_minute, resolution = key
+                quote = self.get_series(scope, asset).get(epoch_minute, RESOLUTION_MINUTES[resolution])
+                if quote is not None:
+                    prices[key] = quote
+
+        return prices
+
+    def save_prices(self, prices: Dict[Tuple[str, str, int, str], float]):
+        """
+        Store prices by (scope, asset, epoch minute, resolution) key, a point already stored at the minute is replaced
+        """
+        if not prices:
+            return
+
+        with self.lock:
+            asset_ids = {asset: self.get_asset_id(asset, create=True) for _, asset, _, _ in prices}
+
+            with self.connection.begin() as conn:
+                sql = "DELETE FROM price_series WHERE asset_id = :asset_id AND scope_id = :scope_id AND epoch_minute = :epoch_minute"
+                with BatchWriter(conn, sql) as writer:
+                    for scope, asset, epoch_minute, _ in prices:
+                        if self.get_series(scope, asset).get(epoch_minute, max(RESOLUTION_MINUTES.values())) is not None:
+                            writer.add({"asset_id": asset_ids[asset], "scope_id": PRICE_SCOPE_IDS[scope], "epoch_minute": epoch_minute})
+
+                sql = "INSERT INTO price_series (asset_id,  scope_id,  epoch_minute,  price,  resolution_minutes)" \
+                      "                  VALUES (:asset_id, :scope_id, :epoch_minute, :price, :resolution_minutes)"
+                with BatchWriter(conn, sql) as writer:
+                    for (scope, asset, epoch_minute, resolution), price in prices.items():
+                        writer.add({"asset_id": asset_ids[asset],
+                                    "scope_id": PRICE_SCOPE_IDS[scope],
+                                    "epoch_minute": epoch_minute,
+                                    "price": float(price),
+                                    "resolution_minutes": RESOLUTION_MINUTES[resolution]})
+
+            for (scope, asset, epoch_minute, resolution), price in prices.items():
+                self.get_series(scope, asset).put(epoch_minute, float(price), RESOLUTION_MINUTES[resolution])
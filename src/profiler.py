@@ -0,0 +1,121 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from utils import CurrencyExtractor
+
+logger = logging.getLogger("main")
+
+
+def get_profile_filename(filename: str = None):
+    """
+    Profile report written next to a file: decla.csv -> decla.profile.json
+    """
+    if not filename:
+        return "profile.json"
+
+    return os.path.splitext(filename)[0] + ".profile.json"
+
+
+def get_ratio(hits: int, total: int):
+    return round(hits / total, 4) if total else None
+
+
+def round_seconds(counters: dict):
+    return {name: round(value, 3) if name.endswith("_seconds") else value for name, value in counters.items()}
+
+
+class Profiler:
+    """
+    Per pipeline stage wall time, SQL statements (SQLAlchemy cursor events), price provider calls, retries
+    and waits, and price cache hits. A stage run several times is summed.
+    Disabled, stage() only runs its block.
+    """
+
+    def __init__(self, engine: Engine, currency_extractor: CurrencyExtractor, enabled: bool = True):
+        self.engine = engine
+        self.currency_extractor = currency_extractor
+        self.enabled = enabled
+        self.stages = {}
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+        if enabled:
+            event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_start", []).append(time.monotonic())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.monotonic() - conn.info["profile_start"].pop()
+        with self.lock:
+            self.sql_statements += 1
+            self.sql_seconds += elapsed
+
+    def get_counters(self):
+        with self.lock:
+            counters = {"sql_statements": self.sql_statements, "sql_seconds": self.sql_seconds}
+
+        cache_stats = self.currency_extractor.get_cache_stats()
+        counters.update({name: value for name, value in cache_stats.items() if name != "lru_size"})
+
+        for provider, stats in self.currency_extractor.fetcher.get_stats().items():
+            for name, value in stats.items():
+                counters["{}_{}".format(provider.lower(), name)] = value
+
+        return counters
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        before = self.get_counters()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            wall_seconds = time.monotonic() - started
+            after = self.get_counters()
+
+            stage = self.stages.setdefault(name, {"runs": 0, "wall_seconds": 0.0})
+            stage["runs"] += 1
+            stage["wall_seconds"] += wall_seconds
+            for counter, value in after.items():
+                stage[counter] = stage.get(counter, 0) + value - before.get(counter, 0)
+
+            logger.debug("Profile {}: {:.3f}s, {} sql statements".format(name, wall_seconds, after["sql_statements"] - before["sql_statements"]))
+
+    def get_report(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            stage = round_seconds(stage)
+
+            lookups = stage.get("lru_hits", 0) + stage.get("lru_misses", 0)
+            stage["lru_hit_ratio"] = get_ratio(stage.get("lru_hits", 0), lookups)
+            stage["price_hit_ratio"] = get_ratio(stage.get("lru_hits", 0) + stage.get("store_hits", 0), lookups)
+            stages[name] = stage
+
+        return {"creation_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "wall_seconds": round(time.monotonic() - self.started, 3),
+                "stages": stages,
+                "totals": round_seconds(self.get_counters())}
+
+    def write(self, filename: str):
+        if not self.enabled:
+            return
+
+        with open(filename, "w") as file:
+            json.dump(self.get_report(), file, indent=2, default=str)
+
+        logger.info("Profile written to {}".format(filename))
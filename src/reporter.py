@@ -1,16 +1,23 @@
 import csv
 import logging
+import os
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from decimal import Decimal
-from typing import List
+from typing import List, Tuple
 
+from sqlalchemy import text
 from sqlalchemy.engine import Connection
 
+from database import BatchWriter, DEFAULT_BATCH_SIZE
+from disposal import DisposalEngine
 from exchange.common import AbstractExchangeExtractor, TaxExtractor
 from utils import CurrencyExtractor
 
 logger = logging.getLogger("main")
 
+DEFAULT_VALUATION_WORKERS = 8
+
 header = ["disposal_datetime",
           "current_portfolio_value",
           "disposal_price",
@@ -21,11 +28,6 @@ header = ["disposal_datetime",
 white_row = [""*7]
 
 
-# replace shitty version
-def real_round(value: Decimal, digit: int = 2):
-    return Decimal(str(round(value, digit)))
-
-
 def dump_to_csv(tax_report, output):
     with open(output, 'w', newline='') as csvfile:
         disposal_writer = csv.writer(csvfile, delimiter=';')
@@ -51,72 +53,161 @@ def dump_to_csv(tax_report, output):
         disposal_writer.writerow(["global_pnl", tax_report["global_pnl"] ])
 
 
-class TaxReporter:
-    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor):
-        self.connection = connection
-        self.currency_extractor = currency_extractor
-        self.all_extractor = [cls(self.connection, self.currency_extractor) for cls in TaxExtractor.get_supported_exchange().values()]
-
-    def get_sale_operations(self, begin_date: datetime, end_date: datetime):
-        with self.connection.connect() as conn:
-            sql = "SELECT * FROM sale_operation_history WHERE sale_datetime >= %s AND sale_datetime <= %s ORDER BY sale_datetime ASC"
-            args = [begin_date, end_date]
-
-            result = conn.execute(sql, args).mappings().all()
-            return result
-
-    def get_portfolio_value(self, timestamp: datetime):
-        portfolio_value = 0.0
-
-        for extractor in self.all_extractor:
-            portfolio_value += extractor.get_portfolio_value(timestamp)
-        return portfolio_value
-
-    def get_all_purchase_value(self, timestamp: datetime):
-        with self.connection.connect() as conn:
-            sql = "SELECT SUM(amount_price_euro) FROM purchase_operation_history WHERE purchase_datetime <= %s"
-            args = [timestamp]
-            result = conn.execute(sql, args).mappings().fetchone()
+def get_window_filename(output: str, begin_date: datetime, end_date: datetime):
+    """
+    output csv name of one window of a multi window report: report.csv -> report_20210101-20211231.csv
+    """
+    stem, extension = os.path.splitext(output)
+    return "{}_{}-{}{}".format(stem, begin_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d"), extension)
 
-            return result["SUM(amount_price_euro)"] if result["SUM(amount_price_euro)"] else 0.0
 
-    def generate_tax_disposal_history(self, begin_date: datetime, end_date: datetime, compacted: bool = False):
-        logger.info("Generate tax disposal history")
-        sale_operations = self.get_sale_operations(begin_date, end_date)
+class HoldingsSweep:
+    """
+    Running per-asset balances of one exchange, built from its holdings timeline read once in timestamp order.
+    Advancing to the next disposal only applies the changes since the previous one.
+    """
 
-        all_disposals = []
-        global_pnl = 0
+    def __init__(self, extractor: AbstractExchangeExtractor, until: datetime):
+        self.extractor = extractor
+        self.balances = {}
+        self.timestamp = None
+        self.changes = extractor.get_timeline_changes(until)
+        self.index = 0
 
-        for sale in sale_operations:
-            disposal = {}
+    def advance(self, timestamp: datetime):
+        if self.timestamp is not None and timestamp < self.timestamp:
+            raise Exception("Holdings sweep can't go back in time ({} < {})".format(timestamp, self.timestamp))
+        self.timestamp = timestamp
 
-            sale_datetime = sale["sale_datetime"]
-            current_portfolio_value = self.get_portfolio_value(sale_datetime)
+        # an inclusive change (phase 0) is owned at its own timestamp, an exclusive one only after it
+        while self.index < len(self.changes):
+            change_datetime, phase, asset, balance = self.changes[self.index]
+            if change_datetime > timestamp or (change_datetime == timestamp and phase != 0):
+                break
 
-            disposal["disposal_datetime"] = sale_datetime
-            disposal["current_portfolio_value"] = real_round(Decimal(current_portfolio_value))
-            disposal["disposal_price"] = real_round(Decimal(sale["amount_price_euro"]))
+            self.balances[asset] = balance
+            self.index += 1
 
-            all_cash_in = self.get_all_purchase_value(sale_datetime)
-            disposal["current_total_purchase"] = real_round(Decimal(all_cash_in))
+        return self.balances
 
-            if all_disposals:
-                previous_disposal = all_disposals[-1]
-                current_previous_disposed_purchase = previous_disposal["current_balanced_purchase"] * previous_disposal["disposal_price"] / previous_disposal["current_portfolio_value"]
-                disposal["current_previous_disposed_purchase"] = real_round(Decimal(current_previous_disposed_purchase + previous_disposal["current_previous_disposed_purchase"]))
-            else:
-                disposal["current_previous_disposed_purchase"] = 0
+    def get_holdings(self, timestamp: datetime):
+        return self.extractor.get_owned_holdings(self.advance(timestamp))
 
-            disposal["current_balanced_purchase"] = real_round(Decimal(disposal["current_total_purchase"] - disposal["current_previous_disposed_purchase"]))
-            disposal["profit_and_loss"] = real_round(Decimal(disposal["disposal_price"] - (disposal["current_balanced_purchase"] * disposal["disposal_price"] / disposal["current_portfolio_value"])))
 
-            global_pnl += real_round(Decimal(disposal["profit_and_loss"]))
+class TaxReporter:
+    def __init__(self, connection: Connection, currency_extractor: CurrencyExtractor, batch_size: int = DEFAULT_BATCH_SIZE,
+                 valuation_workers: int = DEFAULT_VALUATION_WORKERS):
+        self.connection = connection
+        self.currency_extractor = currency_extractor
+        self.batch_size = batch_size
+        self.valuation_workers = valuation_workers
+        self.all_extractor = [cls(self.connection, self.currency_extractor, batch_size=batch_size) for cls in TaxExtractor.get_supported_exchange().values()]
 
-            all_disposals.append(disposal)
+    def get_sale_operations(self, begin_date: datetime, end_date: datetime):
+        """
+        Sales of the period, each with the cumulated euro purchase up to its datetime (current_total_purchase),
+        computed with a window function over purchases and sales merged in datetime order (MariaDB 10.2+, SQLite 3.25+)
+        """
+        with self.connection.connect() as conn:
+            sql = "SELECT sale.*, cumulated.current_total_purchase " \
+                  "FROM (" \
+                  "    SELECT operation_id, operation_order," \
+                  "           SUM(purchase_price_euro) OVER (ORDER BY operation_datetime ASC, operation_order ASC" \
+                  "                                          ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS current_total_purchase" \
+                  "    FROM (" \
+                  "        SELECT id AS operation_id, purchase_datetime AS operation_datetime, 0 AS operation_order, amount_price_euro AS purchase_price_euro" \
+                  "        FROM purchase_operation_history WHERE purchase_datetime <= :end_date" \
+                  "        UNION ALL" \
+                  "        SELECT id, sale_datetime, 1, 0.0" \
+                  "        FROM sale_operation_history WHERE sale_datetime >= :begin_date AND sale_datetime <= :end_date" \
+                  "    ) operation" \
+                  ") cumulated " \
+                  "JOIN sale_operation_history sale ON sale.id = cumulated.operation_id AND cumulated.operation_order = 1 " \
+                  "ORDER BY sale.sale_datetime ASC, sale.id ASC"
+            args = {"begin_date": begin_date, "end_date": end_date}
+
+            result = conn.execute(text(sql), args).mappings().all()
+            return result
 
-        tax_report = self.save_declaration(begin_date, end_date, all_disposals, compacted, global_pnl)
+    def prefetch_prices(self, snapshots: List[Tuple[datetime, List]]):
+        """
+        Resolve the prices of every snapshot with one bulk request, so kline range calls group many sale
+        datetimes of a symbol; valuing a snapshot then only reads the price caches
+        """
+        requests = []
+        for sale_datetime, all_holdings in snapshots:
+            for extractor, holdings in zip(self.all_extractor, all_holdings):
+                requests += [(asset, sale_datetime, extractor.PRICE_SCOPE) for asset, _ in holdings]
+
+        if requests:
+            self.currency_extractor.get_asset_prices(requests)
+            self.currency_extractor.get_euro_prices([sale_datetime for sale_datetime, _ in snapshots])
+
+    def get_disposal_portfolio_values(self, sale_datetimes: List[datetime]):
+        """
+        Portfolio value at each sale datetime, in ascending order.
+
+        Holdings of every exchange are swept once along its holdings timeline, their prices are prefetched together,
+        then the snapshots are valued concurrently by valuation_workers threads. A value is summed exchange by exchange in a fixed order,
+        so the result does not depend on the worker count.
+        """
+        if not sale_datetimes:
+            return []
+
+        sweeps = [HoldingsSweep(extractor, sale_datetimes[-1]) for extractor in self.all_extractor]
+        snapshots = [(sale_datetime, [sweep.get_holdings(sale_datetime) for sweep in sweeps]) for sale_datetime in sale_datetimes]
+        self.prefetch_prices(snapshots)
+
+        def get_value(snapshot):
+            sale_datetime, all_holdings = snapshot
+            portfolio_value = 0.0
+            for extractor, holdings in zip(self.all_extractor, all_holdings):
+                portfolio_value += extractor.get_holdings_value(holdings, sale_datetime)
+            return portfolio_value
+
+        if self.valuation_workers <= 1 or len(snapshots) <= 1:
+            return [get_value(snapshot) for snapshot in snapshots]
+
+        logger.info("Value portfolio at {} disposals with {} workers".format(len(snapshots), self.valuation_workers))
+        with ThreadPoolExecutor(max_workers=self.valuation_workers) as executor:
+            return list(executor.map(get_value, snapshots))
 
-        return tax_report
+    def generate_tax_disposal_history(self, begin_date: datetime, end_date: datetime, compacted: bool = False):
+        return self.generate_tax_disposal_histories([(begin_date, end_date)], compacted=compacted)[0]
+
+    def generate_tax_disposal_histories(self, windows: List[Tuple[datetime, datetime]], compacted: bool = False):
+        """
+        One tax report per (begin_date, end_date) window, from a single walk over the history.
+
+        The sales of every window (and between windows) are valued from the same holdings timeline and go through the same
+        disposal recurrence, so balances and current_previous_disposed_purchase carry over from a window
+        to the next one instead of restarting.
+        """
+        windows = sorted(windows)
+        for (_, previous_end), (begin_date, _) in zip(windows, windows[1:]):
+            if begin_date <= previous_end:
+                raise Exception("Overlapping tax report windows ({} <= {})".format(begin_date, previous_end))
+
+        logger.info("Generate tax disposal history of {} windows".format(len(windows)))
+        sale_operations = self.get_sale_operations(windows[0][0], windows[-1][1])
+        portfolio_values = self.get_disposal_portfolio_values([sale["sale_datetime"] for sale in sale_operations])
+
+        engine = DisposalEngine()
+        for sale, current_portfolio_value in zip(sale_operations, portfolio_values):
+            all_cash_in = sale["current_total_purchase"] if sale["current_total_purchase"] else 0.0
+            engine.add(sale["sale_datetime"], current_portfolio_value, sale["amount_price_euro"], all_cash_in)
+
+        engine.compute()
+
+        tax_reports = []
+        sale_datetimes = [sale["sale_datetime"] for sale in sale_operations]
+        for begin_date, end_date in windows:
+            first = bisect_left(sale_datetimes, begin_date)
+            last = bisect_right(sale_datetimes, end_date)
+            tax_reports.append(self.save_declaration(begin_date, end_date, engine.get_disposals(first, last), compacted,
+                                                     engine.get_global_pnl(first, last)))
+
+        return tax_reports
 
     def save_declaration(self, begin_date: datetime, end_date: datetime, all_disposals: List, compacted: bool, global_pnl: float):
         tax_report = {"creation_date": datetime.utcnow(),
@@ -128,25 +219,26 @@ class TaxReporter:
 
         with self.connection.begin() as conn:
             sql = "INSERT INTO tax_report (creation_date, begin_date, end_date, compacted, global_pnl)" \
-                  "                VALUES (%s,            %s,         %s,       %s,        %s        )"
-            result = conn.execute(sql, [tax_report["creation_date"],
-                                        tax_report["begin_date"],
-                                        tax_report["end_date"],
-                                        tax_report["compacted"],
-                                        tax_report["global_pnl"]])
+                  "                VALUES (:creation_date, :begin_date, :end_date, :compacted, :global_pnl)"
+            result = conn.execute(text(sql), {"creation_date": tax_report["creation_date"],
+                                              "begin_date": tax_report["begin_date"],
+                                              "end_date": tax_report["end_date"],
+                                              "compacted": tax_report["compacted"],
+                                              "global_pnl": tax_report["global_pnl"]})
             tax_report["id"] = result.lastrowid
 
-            for disposal in all_disposals:
-                    sql = "INSERT INTO tax_disposal_history (disposal_datetime, current_portfolio_value, disposal_price, current_total_purchase, current_previous_disposed_purchase, current_balanced_purchase, profit_and_loss, tax_report_id)" \
-                          "                          VALUES (%s,                %s,                      %s,             %s,                     %s,                                  %s,                        %s,              %s           )"
-                    conn.execute(sql, [disposal["disposal_datetime"],
-                                         disposal["current_portfolio_value"],
-                                         disposal["disposal_price"],
-                                         disposal["current_total_purchase"],
-                                         disposal["current_previous_disposed_purchase"],
-                                         disposal["current_balanced_purchase"],
-                                         disposal["profit_and_loss"],
-                                         tax_report["id"]])
+            sql = "INSERT INTO tax_disposal_history (disposal_datetime, current_portfolio_value, disposal_price, current_total_purchase, current_previous_disposed_purchase, current_balanced_purchase, profit_and_loss, tax_report_id)" \
+                  "                          VALUES (:disposal_datetime, :current_portfolio_value, :disposal_price, :current_total_purchase, :current_previous_disposed_purchase, :current_balanced_purchase, :profit_and_loss, :tax_report_id)"
+            with BatchWriter(conn, sql, batch_size=self.batch_size) as writer:
+                for disposal in all_disposals:
+                    writer.add({"disposal_datetime": disposal["disposal_datetime"],
+                                "current_portfolio_value": disposal["current_portfolio_value"],
+                                "disposal_price": disposal["disposal_price"],
+                                "current_total_purchase": disposal["current_total_purchase"],
+                                "current_previous_disposed_purchase": disposal["current_previous_disposed_purchase"],
+                                "current_balanced_purchase": disposal["current_balanced_purchase"],
+                                "profit_and_loss": disposal["profit_and_loss"],
+                                "tax_report_id": tax_report["id"]})
 
         return tax_report
 
@@ -1,94 +1,562 @@
 import datetime
 import logging
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Tuple
 
 from binance.client import Client
-from pycoingecko import CoinGeckoAPI
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
 from sqlalchemy.engine import Connection
-from tenacity import retry, wait_fixed, stop_after_attempt, before_log
 
-from database import BOOT_DB_REQUEST
+from database import BOOT_DB_REQUEST, MIGRATE_DB_REQUEST, NATIVE_RESOLUTION_MINUTES, SCHEMA_VERSION, SCHEMA_VERSION_REQUEST, BatchWriter, \
+    from_epoch_minute, to_epoch_minute
+from fetcher import RATE_LIMIT_STATUS, PriceFetcher, get_status_code
+from fx import DEFAULT_FX_MAX_GAP_HOURS, FxCurve
+from klines import KlineStore, is_covered
+from price_series import RESOLUTION_MINUTES, PriceQuote, PriceSeriesStore, ResolutionPolicies, ResolutionPolicy
 
 logger = logging.getLogger("main")
 
+CACHE_QUERY_CHUNK_SIZE = 500
+KLINE_RANGE_LIMIT = 1000
+DEFAULT_LRU_SIZE = 100000
+DEFAULT_FAILURE_TTL_HOURS = 24 * 7
+
+
+class UnknownPriceException(Exception):
+    """
+    Price that the providers can not give (no market, unknown id...), remembered in asset_price_failure
+    """
+
+    def __init__(self, reason: str):
+        super(UnknownPriceException, self).__init__(reason)
+        self.reason = reason
+
+
+class LRUCache:
+    """
+    Memory bounded least recently used cache, with hit/miss counters, safe to share across threads
+    """
+
+    def __init__(self, max_size: int = DEFAULT_LRU_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class CurrencyExtractor:
+    """
+    Asset prices from the memory cache, the database cache, then the price providers.
 
-    def __init__(self, connection: Connection, binance_client: Client):
+    Safe to share across threads: concurrent lookups of a same price key are merged,
+    the first caller fetches and stores the price, the others wait for its result.
+    """
+
+    def __init__(self, connection: Connection, binance_client: Client, lru_size: int = DEFAULT_LRU_SIZE, fetch_config: dict = None,
+                 failure_ttl_hours: int = DEFAULT_FAILURE_TTL_HOURS, resolution_config: dict = None, fx_config: dict = None):
         self.connection = connection
+        self.policies = ResolutionPolicies(resolution_config)
+        self.failure_ttl = datetime.timedelta(hours=failure_ttl_hours)
         self.binance_client = binance_client
+        self.fetcher = PriceFetcher(binance_client, fetch_config)
+        self.kline_store = KlineStore(connection)
+        self.price_store = PriceSeriesStore(connection)
+        fx_config = fx_config or {}
+        self.fx_curve = FxCurve(connection, self.fetcher, max_gap_hours=fx_config.get("max_gap_hours", DEFAULT_FX_MAX_GAP_HOURS)) \
+            if fx_config.get("enabled", True) else None
         self.local_gecko_cache = {}
+        self.gecko_cache_lock = threading.Lock()
+        self.price_lru = LRUCache(lru_size)
+        # lookups missing the memory cache, resolved or not by the price series store
+        self.store_hits = 0
+        self.store_misses = 0
+        self.stats_lock = threading.Lock()
+        # price key -> Future of the price, for keys being resolved by a caller
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
 
     def get_gecko_token_name(self, token_name):
-        if token_name in self.local_gecko_cache.keys():
-            return self.local_gecko_cache[token_name]
+        with self.gecko_cache_lock:
+            if token_name in self.local_gecko_cache.keys():
+                return self.local_gecko_cache[token_name]
 
         with self.connection.begin() as conn:
-            sql = "SELECT * FROM asset_gecko_convert WHERE token_name like %s"
-            args = [token_name]
+            sql = "SELECT * FROM asset_gecko_convert WHERE token_name like :token_name"
+            args = {"token_name": token_name}
 
-            result = conn.execute(sql, args).mappings().fetchone()
+            result = conn.execute(text(sql), args).mappings().fetchone()
 
-            if result:
-                self.local_gecko_cache[token_name] = result["gecko_name"]
-                return self.local_gecko_cache[token_name]
+        gecko_name = result["gecko_name"] if result else token_name
+        with self.gecko_cache_lock:
+            self.local_gecko_cache[token_name] = gecko_name
+
+        return gecko_name
+
+    def get_price_key(self, asset: str, epoch_minute: int, scope: str, policy: ResolutionPolicy):
+        """
+        (scope, asset, epoch minute, resolution) a missing price is fetched and stored at
+        """
+        return scope, asset, policy.get_fetch_minute(scope, epoch_minute), policy.get_resolution(scope)
+
+    def get_failure_key(self, key: Tuple[str, str, int, str]):
+        scope, asset, epoch_minute, resolution = key
+        failure_key = "{}-{}-{}".format(from_epoch_minute(epoch_minute).strftime("%Y-%m-%d-%H-%M"), scope, asset)
+        if RESOLUTION_MINUTES[resolution] > NATIVE_RESOLUTION_MINUTES[scope]:
+            failure_key += "-" + resolution
+
+        return failure_key
 
-        return token_name
+    def get_cache_stats(self):
+        with self.stats_lock:
+            return {"lru_size": len(self.price_lru),
+                    "lru_hits": self.price_lru.hits,
+                    "lru_misses": self.price_lru.misses,
+                    "store_hits": self.store_hits,
+                    "store_misses": self.store_misses}
 
-    def get_asset_price(self, asset: str, timestamp: datetime, scope="GECKO"):
-        if asset.upper() in ["USD", "USDT"]:
-            return 1.0
+    def get_asset_price(self, asset: str, timestamp: datetime, scope="GECKO", policy: ResolutionPolicy = None):
+        request = (asset, timestamp, scope)
+        return self.get_asset_prices([request], policy=policy)[request]
+
+    def get_asset_prices(self, requests: List[Tuple[str, datetime.datetime, str]], policy: ResolutionPolicy = None):
+        """
+        Resolve many (asset, timestamp, scope) price requests at once.
+
+        Each request follows policy, or the configured policy of its scope and asset: a stored price within
+        its tolerance is reused, a missing one is fetched at its resolution. Prices are looked up in the
+        in memory price series, misses are grouped by symbol and binance misses are filled with kline
+        range calls covering many timestamps.
+        Return a dict of request -> PriceQuote.
+        """
+        prices = {}
+        requests_by_key = {}
+
+        for request in requests:
+            asset, timestamp, scope = request
+            epoch_minute = to_epoch_minute(timestamp)
+            if asset.upper() in ["USD", "USDT"]:
+                prices[request] = PriceQuote(1.0, None, epoch_minute)
+                continue
+
+            request_policy = policy or self.policies.get_policy(scope, asset)
+            lru_key = (scope, asset, epoch_minute, request_policy)
+            price = self.price_lru.get(lru_key)
+            if price is None:
+                price = self.price_store.get_quote(scope, asset, epoch_minute, request_policy)
+                with self.stats_lock:
+                    if price is not None:
+                        self.store_hits += 1
+                    else:
+                        self.store_misses += 1
+                if price is not None:
+                    self.price_lru.put(lru_key, price)
+
+            if price is not None:
+                prices[request] = price
+            else:
+                requests_by_key.setdefault(self.get_price_key(asset, epoch_minute, scope, request_policy), []).append((request, lru_key))
 
-        key = "{}-{}-{}".format(timestamp.strftime("%Y-%m-%d-%H-%M"), scope, asset)
+        if not requests_by_key:
+            return prices
+
+        # claim the keys nobody is resolving, wait for the others
+        owned_keys = {}
+        waited_keys = {}
+        with self.in_flight_lock:
+            for key in requests_by_key:
+                if key in self.in_flight:
+                    waited_keys[key] = self.in_flight[key]
+                else:
+                    owned_keys[key] = self.in_flight[key] = Future()
+
+        try:
+            key_prices, errors = self.load_prices({key: requests_by_key[key][0][0] for key in owned_keys})
+        except Exception as e:
+            key_prices, errors = {}, {key: e for key in owned_keys}
+
+        with self.in_flight_lock:
+            for key, future in owned_keys.items():
+                if key in key_prices:
+                    future.set_result(key_prices[key])
+                else:
+                    future.set_exception(errors[key])
+                del self.in_flight[key]
+
+        for key, future in waited_keys.items():
+            try:
+                key_prices[key] = future.result()
+            except Exception as e:
+                errors[key] = e
+
+        if errors:
+            raise next(iter(errors.values()))
+
+        for key, key_requests in requests_by_key.items():
+            for request, lru_key in key_requests:
+                prices[request] = key_prices[key]
+                self.price_lru.put(lru_key, key_prices[key])
+
+        return prices
+
+    def get_euro_prices(self, timestamps: List[datetime.datetime]):
+        """
+        EUR price of one USD at each timestamp, from the EUR/USD curve, else from a "euro" price lookup
+        """
+        rates = self.fx_curve.get_rates(timestamps) if self.fx_curve else [None] * len(timestamps)
+
+        missing_requests = [("euro", timestamp, "GECKO") for timestamp, rate in zip(timestamps, rates) if rate is None]
+        prices = self.get_asset_prices(missing_requests) if missing_requests else {}
+
+        return {timestamp: rate if rate is not None else prices[("euro", timestamp, "GECKO")] for timestamp, rate in zip(timestamps, rates)}
+
+    def to_euro(self, usd_amounts: List[float], timestamps: List[datetime.datetime]):
+        """
+        Convert USD amounts, each at its timestamp, to euro
+        """
+        euro_prices = self.get_euro_prices(timestamps)
+        return array("d", [amount * euro_prices[timestamp] for amount, timestamp in zip(usd_amounts, timestamps)])
+
+    def load_prices(self, requests_by_key: Dict[Tuple[str, str, int, str], Tuple[str, datetime.datetime, str]]):
+        """
+        Resolve claimed price keys from the price series store, then from the price providers.
+        Keys that recently failed for good are not requested again before failure_ttl.
+        Fetched prices and new failures are stored before returning (prices by key, errors by key).
+        """
+        if not requests_by_key:
+            return {}, {}
+
+        prices = self.price_store.get_prices(list(requests_by_key.keys()))
+        previous_failures = self.get_price_failures([key for key in requests_by_key if key not in prices])
+        expiration = datetime.datetime.utcnow() - self.failure_ttl
+
+        errors = {}
+        missing_requests = {}
+        for key, request in requests_by_key.items():
+            if key in prices:
+                continue
+
+            failure = previous_failures.get(key)
+            if failure and failure["failure_datetime"] >= expiration:
+                errors[key] = UnknownPriceException("{} (known failure since {})".format(failure["reason"], failure["failure_datetime"]))
+            else:
+                missing_requests[key] = request
+
+        fetched_prices, fetch_errors = self.query_asset_prices(missing_requests)
+        self.price_store.save_prices(fetched_prices)
+        self.save_price_failures({key: (missing_requests[key], error) for key, error in fetch_errors.items() if isinstance(error, UnknownPriceException)},
+                                 previous_failures, fetched_prices)
+        errors.update(fetch_errors)
+
+        prices.update(fetched_prices)
+
+        return prices, errors
+
+    def get_price_failures(self, keys: List[Tuple[str, str, int, str]]):
+        failures = {}
+        if not keys:
+            return failures
+
+        keys_by_failure_key = {self.get_failure_key(key): key for key in keys}
+        failure_keys = list(keys_by_failure_key.keys())
 
         with self.connection.begin() as conn:
-            sql = "SELECT price FROM asset_price_cache WHERE `key` = %s"
-            args = [key]
+            sql = text("SELECT * FROM asset_price_failure WHERE `key` IN :keys").bindparams(bindparam("keys", expanding=True))
+
+            for i in range(0, len(failure_keys), CACHE_QUERY_CHUNK_SIZE):
+                args = {"keys": failure_keys[i:i + CACHE_QUERY_CHUNK_SIZE]}
+
+                for res in conn.execute(sql, args).mappings().all():
+                    failures[keys_by_failure_key[res["key"]]] = res
 
-            result = conn.execute(sql, args).mappings().fetchone()
+        return failures
+
+    def save_price_failures(self, failures, previous_failures, resolved_keys):
+        """
+        Record (request, UnknownPriceException) failures by key, a previous failure of the key is replaced
+        """
+        # previous failures of retried keys are outdated, whether the retry succeeded or failed again
+        outdated_keys = [key for key in previous_failures if key in failures or key in resolved_keys]
+        if not failures and not outdated_keys:
+            return
+
+        with self.connection.begin() as conn:
+            sql = "DELETE FROM asset_price_failure WHERE `key` = :key"
+            with BatchWriter(conn, sql) as writer:
+                for key in outdated_keys:
+                    writer.add({"key": self.get_failure_key(key)})
 
-            if result:
-                return result["price"]
+            sql = "INSERT INTO asset_price_failure (`key`, scope,  asset,  price_datetime,  reason,  failure_datetime,  attempts)" \
+                  "                         VALUES (:key,  :scope, :asset, :price_datetime, :reason, :failure_datetime, :attempts)"
+            with BatchWriter(conn, sql) as writer:
+                for key, ((asset, timestamp, scope), error) in failures.items():
+                    writer.add({"key": self.get_failure_key(key),
+                                "scope": scope,
+                                "asset": asset,
+                                "price_datetime": timestamp.replace(second=0, microsecond=0),
+                                "reason": str(error.reason)[:1024],
+                                "failure_datetime": datetime.datetime.utcnow(),
+                                "attempts": previous_failures[key]["attempts"] + 1 if key in previous_failures else 1})
+
+    def get_unresolved_prices(self):
+        with self.connection.connect() as conn:
+            sql = "SELECT * FROM asset_price_failure ORDER BY scope ASC, asset ASC, price_datetime ASC"
+
+            result = conn.execute(text(sql)).mappings().all()
+            return result
+
+    def clean_unresolved_prices(self):
+        with self.connection.begin() as conn:
+            sql = "DELETE FROM asset_price_failure"
+            conn.execute(text(sql))
+
+    def query_asset_prices(self, requests_by_key: Dict[Tuple[str, str, int, str], Tuple[str, datetime.datetime, str]]):
+        """
+        Fetch missing prices with concurrent provider calls: one coingecko call per key,
+        one binance kline range call per window of timestamps of a symbol not covered by the imported klines.
+        Keys at a coarse resolution are priced with the candle starting at their epoch minute.
+        Return (PriceQuote by key, errors by key).
+        """
+        prices = {}
+        errors = {}
+        calls = []
+        call_targets = []
+        binance_requests = {}
+        coarse_binance_requests = {}
+
+        for key, (asset, timestamp, scope) in requests_by_key.items():
+            _, _, epoch_minute, resolution = key
+            coarse = RESOLUTION_MINUTES[resolution] > NATIVE_RESOLUTION_MINUTES[scope]
+            if coarse:
+                timestamp = from_epoch_minute(epoch_minute)
+
+            if scope == "GECKO":
+                calls.append(self.get_coingecko_call(asset, timestamp))
+                call_targets.append((scope, asset, [(key, timestamp)]))
+            elif scope == "BINANCE" and coarse:
+                coarse_binance_requests.setdefault((asset, resolution), []).append((key, timestamp))
+            elif scope == "BINANCE":
+                binance_requests.setdefault(asset, []).append((key, timestamp))
+
+        for asset, key_timestamps in binance_requests.items():
+            local_prices, local_errors, key_timestamps = self.query_local_kline_prices(asset, key_timestamps)
+            prices.update(local_prices)
+            errors.update(local_errors)
+
+            for window in self.get_kline_windows(sorted(key_timestamps, key=lambda key_timestamp: key_timestamp[1])):
+                calls.append(self.get_binance_call(asset, [timestamp for _, timestamp in window]))
+                call_targets.append(("BINANCE", asset, window))
+
+        for (asset, resolution), key_timestamps in coarse_binance_requests.items():
+            for window in self.get_kline_windows(sorted(key_timestamps, key=lambda key_timestamp: key_timestamp[1]), 0, RESOLUTION_MINUTES[resolution]):
+                calls.append(self.get_binance_call(asset, [timestamp for _, timestamp in window], 0, resolution))
+                call_targets.append(("BINANCE", asset, window))
+
+        for (scope, asset, key_timestamps), (_, _, call_args), result in zip(call_targets, calls, self.fetcher.run(calls)):
+            if isinstance(result, Exception):
+                status = get_status_code(result)
+                # a client error other than a rate limit (unknown id, invalid symbol) will not succeed on retry
+                if status is not None and 400 <= status < 500 and status not in RATE_LIMIT_STATUS:
+                    result = UnknownPriceException("{} {} error: {}".format(scope, status, result))
+
+                for key, _ in key_timestamps:
+                    errors[key] = result
+                continue
+
+            if scope == "GECKO":
+                key, timestamp = key_timestamps[0]
+                try:
+                    prices[key] = self.parse_coingecko_price(asset, timestamp, result)
+                except Exception as e:
+                    errors[key] = e
             else:
-                if scope == "GECKO":
-                    price = self.query_coingecko_asset_price(asset, timestamp)
-                elif scope == "BINANCE":
-                    price = self.query_binance_asset_price(asset, timestamp)
-
-                sql = "INSERT INTO asset_price_cache (`key`, price)" \
-                      "                       VALUES (%s,  %s   )"
-                conn.execute(sql, [key, price])
-
-                return price
-
-    # TODO: coingecko api is limit rated... use binance api instead
-    @retry(stop=stop_after_attempt(10), wait=wait_fixed(2), reraise=True)
-    def query_coingecko_asset_price(self, asset: str, timestamp: datetime, fiat: str = "usd"):
-        asset = self.get_gecko_token_name(asset)
-        logger.debug("Requesting price of {} at {}".format(asset, timestamp))
-
-        if asset == "euro":
-            return self.query_coingecko_asset_price("tether", timestamp, fiat="eur")
-        else:
-            cg = CoinGeckoAPI()
-            data = cg.get_coin_history_by_id(asset, timestamp.strftime("%d-%m-%Y %H:%M:%S"), localization='false')
-            price = data["market_data"]["current_price"][fiat]
-            logger.debug("{} is {} at {}".format(asset, price, timestamp))
-            return float(price)
+                resolution = call_args[4]
+                timestamps = [timestamp for _, timestamp in key_timestamps]
+                if RESOLUTION_MINUTES[resolution] > NATIVE_RESOLUTION_MINUTES[scope]:
+                    window_prices = self.parse_candle_prices(result, timestamps, RESOLUTION_MINUTES[resolution])
+                else:
+                    # every returned candle is kept, later lookups of this range are answered locally
+                    self.kline_store.save_api_klines(result, *call_args[:3])
+                    window_prices = self.parse_kline_prices(result, timestamps)
+
+                for key, timestamp in key_timestamps:
+                    if timestamp in window_prices:
+                        prices[key] = window_prices[timestamp]
+                    else:
+                        errors[key] = UnknownPriceException("Unable to guess price from {} at {}".format(asset.upper()+"USDT", timestamp))
+
+        return {key: PriceQuote(price, key[3], key[2]) for key, price in prices.items()}, errors
+
+    def query_local_kline_prices(self, asset: str, key_timestamps: List[Tuple[str, datetime.datetime]], delta_minutes=10):
+        """
+        Price (key, timestamp) covered by the imported klines.
+        Return (prices by key, errors by key, (key, timestamp) left to the binance api).
+        """
+        symbol = asset.upper()+"USDT"
+        ranges = self.kline_store.get_covered_ranges(symbol)
+        if not ranges:
+            return {}, {}, key_timestamps
+
+        delta = datetime.timedelta(minutes=delta_minutes)
+        covered = []
+        remaining = []
+        for key, timestamp in key_timestamps:
+            if is_covered(ranges, to_milliseconds(timestamp), to_milliseconds(timestamp + delta)):
+                covered.append((key, timestamp))
+            else:
+                remaining.append((key, timestamp))
+
+        prices = {}
+        errors = {}
+        for window in self.get_kline_windows(sorted(covered, key=lambda key_timestamp: key_timestamp[1]), delta_minutes):
+            timestamps = [timestamp for _, timestamp in window]
+            klines = self.kline_store.get_klines(symbol, to_milliseconds(timestamps[0]), to_milliseconds(timestamps[-1] + delta))
+            window_prices = self.parse_kline_prices(klines, timestamps, delta_minutes)
+
+            for key, timestamp in window:
+                if timestamp in window_prices:
+                    prices[key] = window_prices[timestamp]
+                else:
+                    errors[key] = UnknownPriceException("Unable to guess price from {} at {} (imported klines)".format(symbol, timestamp))
+
+        return prices, errors, remaining
+
+    def get_coingecko_call(self, asset: str, timestamp: datetime):
+        gecko_asset = self.get_gecko_token_name(asset)
+        # euro is priced from tether in eur
+        if gecko_asset == "euro":
+            gecko_asset = "tether"
+
+        logger.debug("Requesting price of {} at {}".format(gecko_asset, timestamp))
+        return "GECKO", self.fetcher.get_coin_history, (gecko_asset, timestamp.strftime("%d-%m-%Y %H:%M:%S"))
+
+    def parse_coingecko_price(self, asset: str, timestamp: datetime, data):
+        fiat = "eur" if self.get_gecko_token_name(asset) == "euro" else "usd"
+        if "market_data" not in data:
+            raise UnknownPriceException("No coingecko market data for {} at {}".format(asset, timestamp))
+
+        price = data["market_data"]["current_price"][fiat]
+        logger.debug("{} is {} at {}".format(asset, price, timestamp))
+        return float(price)
+
+    def query_coingecko_asset_price(self, asset: str, timestamp: datetime):
+        result = self.fetcher.run([self.get_coingecko_call(asset, timestamp)])[0]
+        if isinstance(result, Exception):
+            raise result
+
+        return self.parse_coingecko_price(asset, timestamp, result)
 
     def query_binance_asset_price(self, asset: str, timestamp: datetime, delta_minutes=10):
-        asset = asset.upper()+"USDT"
-        logger.debug("Requesting price of {} at {}".format(asset, timestamp))
-        start_date = timestamp
-        end_date = start_date + datetime.timedelta(minutes=delta_minutes)
+        prices = self.query_binance_asset_prices(asset, [timestamp], delta_minutes=delta_minutes)
+
+        if timestamp not in prices:
+            raise UnknownPriceException("Unable to guess price from {} at {}".format(asset.upper()+"USDT", timestamp))
+
+        return prices[timestamp]
+
+    def query_binance_asset_prices(self, asset: str, timestamps: List[datetime.datetime], delta_minutes=10):
+        """
+        Price each timestamp with the first 3 minutes kline opened in [timestamp, timestamp + delta_minutes].
+        Timestamps without kline are missing from the returned dict.
+        """
+        windows = [[timestamp for _, timestamp in window]
+                   for window in self.get_kline_windows([(None, timestamp) for timestamp in sorted(set(timestamps))], delta_minutes)]
+        results = self.fetcher.run([self.get_binance_call(asset, window, delta_minutes) for window in windows])
+
+        prices = {}
+        for window, result in zip(windows, results):
+            if isinstance(result, Exception):
+                raise result
+            prices.update(self.parse_kline_prices(result, window, delta_minutes))
+
+        return prices
+
+    def get_kline_windows(self, key_timestamps: List[Tuple[str, datetime.datetime]], delta_minutes=10, interval_minutes=3):
+        """
+        Pack (key, timestamp) sorted by timestamp into windows of at most KLINE_RANGE_LIMIT klines,
+        so a single kline range call covers every timestamp of a window
+        """
+        delta = datetime.timedelta(minutes=delta_minutes)
+        max_window = datetime.timedelta(minutes=interval_minutes * (KLINE_RANGE_LIMIT - 1))
+        timestamps = [timestamp for _, timestamp in key_timestamps]
+
+        windows = []
+        first = 0
+        while first < len(key_timestamps):
+            last = bisect_right(timestamps, timestamps[first] + max_window - delta, first + 1)
+            windows.append(key_timestamps[first:last])
+            first = last
+
+        return windows
+
+    def get_binance_call(self, asset: str, window: List[datetime.datetime], delta_minutes=10, resolution="3m"):
+        symbol = asset.upper()+"USDT"
+        start_date = window[0]
+        end_date = window[-1] + datetime.timedelta(minutes=delta_minutes)
+
+        logger.debug("Requesting {} price of {} from {} to {} ({} timestamps)".format(resolution, symbol, start_date, end_date, len(window)))
+        return "BINANCE", self.fetcher.get_klines, (symbol, to_milliseconds(start_date), to_milliseconds(end_date), KLINE_RANGE_LIMIT, resolution)
+
+    def parse_candle_prices(self, klines, window: List[datetime.datetime], interval_minutes: int):
+        """
+        Price each timestamp with the kline containing it, coarse keys are priced at the open of their candle
+        """
+        interval = interval_minutes * 60 * 1000
+        open_times = [kline[0] for kline in klines]
+
+        prices = {}
+        for timestamp in window:
+            i = bisect_right(open_times, to_milliseconds(timestamp)) - 1
+            if i >= 0 and to_milliseconds(timestamp) < open_times[i] + interval:
+                kline = klines[i]
+                prices[timestamp] = float(float(kline[1])+float(kline[2])+float(kline[3])+float(kline[4]))/4
 
-        klines = self.binance_client.get_historical_klines(asset,
-                                                       Client.KLINE_INTERVAL_3MINUTE,
-                                                       str(start_date.timestamp()),
-                                                       str(end_date.timestamp()))
-        if not klines:
-            raise Exception("Unable to guess price from {} at {}".format(asset, timestamp))
+        return prices
 
-        return float(float(klines[0][1])+float(klines[0][2])+float(klines[0][3])+float(klines[0][4]))/4
+    def parse_kline_prices(self, klines, window: List[datetime.datetime], delta_minutes=10):
+        delta = datetime.timedelta(minutes=delta_minutes)
+        open_times = [kline[0] for kline in klines]
+
+        prices = {}
+        for timestamp in window:
+            i = bisect_left(open_times, to_milliseconds(timestamp))
+            if i < len(klines) and open_times[i] <= to_milliseconds(timestamp + delta):
+                kline = klines[i]
+                prices[timestamp] = float(float(kline[1])+float(kline[2])+float(kline[3])+float(kline[4]))/4
+
+        return prices
+
+
+def to_milliseconds(timestamp: datetime.datetime):
+    return int(timestamp.timestamp() * 1000)
 
 
 def boot_db(dialect: str, engine: Connection):
@@ -96,4 +564,35 @@ def boot_db(dialect: str, engine: Connection):
         creation_steps = BOOT_DB_REQUEST[dialect]
 
         for step in creation_steps:
-            conn.execute(step)
+            conn.execute(text(step))
+
+        set_schema_version(conn, SCHEMA_VERSION)
+
+
+def migrate_db(dialect: str, engine: Connection):
+    """
+    Upgrade an existing database in place, without dropping any data
+    """
+    with engine.begin() as conn:
+        conn.execute(text(SCHEMA_VERSION_REQUEST[dialect]))
+        result = conn.execute(text("SELECT MAX(version) AS version FROM schema_version")).mappings().fetchone()
+        current_version = result["version"] if result["version"] else 1
+
+        if current_version >= SCHEMA_VERSION:
+            logger.info("Database schema is up to date (version {})".format(current_version))
+            return
+
+        for version in range(current_version + 1, SCHEMA_VERSION + 1):
+            logger.info("Migrate database schema to version {}".format(version))
+            for step in MIGRATE_DB_REQUEST[dialect][version]:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(text(step))
+
+            set_schema_version(conn, version)
+
+
+def set_schema_version(conn, version: int):
+    conn.execute(text("DELETE FROM schema_version"))
+    conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": version})
@@ -0,0 +1,82 @@
+import csv
+import os
+import sys
+
+import pytest
+from openpyxl import Workbook
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from database import create_db_engine  # noqa: E402
+from utils import CurrencyExtractor, boot_db  # noqa: E402
+
+
+def create_sqlite_engine(path):
+    return create_db_engine({"database_dialect": "sqlite", "database_uri": "sqlite:///{}".format(path)})
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    Empty sqlite database with the current schema
+    """
+    engine = create_sqlite_engine(tmp_path / "cryptotax.db")
+    boot_db("sqlite", engine)
+    return engine
+
+
+class StubCurrencyExtractor(CurrencyExtractor):
+    """
+    Currency extractor answering every price and EUR/USD rate with a constant, no provider is called
+    """
+
+    def __init__(self, engine, asset_price: float = 20000.0, euro_price: float = 0.9):
+        super(StubCurrencyExtractor, self).__init__(engine, None, fx_config={"enabled": False})
+        self.asset_price = asset_price
+        self.euro_price = euro_price
+
+    def get_asset_prices(self, requests, policy=None):
+        return {request: self.asset_price for request in requests}
+
+    def get_euro_prices(self, timestamps):
+        return {timestamp: self.euro_price for timestamp in timestamps}
+
+
+@pytest.fixture
+def currency_extractor(engine):
+    return StubCurrencyExtractor(engine)
+
+
+BINANCE_HEADER = ["UTC_Time", "Account", "Operation", "Coin", "Change", "Remark"]
+
+
+def write_binance_statement(path, rows):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(BINANCE_HEADER)
+        writer.writerows(rows)
+
+    return str(path)
+
+
+def write_etoro_statement(path, close_rows, transaction_rows=()):
+    workbook = Workbook()
+    workbook.active.title = "Closed Positions"
+    workbook.active.append(["Position ID", "Action", "Copy Trader Name", "Amount", "Units", "Open Rate", "Close Rate",
+                            "Spread", "Profit", "Open Date", "Close Date"])
+    for row in close_rows:
+        workbook.active.append(row)
+
+    transactions = workbook.create_sheet("Transactions Report")
+    transactions.append(["Date", "Account Balance", "Type", "Details", "Position ID", "Amount"])
+    for row in transaction_rows:
+        transactions.append(row)
+
+    workbook.save(path)
+    return str(path)
+
+
+def count_rows(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT COUNT(*) FROM {}".format(table))).scalar()
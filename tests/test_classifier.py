@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from conftest import write_binance_statement
+from exchange.binance import BinanceTaxExtractor
+from exchange.coinbase import CoinbaseTaxExtractor
+from test_load import load_binance
+
+TIMESTAMP = datetime(2021, 1, 1, 10, 0)
+
+
+def binance_operation(operation, coin, change, account="Spot"):
+    return {"operation_datetime": TIMESTAMP, "account": account, "operation": operation, "coin": coin, "change": change, "remark": ""}
+
+
+def coinbase_operation(operation, coin, quantity, note=""):
+    return {"operation_datetime": TIMESTAMP, "operation": operation, "coin": coin, "quantity": quantity,
+            "spot_price": 1.0, "amount_price": 1.0, "note": note}
+
+
+@pytest.mark.parametrize("raw_operation, expected", [
+    (binance_operation("Deposit", "BTC", 0.5), [(TIMESTAMP, "BTC", 0.5, "BUY")]),
+    (binance_operation("Sell", "BTC", -0.5), [(TIMESTAMP, "BTC", -0.5, "SELL")]),
+    (binance_operation("Fee", "BNB", -0.01), [(TIMESTAMP, "BNB", -0.01, "SELL")]),
+    (binance_operation("Distribution", "ADA", 3.0), [(TIMESTAMP, "ADA", 3.0, "BUY")]),
+    # operations are matched without case
+    (binance_operation("savings interest", "USDT", 0.1), [(TIMESTAMP, "USDT", 0.1, "BUY")]),
+    # fiat is in the fiat history, other accounts and operations are ignored
+    (binance_operation("Deposit", "EUR", 100.0), []),
+    (binance_operation("Deposit", "BTC", 0.5, account="Savings"), []),
+    (binance_operation("Transfer Between Main and Funding Wallet", "BTC", 0.5), []),
+])
+def test_binance_rules(engine, currency_extractor, raw_operation, expected):
+    extractor = BinanceTaxExtractor(engine, currency_extractor)
+    assert extractor.classify_operation(raw_operation, extractor.get_operation_rules()) == expected
+
+
+@pytest.mark.parametrize("raw_operation, expected", [
+    (coinbase_operation("Buy", "BTC", 0.5), [(TIMESTAMP, "BTC", 0.5, "BUY")]),
+    (coinbase_operation("Sell", "BTC", 0.5), [(TIMESTAMP, "BTC", -0.5, "SELL")]),
+    (coinbase_operation("Send", "ETH", 2.0), [(TIMESTAMP, "ETH", -2.0, "SELL")]),
+    (coinbase_operation("Coinbase Earn", "XLM", 10.0), [(TIMESTAMP, "XLM", 10.0, "BUY")]),
+    # a convert sells the coin and buys the one of its note
+    (coinbase_operation("Convert", "BTC", 0.5, "Converted 0,5 BTC to 10,25 ETH"),
+     [(TIMESTAMP, "BTC", -0.5, "SELL"), (TIMESTAMP, "ETH", 10.25, "BUY")]),
+    (coinbase_operation("Rewards Income", "ETH", 0.1), []),
+])
+def test_coinbase_rules(engine, currency_extractor, raw_operation, expected):
+    extractor = CoinbaseTaxExtractor(engine, currency_extractor)
+    assert extractor.classify_operation(raw_operation, extractor.get_operation_rules()) == expected
+
+
+def test_crypto_history_only_classifies_the_current_load(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Buy", "BTC", "0.003", ""],
+            ["2021-01-01 10:00:00", "Spot", "Deposit", "EUR", "100.00", ""]]
+    load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "first.csv", rows)).extract_crypto_history()
+
+    rows += [["2021-01-02 10:00:00", "Spot", "Sell", "BTC", "-0.001", ""]]
+    load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "second.csv", rows)).extract_crypto_history()
+
+    with engine.connect() as conn:
+        result = conn.execute(text("SELECT asset, amount_asset, operation FROM binance_crypto_history ORDER BY id ASC")).fetchall()
+    assert [tuple(res) for res in result] == [("BTC", 0.003, "BUY"), ("BTC", -0.001, "SELL")]
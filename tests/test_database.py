@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import text
+
+from database import BatchWriter
+
+
+class RecordingConnection:
+    """
+    Connection keeping the rows of each executemany instead of running it
+    """
+
+    def __init__(self):
+        self.executions = []
+
+    def execute(self, sql, rows):
+        self.executions.append(list(rows))
+
+
+def test_rows_are_flushed_by_batch():
+    conn = RecordingConnection()
+    with BatchWriter(conn, "INSERT INTO t (a) VALUES (:a)", batch_size=2) as writer:
+        for a in range(5):
+            writer.add({"a": a})
+        assert [len(rows) for rows in conn.executions] == [2, 2]
+
+    # the last partial batch is flushed on exit
+    assert [len(rows) for rows in conn.executions] == [2, 2, 1]
+    assert writer.count == 5
+
+
+def test_empty_writer_executes_nothing():
+    conn = RecordingConnection()
+    with BatchWriter(conn, "INSERT INTO t (a) VALUES (:a)") as writer:
+        writer.flush()
+
+    assert conn.executions == []
+    assert writer.count == 0
+
+
+def test_pending_rows_are_dropped_on_error():
+    conn = RecordingConnection()
+    with pytest.raises(ValueError):
+        with BatchWriter(conn, "INSERT INTO t (a) VALUES (:a)", batch_size=10) as writer:
+            writer.add({"a": 1})
+            raise ValueError()
+
+    assert conn.executions == []
+
+
+def test_rows_are_written_in_the_transaction(engine):
+    with pytest.raises(ValueError):
+        with engine.begin() as conn, BatchWriter(conn, "INSERT INTO asset_gecko_convert (token_name, gecko_name) VALUES (:token_name, :gecko_name)", batch_size=1) as writer:
+            writer.add({"token_name": "btc", "gecko_name": "bitcoin"})
+            raise ValueError()
+
+    # flushed rows are rolled back with their transaction
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM asset_gecko_convert")).scalar() == 0
@@ -0,0 +1,143 @@
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal, localcontext
+
+import pytest
+
+from disposal import DisposalEngine
+
+FIELDS = ["current_portfolio_value", "disposal_price", "current_total_purchase", "current_previous_disposed_purchase",
+          "current_balanced_purchase", "profit_and_loss"]
+
+
+def real_round(value: Decimal, digit: int = 2):
+    return Decimal(str(round(value, digit)))
+
+
+def get_reference_disposals(sales):
+    """
+    Disposals of (datetime, portfolio value, disposal price, total purchase) sales, computed with Decimal
+    rounded at each step as the report did before DisposalEngine
+    """
+    all_disposals = []
+    global_pnl = 0
+
+    for sale_datetime, current_portfolio_value, disposal_price, all_cash_in in sales:
+        disposal = {"disposal_datetime": sale_datetime,
+                    "current_portfolio_value": real_round(Decimal(current_portfolio_value)),
+                    "disposal_price": real_round(Decimal(disposal_price)),
+                    "current_total_purchase": real_round(Decimal(all_cash_in))}
+
+        if all_disposals:
+            previous_disposal = all_disposals[-1]
+            current_previous_disposed_purchase = previous_disposal["current_balanced_purchase"] * previous_disposal["disposal_price"] / previous_disposal["current_portfolio_value"]
+            disposal["current_previous_disposed_purchase"] = real_round(Decimal(current_previous_disposed_purchase + previous_disposal["current_previous_disposed_purchase"]))
+        else:
+            disposal["current_previous_disposed_purchase"] = 0
+
+        disposal["current_balanced_purchase"] = real_round(Decimal(disposal["current_total_purchase"] - disposal["current_previous_disposed_purchase"]))
+        disposal["profit_and_loss"] = real_round(Decimal(disposal["disposal_price"] - (disposal["current_balanced_purchase"] * disposal["disposal_price"] / disposal["current_portfolio_value"])))
+
+        global_pnl += real_round(Decimal(disposal["profit_and_loss"]))
+
+        all_disposals.append(disposal)
+
+    return all_disposals, global_pnl
+
+
+def get_engine_disposals(sales):
+    engine = DisposalEngine()
+    for sale in sales:
+        engine.add(*sale)
+    engine.compute()
+
+    return engine.get_disposals(), engine.get_global_pnl()
+
+
+def assert_same_disposals(disposals, reference_disposals):
+    assert len(disposals) == len(reference_disposals)
+    for disposal, reference in zip(disposals, reference_disposals):
+        for field in FIELDS:
+            # str() keeps the sign of zeros, only an exact zero may differ: the engine prints it "0.00"
+            assert str(disposal[field]) == str(reference[field]) or disposal[field] == reference[field] == 0, \
+                "{} of disposal {}".format(field, reference["disposal_datetime"])
+
+
+def get_random_amount(rand: random.Random, scale: float):
+    choice = rand.random()
+    if choice < 0.05:
+        return 0.0
+    if choice < 0.1:
+        return -0.0
+    if choice < 0.15:
+        # rounds to a zero of either sign
+        return rand.uniform(-0.004, 0.004)
+    if choice < 0.25:
+        return -rand.uniform(0, scale)
+    return rand.uniform(0, scale)
+
+
+def get_random_sales(rand: random.Random, count: int):
+    begin = datetime(2021, 1, 1)
+    sales = []
+    for i in range(count):
+        portfolio_value = rand.uniform(0.01, 50000.0) if rand.random() < 0.95 else -rand.uniform(0.01, 50000.0)
+        sales.append((begin + timedelta(hours=i), portfolio_value, get_random_amount(rand, 10000.0), get_random_amount(rand, 100000.0)))
+
+    return sales
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_engine_matches_decimal_reference(seed):
+    sales = get_random_sales(random.Random(seed), 200)
+
+    disposals, global_pnl = get_engine_disposals(sales)
+    reference_disposals, reference_global_pnl = get_reference_disposals(sales)
+
+    assert_same_disposals(disposals, reference_disposals)
+    assert global_pnl == reference_global_pnl
+
+
+def test_engine_keeps_amounts_beyond_64_bits():
+    # disposals far above the portfolio value make the disposed purchase grow past int64 cents
+    begin = datetime(2021, 1, 1)
+    sales = [(begin + timedelta(days=i), 0.5, 1e9, 1e9 * (i + 1)) for i in range(6)]
+
+    disposals, global_pnl = get_engine_disposals(sales)
+    with localcontext() as context:
+        context.prec = 200
+        reference_disposals, reference_global_pnl = get_reference_disposals(sales)
+
+    assert abs(disposals[-1]["current_previous_disposed_purchase"]) > 2 ** 63 / 100
+    assert_same_disposals(disposals, reference_disposals)
+    assert global_pnl == reference_global_pnl
+
+
+def test_zero_portfolio_value_is_reported():
+    engine = DisposalEngine()
+    engine.add(datetime(2021, 1, 1), 0.001, 100.0, 100.0)
+
+    with pytest.raises(Exception, match="Portfolio value is zero"):
+        engine.compute()
+
+
+def test_negative_values_rounded_to_zero_keep_their_sign():
+    begin = datetime(2021, 1, 1)
+    # purchase share of the first disposal: -0.30 * 0.01 / 1.00 = -0.003
+    # profit and loss of the second one: 0.01 - 140.00 * 0.01 / 100.00 = -0.004
+    sales = [(begin, 1.0, 0.01, -0.3), (begin + timedelta(days=1), 100.0, 0.01, 140.0), (begin + timedelta(days=2), 100.0, -0.004, 140.0)]
+
+    disposals, _ = get_engine_disposals(sales)
+    reference_disposals, _ = get_reference_disposals(sales)
+
+    assert str(disposals[1]["current_previous_disposed_purchase"]) == "-0.00"
+    assert str(disposals[1]["profit_and_loss"]) == "-0.00"
+    assert str(disposals[2]["disposal_price"]) == "-0.00"
+    assert_same_disposals(disposals, reference_disposals)
+
+
+@pytest.mark.parametrize("disposal_price", [0.0, -0.0])
+def test_exact_zero_is_positive(disposal_price):
+    disposals, _ = get_engine_disposals([(datetime(2021, 1, 1), 100.0, disposal_price, -5.0)])
+
+    assert str(disposals[0]["profit_and_loss"]) == "0.00"
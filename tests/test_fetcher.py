@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetcher import PriceFetcher
+
+
+class StandInProvider:
+    """
+    Local HTTP stand-in of coingecko: answers coin history calls with a price derived from the coin id, after a delay.
+    Scripted (status, headers, body) responses are served first, in order, then every call succeeds
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.responses = []
+        self.arrivals = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                provider.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.server.server_address[1])
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        with self.lock:
+            self.arrivals.append(time.monotonic())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            response = self.responses.pop(0) if self.responses else None
+
+        time.sleep(self.delay)
+        if response is None:
+            coin_id = request.path.split("/")[2]
+            response = (200, {}, json.dumps({"market_data": {"current_price": {"usd": float(coin_id.split("-")[-1])}}}))
+
+        status, headers, body = response
+        request.send_response(status)
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body.encode())
+
+        with self.lock:
+            self.in_flight -= 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def provider():
+    provider = StandInProvider()
+    yield provider
+    provider.close()
+
+
+def get_fetcher(provider, rate=100.0, burst=20, workers=8):
+    return PriceFetcher(None, {"workers": workers, "min_backoff": 0.2, "max_retries": 4,
+                               "gecko": {"url": provider.url, "rate": rate, "burst": burst}})
+
+
+def get_calls(fetcher, count):
+    return [("GECKO", fetcher.get_coin_history, ("coin-{}".format(i), "01-01-2021 10:00:00")) for i in range(count)]
+
+
+def test_calls_are_concurrent_and_ordered(provider):
+    provider.delay = 0.2
+    fetcher = get_fetcher(provider)
+
+    started = time.monotonic()
+    results = fetcher.run(get_calls(fetcher, 8))
+
+    assert [result["market_data"]["current_price"]["usd"] for result in results] == [float(i) for i in range(8)]
+    assert provider.max_in_flight > 1
+    assert time.monotonic() - started < 8 * provider.delay
+
+
+def test_token_bucket_paces_the_calls(provider):
+    fetcher = get_fetcher(provider, rate=20.0, burst=1)
+
+    fetcher.run(get_calls(fetcher, 10))
+
+    # one call at once, then one every 1 / rate second
+    arrivals = sorted(provider.arrivals)
+    assert arrivals[-1] - arrivals[0] >= 9 / 20.0 * 0.9
+    assert fetcher.get_stats()["GECKO"]["throttle_wait_seconds"] > 0
+
+
+@pytest.mark.parametrize("status, headers, body, min_wait", [
+    # coingecko returns its rate limit as a json error body
+    (429, {}, json.dumps({"status": {"error_code": 429, "error_message": "rate limited"}}), 0.2),
+    (418, {"Retry-After": "0.5"}, "banned", 0.5),
+])
+def test_rate_limit_pauses_and_halves_the_rate(provider, status, headers, body, min_wait):
+    provider.responses = [(status, headers, body)]
+    fetcher = get_fetcher(provider)
+
+    result = fetcher.run(get_calls(fetcher, 1))[0]
+
+    assert result["market_data"]["current_price"]["usd"] == 0.0
+    assert provider.arrivals[1] - provider.arrivals[0] >= min_wait * 0.9
+    # halved by the pause, then recovering by 1/16 of the rate on the successful retry
+    bucket = fetcher.limiters["GECKO"].bucket
+    assert bucket.rate == pytest.approx(100.0 / 2 + 100.0 / 16)
+    assert fetcher.get_stats()["GECKO"]["retries"] == 1
+
+
+def test_server_errors_are_retried(provider):
+    provider.responses = [(500, {}, "error"), (500, {}, "error")]
+    fetcher = get_fetcher(provider)
+
+    result = fetcher.run(get_calls(fetcher, 1))[0]
+
+    assert result["market_data"]["current_price"]["usd"] == 0.0
+    stats = fetcher.get_stats()["GECKO"]
+    assert (stats["calls"], stats["retries"], stats["failures"]) == (3, 2, 0)
+    assert fetcher.limiters["GECKO"].bucket.rate == 100.0
+
+
+def test_client_errors_are_not_retried(provider):
+    provider.responses = [(404, {}, json.dumps({"error": "coin not found"}))]
+    fetcher = get_fetcher(provider)
+
+    result = fetcher.run(get_calls(fetcher, 1))[0]
+
+    assert isinstance(result, Exception)
+    stats = fetcher.get_stats()["GECKO"]
+    assert (stats["calls"], stats["retries"], stats["failures"]) == (1, 0, 1)
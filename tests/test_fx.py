@@ -0,0 +1,52 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from database import to_epoch_minute
+from fx import FxCurve
+
+
+class StubChartFetcher:
+    """
+    Fetcher answering coingecko market chart range calls with an hourly constant rate, slowly
+    """
+
+    def __init__(self, rate: float = 0.9, delay: float = 0.05):
+        self.rate = rate
+        self.delay = delay
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get_coin_market_chart_range(self, coin_id, currency, from_timestamp, to_timestamp):
+        with self.lock:
+            self.ranges.append((from_timestamp, to_timestamp))
+        time.sleep(self.delay)
+        return {"prices": [[timestamp * 1000, self.rate] for timestamp in range(from_timestamp - from_timestamp % 3600, to_timestamp, 3600)]}
+
+    def run(self, calls):
+        return [fn(*args) for _, fn, args in calls]
+
+
+def test_fetched_ranges_stay_hourly(engine):
+    fetcher = StubChartFetcher(delay=0)
+    curve = FxCurve(engine, fetcher)
+
+    timestamps = [datetime(2021, 1, 1) + timedelta(days=day) for day in range(0, 365, 5)]
+    assert curve.get_rates(timestamps) == [0.9] * len(timestamps)
+
+    # coingecko only returns hourly points for ranges of at most 90 days, padding included
+    assert len(fetcher.ranges) >= 4
+    assert all(to_timestamp - from_timestamp <= 90 * 24 * 3600 for from_timestamp, to_timestamp in fetcher.ranges)
+
+
+def test_concurrent_ensure_fetches_each_block_once(engine):
+    fetcher = StubChartFetcher()
+    curve = FxCurve(engine, fetcher)
+    epoch_minutes = [to_epoch_minute(datetime(2021, 3, 1)), to_epoch_minute(datetime(2021, 9, 1))]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: curve.ensure(epoch_minutes), range(8)))
+
+    assert len(fetcher.ranges) == 2
+    assert all(curve.is_covered(epoch_minute) for epoch_minute in epoch_minutes)
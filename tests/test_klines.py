@@ -0,0 +1,116 @@
+import csv
+import zipfile
+from datetime import datetime, timedelta
+
+import pytest
+
+from klines import KLINE_INTERVAL_MS, KlineStore, is_covered
+from utils import CurrencyExtractor, UnknownPriceException, to_milliseconds
+
+BEGIN = datetime(2021, 1, 1)
+
+
+def get_rows(begin: datetime, count: int, scale: int = 1, header: bool = False):
+    """
+    Archive rows of count 3m klines from begin, open times in milliseconds (scale 1) or microseconds (scale 1000)
+    """
+    rows = [["open_time", "open", "high", "low", "close", "volume", "close_time"]] if header else []
+    for i in range(count):
+        open_time = to_milliseconds(begin) + i * KLINE_INTERVAL_MS
+        price = 100.0 + i
+        rows.append([open_time * scale, price, price + 2, price - 2, price + 1, 10.0, (open_time + KLINE_INTERVAL_MS - 1) * scale])
+
+    return rows
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as file:
+        csv.writer(file).writerows(rows)
+
+
+def write_zip(path, rows):
+    write_csv(path.with_suffix(".csv.tmp"), rows)
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.write(path.with_suffix(".csv.tmp"), path.with_suffix(".csv").name)
+    path.with_suffix(".csv.tmp").unlink()
+
+
+class RecordingFetcher:
+    """
+    Fetcher recording the provider calls instead of running them
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def get_klines(self, *args):
+        return []
+
+    def run(self, calls):
+        self.calls += calls
+        return [fn(*args) for _, fn, args in calls]
+
+
+def test_archives_are_imported(engine, tmp_path):
+    write_zip(tmp_path / "BTCUSDT-3m-2021-01-01.zip", get_rows(BEGIN, 5, header=True))
+    # spot archives since 2025 have open times in microseconds
+    write_csv(tmp_path / "BTCUSDT-3m-2021-01-02.csv", get_rows(BEGIN + timedelta(days=1), 5, scale=1000))
+    # other intervals and names are skipped
+    write_csv(tmp_path / "BTCUSDT-1m-2021-01-03.csv", get_rows(BEGIN + timedelta(days=2), 5))
+    write_csv(tmp_path / "notes.csv", get_rows(BEGIN + timedelta(days=3), 5))
+
+    store = KlineStore(engine)
+    store.import_directory(str(tmp_path))
+
+    first_day = store.get_klines("BTCUSDT", to_milliseconds(BEGIN), to_milliseconds(BEGIN + timedelta(days=1)) - 1)
+    assert first_day[0] == [to_milliseconds(BEGIN), 100.0, 102.0, 98.0, 101.0]
+    assert len(first_day) == 5
+
+    second_day = store.get_klines("BTCUSDT", to_milliseconds(BEGIN + timedelta(days=1)), to_milliseconds(BEGIN + timedelta(days=2)) - 1)
+    assert [kline[0] for kline in second_day] == [to_milliseconds(BEGIN + timedelta(days=1)) + i * KLINE_INTERVAL_MS for i in range(5)]
+
+    assert store.get_klines("BTCUSDT", to_milliseconds(BEGIN + timedelta(days=2)), to_milliseconds(BEGIN + timedelta(days=4))) == []
+
+
+def test_covered_ranges_merge_contiguous_files(engine, tmp_path):
+    # the second file starts right after the first one, the third one after a gap
+    write_csv(tmp_path / "BTCUSDT-3m-2021-01-01.csv", get_rows(BEGIN, 10))
+    write_csv(tmp_path / "BTCUSDT-3m-2021-01-02.csv", get_rows(BEGIN + timedelta(minutes=30), 10))
+    write_csv(tmp_path / "BTCUSDT-3m-2021-01-03.csv", get_rows(BEGIN + timedelta(hours=2), 10))
+
+    store = KlineStore(engine)
+    store.import_directory(str(tmp_path))
+    ranges = store.get_covered_ranges("BTCUSDT")
+
+    first = to_milliseconds(BEGIN)
+    after_gap = to_milliseconds(BEGIN + timedelta(hours=2))
+    assert ranges == [(first, first + 19 * KLINE_INTERVAL_MS), (after_gap, after_gap + 9 * KLINE_INTERVAL_MS)]
+    assert store.get_covered_ranges("ETHUSDT") == []
+
+    # the last kline of a range covers up to its close
+    assert is_covered(ranges, first, first + 20 * KLINE_INTERVAL_MS - 1)
+    assert not is_covered(ranges, first, first + 20 * KLINE_INTERVAL_MS)
+    assert not is_covered(ranges, first - 1, first + KLINE_INTERVAL_MS)
+    # a window across the gap is not covered
+    assert not is_covered(ranges, first + 15 * KLINE_INTERVAL_MS, after_gap)
+
+
+def test_covered_prices_are_served_without_provider_call(engine, tmp_path):
+    write_csv(tmp_path / "BTCUSDT-3m-2021-01-01.csv", get_rows(BEGIN, 20))
+    KlineStore(engine).import_directory(str(tmp_path))
+
+    currency_extractor = CurrencyExtractor(engine, None, fx_config={"enabled": False})
+    currency_extractor.fetcher = RecordingFetcher()
+    request = ("BTC", BEGIN + timedelta(minutes=4), "BINANCE")
+
+    price = currency_extractor.get_asset_prices([request])[request]
+
+    # first kline opened at or after the timestamp, the one of minute 6
+    assert price == (102.0 + 104.0 + 100.0 + 103.0) / 4
+    assert currency_extractor.fetcher.calls == []
+
+    # past the imported range the binance api is called, it has no kline either
+    late_request = ("BTC", BEGIN + timedelta(minutes=55), "BINANCE")
+    with pytest.raises(UnknownPriceException):
+        currency_extractor.get_asset_prices([late_request])
+    assert len(currency_extractor.fetcher.calls) == 1
@@ -0,0 +1,133 @@
+import struct
+from datetime import datetime
+
+from sqlalchemy import event, text
+
+from conftest import count_rows, write_binance_statement, write_etoro_statement
+from database import LEGACY_FINGERPRINT_VERSION, RAW_OPERATION_KEY_FIELDS, get_raw_operation_fingerprint, get_raw_operation_key
+from exchange.binance import BinanceTaxExtractor
+from exchange.etoro import EtoroTaxExtractor
+
+
+def load_binance(engine, currency_extractor, path):
+    extractor = BinanceTaxExtractor(engine, currency_extractor)
+    extractor.load_account_statement(path)
+    return extractor
+
+
+def test_overlapping_statement_only_loads_new_rows(engine, currency_extractor, tmp_path, caplog):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "EUR", "100.25", ""],
+            ["2021-01-01 10:00:00", "Spot", "Deposit", "EUR", "100.25", ""],
+            ["2021-01-02 10:00:00", "Spot", "Buy", "BTC", "0.003", ""]]
+    load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "first.csv", rows))
+
+    rows += [["2021-01-01 10:00:00", "Spot", "Deposit", "EUR", "100.25", ""],
+             ["2021-01-03 10:00:00", "Spot", "Sell", "BTC", "-0.001", ""]]
+    with caplog.at_level("INFO", logger="main"):
+        extractor = load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "second.csv", rows))
+
+    # the third identical deposit is new, the loaded ones are skipped
+    assert "Load 2 new BINANCE raw operations, 3 already loaded are skipped" in caplog.text
+    assert count_rows(engine, "binance_raw_operations") == 5
+
+
+def test_known_rows_are_looked_up_by_batch(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-0{} 10:00:00".format(day), "Spot", "Deposit", "EUR", "100.25", ""] for day in range(1, 6)]
+    BinanceTaxExtractor(engine, currency_extractor, batch_size=2).load_account_statement(write_binance_statement(tmp_path / "first.csv", rows[:3]))
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    BinanceTaxExtractor(engine, currency_extractor, batch_size=2).load_account_statement(write_binance_statement(tmp_path / "second.csv", rows))
+
+    assert count_rows(engine, "binance_raw_operations") == 5
+    # one fingerprint lookup of each batch of 2 rows, none of the whole table
+    lookups = [statement for statement in statements if statement.startswith("SELECT fingerprint")]
+    assert len(lookups) == 3 and all("WHERE fingerprint IN" in lookup for lookup in lookups)
+
+
+def test_amounts_differing_after_six_digits_are_distinct(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "BTC", "1.0000001", ""],
+            ["2021-01-01 10:00:00", "Spot", "Deposit", "BTC", "1.0000002", ""]]
+    path = write_binance_statement(tmp_path / "statement.csv", rows)
+
+    load_binance(engine, currency_extractor, path)
+    load_binance(engine, currency_extractor, path)
+
+    assert count_rows(engine, "binance_raw_operations") == 2
+
+
+def test_legacy_fingerprints_are_recognized(engine, currency_extractor, tmp_path):
+    # a row loaded by mysql before fingerprints: its amount was read back from a single precision column
+    change = struct.unpack("f", struct.pack("f", 0.123456789))[0]
+    raw_operation = {"operation_datetime": datetime(2021, 1, 1, 10, 0), "account": "Spot", "operation": "Deposit",
+                     "coin": "BTC", "change": change, "remark": ""}
+    key = get_raw_operation_key(raw_operation, RAW_OPERATION_KEY_FIELDS["binance_raw_operations"], LEGACY_FINGERPRINT_VERSION)
+    with engine.begin() as conn:
+        sql = "INSERT INTO binance_raw_operations (operation_datetime, account, operation, coin, `change`, remark, fingerprint, fingerprint_version)" \
+              "                            VALUES (:operation_datetime, :account, :operation, :coin, :change, :remark, :fingerprint, :fingerprint_version)"
+        conn.execute(text(sql), dict(raw_operation, fingerprint=get_raw_operation_fingerprint(key, 0), fingerprint_version=LEGACY_FINGERPRINT_VERSION))
+
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "BTC", "0.123456789", ""],
+            ["2021-01-02 10:00:00", "Spot", "Deposit", "BTC", "0.5", ""]]
+    load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "statement.csv", rows))
+
+    assert count_rows(engine, "binance_raw_operations") == 2
+
+
+def test_close_position_repeated_in_a_statement_is_loaded_once(engine, currency_extractor, tmp_path):
+    row = [1001, "Buy Bitcoin", None, "100,00", "0,005", "20000,00", "22000,00", "0,00", "10,00", "01/01/2021 10:00", "01/02/2021 10:00"]
+    path = write_etoro_statement(tmp_path / "statement.xlsx", [row, list(row)])
+
+    extractor = EtoroTaxExtractor(engine, currency_extractor)
+    extractor.load_account_statement(path)
+    extractor.extract_sale_history()
+
+    assert count_rows(engine, "etoro_close_positions") == 1
+    assert count_rows(engine, "etoro_open_positions") == 1
+
+
+def test_open_positions_skip_empty_details(engine, currency_extractor, tmp_path):
+    transaction_rows = [["2021-01-01 10:00:00", "1000,00", "Open Position", "BTC/USD", 1001, "100.00"],
+                        ["2021-01-01 11:00:00", "900,00", "Open Position", None, 1002, "50.00"],
+                        [None, None, None, None, None, None]]
+    path = write_etoro_statement(tmp_path / "statement.xlsx", [], transaction_rows)
+
+    extractor = EtoroTaxExtractor(engine, currency_extractor)
+    extractor.load_account_statement(path)
+    extractor.extract_purchase_history()
+
+    assert count_rows(engine, "etoro_open_positions") == 1
+
+
+def test_fiat_history_is_extracted_from_new_rows(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "EUR", "100.25", ""],
+            ["2021-01-02 10:00:00", "Spot", "Withdraw", "EUR", "-50.00", ""]]
+    extractor = load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "first.csv", rows))
+    extractor.extract_fiat_history()
+
+    rows += [["2021-01-03 10:00:00", "Spot", "Deposit", "EUR", "20.00", ""]]
+    extractor = load_binance(engine, currency_extractor, write_binance_statement(tmp_path / "second.csv", rows))
+    extractor.extract_fiat_history()
+
+    with engine.connect() as conn:
+        result = conn.execute(text("SELECT operation, amount FROM binance_fiat_history ORDER BY id ASC")).fetchall()
+    assert [tuple(res) for res in result] == [("DEPOSIT", 100.25), ("WITHDRAW", -50.0), ("DEPOSIT", 20.0)]
+
+
+def test_failed_extraction_is_run_again_by_the_next_load(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "EUR", "100.25", ""],
+            ["2021-01-02 10:00:00", "Spot", "Buy", "BTC", "0.003", ""]]
+    path = write_binance_statement(tmp_path / "statement.csv", rows)
+    # the raw operations are committed, process_load fails before extracting them
+    load_binance(engine, currency_extractor, path)
+
+    # the next load skips every raw operation but extracts the ones left behind
+    extractor = load_binance(engine, currency_extractor, path)
+    extractor.process_load()
+    extractor.process_load()
+
+    assert count_rows(engine, "binance_fiat_history") == 1
+    assert count_rows(engine, "binance_crypto_history") == 1
+    with engine.connect() as conn:
+        sql = "SELECT operation, last_source_id FROM operation_watermark WHERE exchange = 'BINANCE' ORDER BY operation ASC"
+        assert [tuple(res) for res in conn.execute(text(sql))] == [("CRYPTO", 2), ("FIAT", 2)]
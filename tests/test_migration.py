@@ -0,0 +1,221 @@
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from conftest import create_sqlite_engine
+from database import SCHEMA_INDEXES, SCHEMA_VERSION, get_raw_operation_fingerprint, get_raw_operation_key, RAW_OPERATION_KEY_FIELDS, \
+    to_epoch_minute
+from price_series import PriceSeriesStore
+from utils import boot_db, migrate_db
+
+# unversioned (version 1) schema, as created by the first releases
+BASELINE_SCHEMA = ["""
+CREATE TABLE `asset_price_cache` (
+  `key` varchar(256) NOT NULL,
+  `price` float NOT NULL,
+  UNIQUE (`key`)
+);
+""", """
+CREATE TABLE `asset_gecko_convert` (
+  `token_name` varchar(256) NOT NULL,
+  `gecko_name` varchar(256) NOT NULL,
+  UNIQUE (`token_name`)
+);
+""", """
+CREATE TABLE `binance_crypto_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `operation` varchar(256) NOT NULL
+);
+""", """
+CREATE TABLE `binance_fiat_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount` float NOT NULL,
+  `operation` varchar(256) NOT NULL
+);
+""", """
+CREATE TABLE `binance_raw_operations` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `account` varchar(256) NOT NULL,
+  `operation` varchar(256) NOT NULL,
+  `coin` varchar(256) NOT NULL,
+  `change` float NOT NULL,
+  `remark` varchar(256) NOT NULL
+);
+""", """
+CREATE TABLE `coinbase_raw_operations` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `operation_datetime` datetime NOT NULL,
+  `operation` varchar(256) NOT NULL,
+  `coin` varchar(256) NOT NULL,
+  `quantity` float NOT NULL,
+  `spot_price` float NOT NULL,
+  `amount_price` float NOT NULL,
+  `note` text NOT NULL
+);
+""", """
+CREATE TABLE `etoro_close_positions` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `position_id` varchar(256) NOT NULL,
+  `close_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `amount_price` float NOT NULL,
+  `current_asset_price` float NOT NULL,
+  `profit_price` float NOT NULL,
+  `open_asset_price` float NOT NULL
+);
+""", """
+CREATE TABLE `etoro_open_positions` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `position_id` varchar(256) NOT NULL,
+  `open_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float DEFAULT NULL,
+  `amount_price` float DEFAULT NULL,
+  `current_asset_price` float DEFAULT NULL,
+  UNIQUE (`position_id`)
+);
+""", """
+CREATE TABLE `purchase_operation_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `purchase_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `amount_price_usd` float NOT NULL,
+  `amount_price_euro` float NOT NULL,
+  `current_asset_price_usd` float NOT NULL,
+  `current_asset_price_euro` float NOT NULL,
+  `exchange` varchar(256) NOT NULL
+);
+""", """
+CREATE TABLE `sale_operation_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `sale_datetime` datetime NOT NULL,
+  `asset` varchar(256) NOT NULL,
+  `amount_asset` float NOT NULL,
+  `amount_price_usd` float NOT NULL,
+  `amount_price_euro` float NOT NULL,
+  `current_asset_price_usd` float NOT NULL,
+  `current_asset_price_euro` float NOT NULL,
+  `exchange` varchar(256) NOT NULL
+);
+""", """
+CREATE TABLE `tax_disposal_history` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `disposal_datetime` datetime NOT NULL,
+  `current_portfolio_value` float NOT NULL,
+  `disposal_price` float NOT NULL,
+  `current_total_purchase` float NOT NULL,
+  `current_previous_disposed_purchase` float NOT NULL,
+  `current_balanced_purchase` float NOT NULL,
+  `profit_and_loss` float NOT NULL,
+  `tax_report_id` integer NOT NULL
+);
+""", """
+CREATE TABLE `tax_report` (
+  `id` integer PRIMARY KEY AUTOINCREMENT,
+  `creation_date` datetime NOT NULL,
+  `begin_date` datetime DEFAULT NULL,
+  `end_date` datetime DEFAULT NULL,
+  `compacted` tinyint(1) NOT NULL,
+  `global_pnl` float NOT NULL
+);
+"""]
+
+
+def create_baseline_database(path):
+    engine = create_sqlite_engine(path)
+    with engine.begin() as conn:
+        for step in BASELINE_SCHEMA:
+            conn.execute(text(step))
+
+        conn.execute(text("INSERT INTO asset_price_cache (`key`, price) VALUES ('2021-01-01-10-00-GECKO-bitcoin', 29000.5)"))
+        sql = "INSERT INTO binance_raw_operations (operation_datetime, account, operation, coin, `change`, remark)" \
+              "                            VALUES (:operation_datetime, 'Spot', 'Deposit', 'EUR', 100.25, '')"
+        conn.execute(text(sql), {"operation_datetime": datetime(2021, 1, 1, 10, 0)})
+        conn.execute(text(sql), {"operation_datetime": datetime(2021, 1, 1, 10, 0)})
+        sql = "INSERT INTO purchase_operation_history (purchase_datetime, asset, amount_asset, amount_price_usd, amount_price_euro," \
+              "                                        current_asset_price_usd, current_asset_price_euro, exchange)" \
+              "                                VALUES (:purchase_datetime, 'EUR', 100.25, 120, 100.25, 120, 100.25, 'BINANCE')"
+        conn.execute(text(sql), {"purchase_datetime": datetime(2021, 1, 1, 10, 0)})
+
+    return engine
+
+
+def get_schema(engine):
+    inspector = inspect(engine)
+    return {table: sorted(column["name"] for column in inspector.get_columns(table))
+            for table in inspector.get_table_names() if not table.startswith("sqlite_")}
+
+
+def get_index_names(engine):
+    inspector = inspect(engine)
+    return {index["name"] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+
+
+def test_migrate_baseline_database_to_current_schema(tmp_path):
+    migrated = create_baseline_database(tmp_path / "baseline.db")
+    migrate_db("sqlite", migrated)
+
+    created = create_sqlite_engine(tmp_path / "created.db")
+    boot_db("sqlite", created)
+
+    with migrated.connect() as conn:
+        assert conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() == SCHEMA_VERSION
+
+    # the legacy price cache is dropped once copied into price_series
+    assert get_schema(migrated) == get_schema(created)
+    assert {name for name, table, columns in SCHEMA_INDEXES} <= get_index_names(migrated)
+
+
+def test_migration_keeps_loaded_data(tmp_path):
+    engine = create_baseline_database(tmp_path / "baseline.db")
+    migrate_db("sqlite", engine)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT price FROM price_series")).scalar() == 29000.5
+        assert conn.execute(text("SELECT COUNT(*) FROM purchase_operation_history WHERE source_id IS NULL")).scalar() == 1
+        # the loaded raw operations were extracted
+        sql = "SELECT exchange, operation, last_source_id FROM operation_watermark ORDER BY operation ASC"
+        assert [tuple(res) for res in conn.execute(text(sql))] == [("BINANCE", "CRYPTO", 2), ("BINANCE", "FIAT", 2)]
+
+        fingerprints = [res[0] for res in conn.execute(text("SELECT fingerprint FROM binance_raw_operations ORDER BY id ASC"))]
+
+    # identical rows of a statement keep distinct fingerprints
+    key = get_raw_operation_key({"operation_datetime": datetime(2021, 1, 1, 10, 0), "account": "Spot", "operation": "Deposit",
+                                 "coin": "EUR", "change": 100.25, "remark": ""}, RAW_OPERATION_KEY_FIELDS["binance_raw_operations"])
+    assert fingerprints == [get_raw_operation_fingerprint(key, 0), get_raw_operation_fingerprint(key, 1)]
+
+
+def test_migration_copies_the_price_cache(tmp_path):
+    engine = create_baseline_database(tmp_path / "baseline.db")
+    with engine.begin() as conn:
+        for key, price in [("2021-01-01-10-03-BINANCE-BTC", 29001.0), ("2021-01-02-00-00-GECKO-usd-coin", 1.001),
+                           ("2021-01-01-10-00-GECKO-euro", 0.82), ("not-a-price-key", 1.0)]:
+            conn.execute(text("INSERT INTO asset_price_cache (`key`, price) VALUES (:key, :price)"), {"key": key, "price": price})
+
+    migrate_db("sqlite", engine)
+
+    minute = to_epoch_minute(datetime(2021, 1, 1, 10, 0))
+    keys = [("GECKO", "bitcoin", minute, "1m"), ("BINANCE", "BTC", minute + 3, "3m"),
+            ("GECKO", "usd-coin", to_epoch_minute(datetime(2021, 1, 2)), "1m"), ("GECKO", "euro", minute, "1m")]
+    prices = PriceSeriesStore(engine).get_prices(keys)
+
+    # every readable key is copied at the native resolution of its scope, the others are dropped with the table
+    assert {key: float(price) for key, price in prices.items()} == dict(zip(keys, [29000.5, 29001.0, 1.001, 0.82]))
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM price_series")).scalar() == 4
+    assert "asset_price_cache" not in inspect(engine).get_table_names()
+
+
+def test_migrate_up_to_date_database(engine):
+    migrate_db("sqlite", engine)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() == SCHEMA_VERSION
@@ -0,0 +1,216 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from database import to_epoch_minute
+from price_series import PriceQuote, ResolutionPolicy
+from utils import CurrencyExtractor, LRUCache, UnknownPriceException
+
+
+class RecordingCurrencyExtractor(CurrencyExtractor):
+    """
+    Currency extractor recording each key sent to the providers, every price is 1.0
+    """
+
+    def __init__(self, engine, lru_size: int = 100, failure_ttl_hours: int = 24):
+        super(RecordingCurrencyExtractor, self).__init__(engine, None, lru_size=lru_size, failure_ttl_hours=failure_ttl_hours,
+                                                         fx_config={"enabled": False})
+        self.queried_keys = []
+
+    def query_asset_prices(self, requests_by_key):
+        self.queried_keys += list(requests_by_key.keys())
+        return {key: PriceQuote(1.0, key[3], key[2]) for key in requests_by_key}, {}
+
+
+class SlowCurrencyExtractor(RecordingCurrencyExtractor):
+    """
+    Recording currency extractor whose provider calls are slow, and fail with error if set
+    """
+
+    def __init__(self, engine, error: Exception = None):
+        super(SlowCurrencyExtractor, self).__init__(engine)
+        self.error = error
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    def query_asset_prices(self, requests_by_key):
+        with self.calls_lock:
+            self.calls += 1
+        time.sleep(0.3)
+        if self.error:
+            raise self.error
+
+        return super(SlowCurrencyExtractor, self).query_asset_prices(requests_by_key)
+
+
+class UnknownCurrencyExtractor(RecordingCurrencyExtractor):
+    """
+    Recording currency extractor whose providers know no price, unless known is set
+    """
+
+    def __init__(self, engine):
+        super(UnknownCurrencyExtractor, self).__init__(engine, failure_ttl_hours=24)
+        self.known = False
+
+    def query_asset_prices(self, requests_by_key):
+        if self.known:
+            return super(UnknownCurrencyExtractor, self).query_asset_prices(requests_by_key)
+
+        self.queried_keys += list(requests_by_key.keys())
+        return {}, {key: UnknownPriceException("GECKO 404 error: coin not found") for key in requests_by_key}
+
+
+def age_failures(engine, age: timedelta):
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE asset_price_failure SET failure_datetime = :failure_datetime"), {"failure_datetime": datetime.utcnow() - age})
+
+
+def request_concurrently(currency_extractor, request, count):
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [executor.submit(currency_extractor.get_asset_prices, [request]) for _ in range(count)]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(future.result(timeout=10)[request])
+            except Exception as e:
+                outcomes.append(e)
+
+    return outcomes
+
+
+def test_lru_evicts_the_least_recently_used_entry():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    cache.put("c", 3)
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_of_size_zero_keeps_nothing():
+    cache = LRUCache(max_size=0)
+    cache.put("a", 1)
+
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def test_prices_are_kept_up_to_the_lru_bound(engine):
+    currency_extractor = RecordingCurrencyExtractor(engine, lru_size=2)
+    begin = datetime(2021, 1, 1)
+    requests = [("BTC", begin + timedelta(minutes=i), "GECKO") for i in range(3)]
+
+    currency_extractor.get_asset_prices(requests)
+
+    assert len(currency_extractor.price_lru) == 2
+    assert {key[2] for key in currency_extractor.price_lru.entries} == {to_epoch_minute(begin) + 1, to_epoch_minute(begin) + 2}
+
+    # the evicted price is read back from the price series store, not from the providers
+    currency_extractor.get_asset_prices(requests[:1])
+    assert len(currency_extractor.queried_keys) == 3
+    assert currency_extractor.get_cache_stats()["store_hits"] == 1
+
+
+def test_lru_is_keyed_by_scope_asset_minute_and_policy(engine):
+    currency_extractor = RecordingCurrencyExtractor(engine)
+    timestamp = datetime(2021, 1, 1, 10, 0)
+    tolerant = ResolutionPolicy(tolerance_minutes=5)
+
+    currency_extractor.get_asset_prices([("BTC", timestamp, "GECKO")])
+    currency_extractor.get_asset_prices([("BTC", timestamp, "GECKO")], policy=tolerant)
+    currency_extractor.get_asset_prices([("BTC", timestamp, "BINANCE"), ("ETH", timestamp, "GECKO")])
+
+    epoch_minute = to_epoch_minute(timestamp)
+    assert set(currency_extractor.price_lru.entries) == {("GECKO", "BTC", epoch_minute, ResolutionPolicy()),
+                                                          ("GECKO", "BTC", epoch_minute, tolerant),
+                                                          ("BINANCE", "BTC", epoch_minute, ResolutionPolicy()),
+                                                          ("GECKO", "ETH", epoch_minute, ResolutionPolicy())}
+
+    # seconds within the minute share the entry
+    hits = currency_extractor.price_lru.hits
+    currency_extractor.get_asset_prices([("BTC", timestamp + timedelta(seconds=42), "GECKO")])
+    assert currency_extractor.price_lru.hits == hits + 1
+
+
+def test_concurrent_lookups_of_a_key_call_the_provider_once(engine):
+    currency_extractor = SlowCurrencyExtractor(engine)
+    request = ("BTC", datetime(2021, 1, 1, 10, 0), "GECKO")
+
+    outcomes = request_concurrently(currency_extractor, request, 16)
+
+    assert outcomes == [1.0] * 16
+    assert currency_extractor.calls == 1
+    assert currency_extractor.in_flight == {}
+
+
+def test_failed_lookup_reaches_the_waiting_callers(engine):
+    currency_extractor = SlowCurrencyExtractor(engine, error=RuntimeError("provider down"))
+    request = ("BTC", datetime(2021, 1, 1, 10, 0), "GECKO")
+
+    outcomes = request_concurrently(currency_extractor, request, 16)
+
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert currency_extractor.calls == 1
+    # nothing is left claimed, the next lookup calls the provider again
+    assert currency_extractor.in_flight == {}
+    currency_extractor.error = None
+    assert currency_extractor.get_asset_prices([request])[request] == 1.0
+    assert currency_extractor.calls == 2
+
+
+UNKNOWN_REQUEST = ("NOCOIN", datetime(2021, 1, 1, 10, 0), "GECKO")
+
+
+def test_unresolved_price_is_not_requested_again_within_the_ttl(engine):
+    currency_extractor = UnknownCurrencyExtractor(engine)
+    with pytest.raises(UnknownPriceException, match="coin not found"):
+        currency_extractor.get_asset_prices([UNKNOWN_REQUEST])
+
+    unresolved = currency_extractor.get_unresolved_prices()
+    assert [(failure["scope"], failure["asset"], failure["price_datetime"], failure["attempts"]) for failure in unresolved] == \
+           [("GECKO", "NOCOIN", datetime(2021, 1, 1, 10, 0), 1)]
+
+    age_failures(engine, timedelta(hours=23))
+    with pytest.raises(UnknownPriceException, match="known failure"):
+        currency_extractor.get_asset_prices([UNKNOWN_REQUEST])
+    assert len(currency_extractor.queried_keys) == 1
+
+
+def test_unresolved_price_is_requested_again_after_the_ttl(engine):
+    currency_extractor = UnknownCurrencyExtractor(engine)
+    with pytest.raises(UnknownPriceException):
+        currency_extractor.get_asset_prices([UNKNOWN_REQUEST])
+
+    age_failures(engine, timedelta(hours=25))
+    with pytest.raises(UnknownPriceException, match="coin not found"):
+        currency_extractor.get_asset_prices([UNKNOWN_REQUEST])
+    assert len(currency_extractor.queried_keys) == 2
+    assert [failure["attempts"] for failure in currency_extractor.get_unresolved_prices()] == [2]
+
+    # a retry that resolves the price removes it from the ledger
+    age_failures(engine, timedelta(hours=25))
+    currency_extractor.known = True
+    assert currency_extractor.get_asset_prices([UNKNOWN_REQUEST])[UNKNOWN_REQUEST] == 1.0
+    assert currency_extractor.get_unresolved_prices() == []
+
+
+def test_cleaning_unresolved_prices_resets_the_ledger(engine):
+    currency_extractor = UnknownCurrencyExtractor(engine)
+    with pytest.raises(UnknownPriceException):
+        currency_extractor.get_asset_prices([UNKNOWN_REQUEST])
+
+    currency_extractor.clean_unresolved_prices()
+
+    assert currency_extractor.get_unresolved_prices() == []
+    with pytest.raises(UnknownPriceException, match="coin not found"):
+        currency_extractor.get_asset_prices([UNKNOWN_REQUEST])
+    assert len(currency_extractor.queried_keys) == 2
@@ -0,0 +1,139 @@
+from array import array
+from datetime import datetime
+
+import pytest
+
+from conftest import count_rows
+from database import NATIVE_RESOLUTION_MINUTES, to_epoch_minute
+from price_series import RESOLUTION_MINUTES, PriceSeries, PriceSeriesStore, ResolutionPolicies, ResolutionPolicy
+
+MINUTE = to_epoch_minute(datetime(2021, 1, 1, 10, 0))
+
+
+def test_saved_prices_are_read_back(engine):
+    PriceSeriesStore(engine).save_prices({("GECKO", "bitcoin", MINUTE, "1m"): 29000.5,
+                                          ("GECKO", "bitcoin", MINUTE + 5, "1m"): 29010.0,
+                                          ("BINANCE", "BTC", MINUTE, "3m"): 29001.0})
+
+    # a new store reads the series from the database
+    store = PriceSeriesStore(engine)
+    prices = store.get_prices([("GECKO", "bitcoin", MINUTE, "1m"), ("GECKO", "bitcoin", MINUTE + 1, "1m"), ("BINANCE", "BTC", MINUTE, "3m")])
+
+    assert prices == {("GECKO", "bitcoin", MINUTE, "1m"): 29000.5, ("BINANCE", "BTC", MINUTE, "3m"): 29001.0}
+    quote = prices[("GECKO", "bitcoin", MINUTE, "1m")]
+    assert (quote.resolution, quote.epoch_minute) == ("1m", MINUTE)
+    assert [float(quote) for quote in store.get_series("GECKO", "bitcoin").get_range(MINUTE, MINUTE + 5)] == [29000.5, 29010.0]
+    assert count_rows(engine, "price_asset") == 2
+
+
+def test_saved_price_replaces_the_point_of_its_minute(engine):
+    store = PriceSeriesStore(engine)
+    store.save_prices({("GECKO", "bitcoin", MINUTE, "1h"): 29000.0})
+    store.save_prices({("GECKO", "bitcoin", MINUTE, "1m"): 29100.0})
+
+    assert count_rows(engine, "price_series") == 1
+    quote = PriceSeriesStore(engine).get_prices([("GECKO", "bitcoin", MINUTE, "1m")])[("GECKO", "bitcoin", MINUTE, "1m")]
+    assert (float(quote), quote.resolution) == (29100.0, "1m")
+
+
+def test_prices_are_served_at_their_resolution_or_finer(engine):
+    store = PriceSeriesStore(engine)
+    store.save_prices({("GECKO", "bitcoin", MINUTE, "1h"): 29000.0, ("GECKO", "bitcoin", MINUTE + 60, "1m"): 29100.0})
+
+    assert store.get_prices([("GECKO", "bitcoin", MINUTE, "1m")]) == {}
+    assert store.get_prices([("GECKO", "bitcoin", MINUTE, "1d")]) == {("GECKO", "bitcoin", MINUTE, "1d"): 29000.0}
+    assert store.get_prices([("GECKO", "bitcoin", MINUTE + 60, "1h")]) == {("GECKO", "bitcoin", MINUTE + 60, "1h"): 29100.0}
+
+
+def test_quote_follows_the_policy(engine):
+    store = PriceSeriesStore(engine)
+    store.save_prices({("GECKO", "bitcoin", MINUTE, "1h"): 29000.0, ("GECKO", "bitcoin", MINUTE + 90, "1m"): 29100.0})
+
+    # exact minute only without tolerance, a coarse point is not used at the native resolution
+    assert store.get_quote("GECKO", "bitcoin", MINUTE + 90, ResolutionPolicy()) == 29100.0
+    assert store.get_quote("GECKO", "bitcoin", MINUTE + 91, ResolutionPolicy()) is None
+    assert store.get_quote("GECKO", "bitcoin", MINUTE, ResolutionPolicy()) is None
+
+    assert store.get_quote("GECKO", "bitcoin", MINUTE + 93, ResolutionPolicy(tolerance_minutes=5)) == 29100.0
+    # a coarse policy falls back to the point of the candle of the request
+    assert store.get_quote("GECKO", "bitcoin", MINUTE + 30, ResolutionPolicy(resolution="1h")) == 29000.0
+    assert store.get_quote("GECKO", "ethereum", MINUTE, ResolutionPolicy(tolerance_minutes=60)) is None
+
+
+def get_series(points):
+    """
+    PriceSeries of (epoch minute, price, resolution minutes) points
+    """
+    return PriceSeries(array("q", [point[0] for point in points]), array("d", [point[1] for point in points]), array("H", [point[2] for point in points]))
+
+
+@pytest.mark.parametrize("epoch_minute, tolerance_minutes, expected", [
+    (100, 0, 1.0),
+    (101, 0, None),
+    # a tie gives the earlier point
+    (105, 5, 1.0),
+    (106, 5, 2.0),
+    # the tolerance is inclusive
+    (95, 5, 1.0),
+    (94, 5, None),
+    (115, 5, 2.0),
+    (116, 5, None),
+    (50, 1000, 1.0),
+    (500, 1000, 2.0),
+])
+def test_nearest_point_within_tolerance(epoch_minute, tolerance_minutes, expected):
+    series = get_series([(100, 1.0, 1), (110, 2.0, 1)])
+
+    quote = series.get_nearest(epoch_minute, tolerance_minutes, 1)
+    assert (float(quote) if quote is not None else None) == expected
+
+
+def test_nearest_point_skips_coarser_points():
+    series = get_series([(100, 1.0, 1), (104, 2.0, 60), (107, 3.0, 60)])
+
+    # the closest points are coarser than allowed, the farther fine one is used
+    assert series.get_nearest(105, 5, 1) == 1.0
+    assert series.get_nearest(105, 4, 1) is None
+    assert series.get_nearest(105, 4, 60) == 2.0
+    assert series.get_nearest(106, 4, 60) == 3.0
+
+
+def test_nearest_point_of_an_empty_series():
+    assert get_series([]).get_nearest(100, 1000, 1440) is None
+
+
+@pytest.mark.parametrize("resolution", sorted(RESOLUTION_MINUTES, key=RESOLUTION_MINUTES.get))
+@pytest.mark.parametrize("scope", sorted(NATIVE_RESOLUTION_MINUTES))
+def test_fetch_minute_of_each_resolution(scope, resolution):
+    policy = ResolutionPolicy(resolution=resolution)
+    resolution_minutes = RESOLUTION_MINUTES[resolution]
+    # last minute of a day: its candle starts resolution_minutes - 1 earlier, whatever the resolution
+    epoch_minute = MINUTE + 13 * 60 + 59
+
+    assert policy.get_resolution(scope) == resolution
+    assert policy.is_coarse(scope) == (resolution_minutes > NATIVE_RESOLUTION_MINUTES[scope])
+    if policy.is_coarse(scope):
+        assert policy.get_fetch_minute(scope, epoch_minute) == epoch_minute + 1 - resolution_minutes
+    else:
+        assert policy.get_fetch_minute(scope, epoch_minute) == epoch_minute
+
+
+def test_native_resolution_policy():
+    assert ResolutionPolicy().get_resolution("GECKO") == "1m"
+    assert ResolutionPolicy().get_resolution("BINANCE") == "3m"
+    assert ResolutionPolicy().get_fetch_minute("BINANCE", MINUTE + 1) == MINUTE + 1
+
+
+def test_asset_classes_override_their_scope_policy():
+    policies = ResolutionPolicies({"GECKO": {"tolerance_minutes": 5},
+                                   "classes": {"illiquid": {"assets": ["CGLD"], "GECKO": {"tolerance_minutes": 720, "resolution": "1d"}}}})
+
+    assert policies.get_policy("GECKO", "bitcoin") == ResolutionPolicy(tolerance_minutes=5)
+    assert policies.get_policy("GECKO", "cgld") == ResolutionPolicy(tolerance_minutes=720, resolution="1d")
+    # a class only overrides the scopes it names
+    assert policies.get_policy("BINANCE", "cgld") == ResolutionPolicy()
+
+
+def test_unsupported_resolution_is_rejected():
+    with pytest.raises(Exception, match="Unsupported price resolution: 7m"):
+        ResolutionPolicies({"BINANCE": {"resolution": "7m"}})
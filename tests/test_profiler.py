@@ -0,0 +1,84 @@
+import json
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+from profiler import Profiler, get_profile_filename
+from test_price_cache import RecordingCurrencyExtractor
+
+
+def run_statements(engine, count):
+    with engine.connect() as conn:
+        for _ in range(count):
+            conn.execute(text("SELECT 1"))
+
+
+def test_stage_runs_are_summed(engine, currency_extractor):
+    profiler = Profiler(engine, currency_extractor)
+
+    for _ in range(2):
+        with profiler.stage("process_load"):
+            run_statements(engine, 3)
+            time.sleep(0.05)
+    with profiler.stage("build_holdings_timeline"):
+        run_statements(engine, 1)
+
+    stages = profiler.get_report()["stages"]
+    assert (stages["process_load"]["runs"], stages["process_load"]["sql_statements"]) == (2, 6)
+    assert stages["process_load"]["wall_seconds"] >= 0.1
+    assert (stages["build_holdings_timeline"]["runs"], stages["build_holdings_timeline"]["sql_statements"]) == (1, 1)
+
+
+def test_stage_is_recorded_when_its_block_fails(engine, currency_extractor):
+    profiler = Profiler(engine, currency_extractor)
+
+    with pytest.raises(RuntimeError):
+        with profiler.stage("process_load"):
+            run_statements(engine, 2)
+            raise RuntimeError("load failed")
+
+    assert profiler.get_report()["stages"]["process_load"]["sql_statements"] == 2
+
+
+def test_disabled_profiler_records_nothing(engine, currency_extractor, tmp_path):
+    profiler = Profiler(engine, currency_extractor, enabled=False)
+
+    with profiler.stage("process_load"):
+        run_statements(engine, 3)
+    profiler.write(str(tmp_path / "decla.profile.json"))
+
+    assert profiler.stages == {}
+    assert profiler.sql_statements == 0
+    assert not (tmp_path / "decla.profile.json").exists()
+
+
+def test_profile_report_is_written_as_json(engine, tmp_path):
+    currency_extractor = RecordingCurrencyExtractor(engine)
+    profiler = Profiler(engine, currency_extractor)
+    request = ("BTC", datetime(2021, 1, 1, 10, 0), "GECKO")
+
+    with profiler.stage("generate_tax_disposal_history"):
+        # a miss, then a hit of the price lru
+        currency_extractor.get_asset_prices([request])
+        currency_extractor.get_asset_prices([request])
+
+    filename = get_profile_filename(str(tmp_path / "decla.csv"))
+    profiler.write(filename)
+    with open(filename) as file:
+        report = json.load(file)
+
+    assert filename == str(tmp_path / "decla.profile.json")
+    assert set(report) == {"creation_date", "wall_seconds", "stages", "totals"}
+    stage = report["stages"]["generate_tax_disposal_history"]
+    assert {"runs", "wall_seconds", "sql_statements", "sql_seconds", "gecko_calls", "binance_calls"} <= set(stage)
+    assert (stage["lru_hits"], stage["lru_misses"], stage["lru_hit_ratio"]) == (1, 1, 0.5)
+    assert stage["sql_statements"] > 0
+    assert report["totals"]["sql_statements"] >= stage["sql_statements"]
+    assert "lru_size" not in report["totals"]
+
+
+def test_profile_filename():
+    assert get_profile_filename("out/decla.csv") == "out/decla.profile.json"
+    assert get_profile_filename(None) == "profile.json"
@@ -0,0 +1,163 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from conftest import StubCurrencyExtractor
+from exchange.common import TaxExtractor
+from price_series import PriceQuote
+from reporter import HoldingsSweep, TaxReporter
+from utils import CurrencyExtractor
+
+
+class CountingCurrencyExtractor(CurrencyExtractor):
+    """
+    Currency extractor recording each batch of prices sent to the providers, every price is 1.0
+    """
+
+    def __init__(self, engine):
+        super(CountingCurrencyExtractor, self).__init__(engine, None, fx_config={"enabled": False})
+        self.queries = []
+
+    def query_asset_prices(self, requests_by_key):
+        self.queries.append(list(requests_by_key.values()))
+        return {key: PriceQuote(1.0, key[3], key[2]) for key in requests_by_key}, {}
+
+
+class VaryingCurrencyExtractor(StubCurrencyExtractor):
+    """
+    Stub currency extractor whose prices depend on the asset and the timestamp, with a small delay
+    so concurrent valuations interleave
+    """
+
+    def get_asset_prices(self, requests, policy=None):
+        time.sleep(0.001)
+        return {request: 1.0 + sum(map(ord, request[0])) / 7.0 + request[1].timestamp() % 86400 / 3.0 for request in requests}
+
+    def get_euro_prices(self, timestamps):
+        return {timestamp: 0.8 + timestamp.timestamp() % 3600 / 36000.0 for timestamp in timestamps}
+
+
+def save_operations(engine, operations):
+    """
+    Insert (BUY/SELL, datetime, exchange, asset, amount_asset, amount_price_euro) operations
+    """
+    with engine.begin() as conn:
+        for side, timestamp, exchange, asset, amount_asset, amount_price_euro in operations:
+            table, field = ("purchase_operation_history", "purchase_datetime") if side == "BUY" else ("sale_operation_history", "sale_datetime")
+            sql = "INSERT INTO {} ({}, asset, amount_asset, amount_price_usd, amount_price_euro, current_asset_price_usd, current_asset_price_euro, exchange)" \
+                  "     VALUES (:timestamp, :asset, :amount_asset, :amount_price_euro, :amount_price_euro, 1.0, 1.0, :exchange)".format(table, field)
+            conn.execute(text(sql), {"timestamp": timestamp, "asset": asset, "amount_asset": amount_asset,
+                                     "amount_price_euro": amount_price_euro, "exchange": exchange})
+
+
+def build_timelines(engine, currency_extractor):
+    for exchange in TaxExtractor.get_supported_exchange():
+        TaxExtractor.get_extractor(exchange, engine, currency_extractor).build_holdings_timeline()
+
+
+def test_disposal_portfolio_values_read_the_timeline(engine, currency_extractor):
+    begin = datetime(2021, 1, 1)
+    save_operations(engine, [("BUY", begin, "ETORO", "BTC", 1.0, 20000.0),
+                             ("BUY", begin + timedelta(days=1), "ETORO", "ETH", 2.0, 2000.0),
+                             ("SELL", begin + timedelta(days=2), "ETORO", "BTC", 0.5, 9000.0),
+                             ("SELL", begin + timedelta(days=3), "ETORO", "ETH", 2.0, 2200.0)])
+    build_timelines(engine, currency_extractor)
+
+    report = TaxReporter(engine, currency_extractor, valuation_workers=1)
+    values = report.get_disposal_portfolio_values([begin + timedelta(days=2), begin + timedelta(days=3)])
+
+    # a sale is still owned at its own datetime
+    price = currency_extractor.asset_price * currency_extractor.euro_price
+    assert values == [pytest.approx(3.0 * price), pytest.approx(2.5 * price)]
+
+
+def test_sweep_matches_point_in_time_holdings(engine, currency_extractor):
+    rand = random.Random(3)
+    begin = datetime(2021, 1, 1)
+    operations = [("BUY", begin, "ETORO", asset, 10.0, 1000.0) for asset in ["BTC", "ETH"]]
+    for i in range(60):
+        # a few changes share their timestamp, a purchase is owned at it and a sale only after it
+        timestamp = begin + timedelta(hours=i // 3 + 1)
+        operations.append((rand.choice(["BUY", "SELL"]), timestamp, "ETORO", rand.choice(["BTC", "ETH"]), rand.uniform(0.1, 1.0), 10.0))
+    save_operations(engine, operations)
+    build_timelines(engine, currency_extractor)
+
+    extractor = TaxExtractor.get_extractor("ETORO", engine, currency_extractor)
+    timestamps = sorted({operation[1] for operation in operations})
+    sweep = HoldingsSweep(extractor, timestamps[-1])
+
+    for timestamp in timestamps:
+        assert sweep.advance(timestamp) == pytest.approx(extractor.get_holdings_as_of(timestamp))
+
+    with pytest.raises(Exception, match="back in time"):
+        sweep.advance(begin)
+
+
+def test_disposal_prices_are_fetched_in_one_batch(engine):
+    begin = datetime(2021, 1, 1)
+    operations = [("BUY", begin, "ETORO", "BTC", 1.0, 20000.0), ("BUY", begin, "ETORO", "ETH", 10.0, 20000.0)]
+    operations += [("SELL", begin + timedelta(hours=i + 1), "ETORO", "BTC" if i % 2 else "ETH", 0.01, 100.0) for i in range(40)]
+    save_operations(engine, operations)
+
+    currency_extractor = CountingCurrencyExtractor(engine)
+    build_timelines(engine, currency_extractor)
+
+    report = TaxReporter(engine, currency_extractor, valuation_workers=8)
+    report.get_disposal_portfolio_values([begin + timedelta(hours=i + 1) for i in range(40)])
+
+    # one batch of the 40 disposals x 2 assets, one of the 40 EUR/USD rates
+    assert [len(query) for query in currency_extractor.queries] == [80, 40]
+
+
+def test_report_does_not_depend_on_the_worker_count(engine):
+    rand = random.Random(7)
+    begin = datetime(2021, 1, 1)
+    assets = ["BTC", "ETH", "ADA", "XRP"]
+    operations = [("BUY", begin, "ETORO", asset, 1000.0, 5000.0) for asset in assets]
+    for i in range(200):
+        timestamp = begin + timedelta(minutes=37 * (i + 1))
+        side = "BUY" if rand.random() < 0.4 else "SELL"
+        operations.append((side, timestamp, "ETORO", rand.choice(assets), rand.uniform(0.1, 2.0), rand.uniform(10.0, 5000.0)))
+    save_operations(engine, operations)
+
+    currency_extractor = VaryingCurrencyExtractor(engine)
+    build_timelines(engine, currency_extractor)
+
+    reports = [TaxReporter(engine, currency_extractor, valuation_workers=workers).generate_tax_disposal_history(begin, begin + timedelta(days=30))
+               for workers in [1, 8]]
+
+    assert len(reports[0]["disposals"]) > 100
+    assert [[str(value) for value in disposal.values()] for disposal in reports[0]["disposals"]] == \
+           [[str(value) for value in disposal.values()] for disposal in reports[1]["disposals"]]
+    assert reports[0]["global_pnl"] == reports[1]["global_pnl"]
+
+
+def test_batched_windows_carry_the_recurrence_over(engine):
+    begin = datetime(2021, 1, 1)
+    operations = [("BUY", begin, "ETORO", "BTC", 10.0, 50000.0), ("BUY", begin, "ETORO", "ETH", 100.0, 20000.0)]
+    operations += [("SELL", begin + timedelta(days=10 * (i + 1)), "ETORO", "BTC" if i % 2 else "ETH", 0.5, 3000.0) for i in range(8)]
+    save_operations(engine, operations)
+
+    currency_extractor = VaryingCurrencyExtractor(engine)
+    build_timelines(engine, currency_extractor)
+    report = TaxReporter(engine, currency_extractor, valuation_workers=1)
+    first_window = (begin, begin + timedelta(days=35))
+    second_window = (begin + timedelta(days=45), begin + timedelta(days=90))
+
+    batched = report.generate_tax_disposal_histories([first_window, second_window])[1]
+    # the second window of a batch is the end of a single report starting at the first begin
+    single = report.generate_tax_disposal_history(first_window[0], second_window[1])
+    alone = report.generate_tax_disposal_history(*second_window)
+
+    def values(tax_report):
+        return [[str(value) for value in disposal.values()] for disposal in tax_report["disposals"]]
+
+    assert len(batched["disposals"]) == 4
+    assert values(batched) == values(single)[-4:]
+    # a window reported alone restarts the recurrence at its begin
+    assert alone["disposals"][0]["current_previous_disposed_purchase"] == 0
+    assert batched["disposals"][0]["current_previous_disposed_purchase"] != 0
+    assert [disposal["disposal_datetime"] for disposal in alone["disposals"]] == [disposal["disposal_datetime"] for disposal in batched["disposals"]]
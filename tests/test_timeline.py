@@ -0,0 +1,92 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, text
+
+from conftest import write_binance_statement, write_etoro_statement
+from exchange.binance import BinanceTaxExtractor
+from exchange.etoro import EtoroTaxExtractor
+from test_watermark import FIRST_STATEMENT, SECOND_STATEMENT, load_statement
+
+
+def load_binance_statement(engine, currency_extractor, path):
+    extractor = BinanceTaxExtractor(engine, currency_extractor)
+    extractor.load_account_statement(path)
+    extractor.process_load()
+    extractor.generate_purchase_operation_history()
+    extractor.generate_sale_operation_history()
+    extractor.build_holdings_timeline()
+
+
+def get_timeline(engine, exchange):
+    with engine.connect() as conn:
+        sql = "SELECT asset, change_datetime, phase, balance FROM holdings_timeline WHERE exchange = :exchange ORDER BY position ASC"
+        return [tuple(res) for res in conn.execute(text(sql), {"exchange": exchange})]
+
+
+def get_rebuilt_timeline(engine, extractor):
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM holdings_timeline WHERE exchange = :exchange"), {"exchange": extractor.PLATFORM})
+    extractor.build_holdings_timeline()
+    return get_timeline(engine, extractor.PLATFORM)
+
+
+def test_timeline_appends_new_changes(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "BTC", "1.0", ""],
+            ["2021-01-03 10:00:00", "Spot", "Sell", "BTC", "-0.25", ""]]
+    load_binance_statement(engine, currency_extractor, write_binance_statement(tmp_path / "first.csv", rows))
+    first_timeline = get_timeline(engine, "BINANCE")
+
+    rows += [["2021-01-04 10:00:00", "Spot", "Deposit", "ETH", "2.0", ""]]
+    load_binance_statement(engine, currency_extractor, write_binance_statement(tmp_path / "second.csv", rows))
+
+    timeline = get_timeline(engine, "BINANCE")
+    assert timeline[:len(first_timeline)] == first_timeline
+    assert timeline[len(first_timeline):] == [("eth", datetime(2021, 1, 4, 10, 0), 0, 2.0)]
+
+
+def test_timeline_is_rewritten_from_an_older_change(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "BTC", "1.0", ""],
+            ["2021-01-03 10:00:00", "Spot", "Sell", "BTC", "-0.25", ""]]
+    load_binance_statement(engine, currency_extractor, write_binance_statement(tmp_path / "first.csv", rows))
+
+    # a later statement starting before the end of the timeline
+    rows = [["2021-01-02 10:00:00", "Spot", "Deposit", "BTC", "0.5", ""],
+            ["2021-01-03 10:00:00", "Spot", "Sell", "BTC", "-0.25", ""],
+            ["2021-01-05 10:00:00", "Spot", "Deposit", "BTC", "0.1", ""]]
+    load_binance_statement(engine, currency_extractor, write_binance_statement(tmp_path / "second.csv", rows))
+
+    timeline = get_timeline(engine, "BINANCE")
+    assert [balance for _, _, _, balance in timeline] == pytest.approx([1.0, 1.5, 1.25, 1.35])
+    assert timeline == get_rebuilt_timeline(engine, BinanceTaxExtractor(engine, currency_extractor))
+
+
+@pytest.mark.parametrize("try_compact", [False, True])
+def test_replaced_sales_rewrite_the_timeline(engine, currency_extractor, tmp_path, try_compact):
+    first = write_etoro_statement(tmp_path / "first.xlsx", FIRST_STATEMENT)
+    second = write_etoro_statement(tmp_path / "second.xlsx", SECOND_STATEMENT)
+
+    extractor = EtoroTaxExtractor(engine, currency_extractor)
+    load_statement(engine, currency_extractor, first, try_compact)
+    extractor.build_holdings_timeline()
+    load_statement(engine, currency_extractor, second, try_compact)
+    extractor.build_holdings_timeline()
+
+    assert get_timeline(engine, "ETORO") == get_rebuilt_timeline(engine, extractor)
+
+
+def test_holdings_as_of_is_one_query(engine, currency_extractor, tmp_path):
+    rows = [["2021-01-01 10:00:00", "Spot", "Deposit", "BTC", "1.0", ""],
+            ["2021-01-01 10:00:00", "Spot", "Deposit", "ETH", "3.0", ""],
+            ["2021-01-02 10:00:00", "Spot", "Sell", "BTC", "-0.25", ""],
+            ["2021-01-03 10:00:00", "Spot", "Deposit", "ADA", "10.0", ""]]
+    load_binance_statement(engine, currency_extractor, write_binance_statement(tmp_path / "statement.csv", rows))
+    extractor = BinanceTaxExtractor(engine, currency_extractor)
+    extractor.timeline_built = True
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    holdings = extractor.get_holdings_as_of(datetime(2021, 1, 2, 10, 0))
+
+    assert holdings == {"btc": 0.75, "eth": 3.0}
+    assert len(statements) == 1
@@ -0,0 +1,115 @@
+import pytest
+from sqlalchemy import text
+
+from conftest import create_sqlite_engine, write_etoro_statement
+from exchange.etoro import EtoroTaxExtractor
+from utils import boot_db
+
+
+def close_row(position_id, close_date, amount_asset="0,005", action="Buy Bitcoin"):
+    return [position_id, action, None, "100,00", amount_asset, "20000,00", "22000,00", "0,00", "10,00", "01/01/2021 10:00", close_date]
+
+
+FIRST_STATEMENT = [close_row(1, "01/02/2021 10:00"),
+                   close_row(2, "01/02/2021 10:00", "0,002"),
+                   close_row(3, "01/02/2021 11:00", action="Buy Ethereum")]
+# a later statement with a close of the last minute of the first one, and of a new minute
+SECOND_STATEMENT = FIRST_STATEMENT + [close_row(4, "01/02/2021 10:00", "0,001"),
+                                      close_row(5, "01/02/2021 12:00")]
+
+
+def load_statement(engine, currency_extractor, path, try_compact):
+    extractor = EtoroTaxExtractor(engine, currency_extractor)
+    extractor.load_account_statement(path)
+    extractor.process_load()
+    extractor.generate_purchase_operation_history()
+    extractor.generate_sale_operation_history(try_compact=try_compact)
+
+
+def get_sales(engine):
+    with engine.connect() as conn:
+        sql = "SELECT sale_datetime, asset, amount_asset, amount_price_usd FROM sale_operation_history ORDER BY sale_datetime ASC, asset ASC"
+        return [tuple(res) for res in conn.execute(text(sql))]
+
+
+def get_full_load_sales(tmp_path, currency_extractor, path, try_compact):
+    engine = create_sqlite_engine(tmp_path / "full.db")
+    boot_db("sqlite", engine)
+    load_statement(engine, type(currency_extractor)(engine), path, try_compact)
+    return get_sales(engine)
+
+
+def test_compaction_merges_closes_across_the_watermark(engine, currency_extractor, tmp_path):
+    first = write_etoro_statement(tmp_path / "first.xlsx", FIRST_STATEMENT)
+    second = write_etoro_statement(tmp_path / "second.xlsx", SECOND_STATEMENT)
+
+    load_statement(engine, currency_extractor, first, try_compact=True)
+    assert len(get_sales(engine)) == 2
+    load_statement(engine, currency_extractor, second, try_compact=True)
+
+    sales = get_sales(engine)
+    # closes 1, 2 and 4 of 10:00 are one sale, even if 4 came after the watermark
+    assert [(sale[1], round(sale[2], 6)) for sale in sales] == [("bitcoin", 0.008), ("ethereum", 0.005), ("bitcoin", 0.005)]
+    assert sales == get_full_load_sales(tmp_path, currency_extractor, second, try_compact=True)
+
+
+def test_incremental_load_matches_a_full_load(engine, currency_extractor, tmp_path):
+    first = write_etoro_statement(tmp_path / "first.xlsx", FIRST_STATEMENT)
+    second = write_etoro_statement(tmp_path / "second.xlsx", SECOND_STATEMENT)
+
+    load_statement(engine, currency_extractor, first, try_compact=False)
+    load_statement(engine, currency_extractor, second, try_compact=False)
+
+    assert len(get_sales(engine)) == 5
+    assert get_sales(engine) == get_full_load_sales(tmp_path, currency_extractor, second, try_compact=False)
+
+
+def test_changing_compaction_regenerates_the_sales(engine, currency_extractor, tmp_path):
+    second = write_etoro_statement(tmp_path / "second.xlsx", SECOND_STATEMENT)
+
+    load_statement(engine, currency_extractor, second, try_compact=False)
+    load_statement(engine, currency_extractor, second, try_compact=True)
+
+    assert get_sales(engine) == get_full_load_sales(tmp_path, currency_extractor, second, try_compact=True)
+
+
+def get_purchases(engine):
+    with engine.connect() as conn:
+        sql = "SELECT purchase_datetime, asset, amount_asset, amount_price_usd FROM purchase_operation_history ORDER BY purchase_datetime ASC, asset ASC"
+        return [tuple(res) for res in conn.execute(text(sql))]
+
+
+def test_position_closed_by_a_later_load_is_replaced_after_a_restart(engine, currency_extractor, tmp_path):
+    open_row = ["2021-01-01 10:00:00", "1000,00", "Open Position", "BTC/USD", 1001, "100.00"]
+    first = write_etoro_statement(tmp_path / "first.xlsx", [], [open_row])
+    second = write_etoro_statement(tmp_path / "second.xlsx", [close_row(1001, "01/02/2021 10:00", "0,004")], [open_row])
+
+    load_statement(engine, currency_extractor, first, try_compact=False)
+    # the open position is consolidated with its close position, then the load stops before generating the purchases
+    extractor = EtoroTaxExtractor(engine, currency_extractor)
+    extractor.load_account_statement(second)
+    extractor.process_load()
+
+    EtoroTaxExtractor(engine, currency_extractor).generate_purchase_operation_history()
+
+    assert [round(purchase[2], 6) for purchase in get_purchases(engine)] == [0.004]
+
+
+def test_failed_regeneration_keeps_the_history(engine, currency_extractor, tmp_path, monkeypatch):
+    second = write_etoro_statement(tmp_path / "second.xlsx", SECOND_STATEMENT)
+    load_statement(engine, currency_extractor, second, try_compact=False)
+    sales = get_sales(engine)
+
+    # changing the compaction mode regenerates every sale, the replaced ones are only deleted with the new ones saved
+    extractor = EtoroTaxExtractor(engine, currency_extractor)
+    assert extractor.get_operation_watermark("SALE", compacted=True) == 0
+    assert get_sales(engine) == sales
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(extractor, "save_operation_watermark", fail)
+    with pytest.raises(RuntimeError):
+        extractor.generate_sale_operation_history(try_compact=True)
+
+    assert get_sales(engine) == sales